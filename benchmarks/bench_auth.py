@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Measure AuthMap.userHas checks/sec against a large privilege map: thousands
+of literal and wildcard masks spread over nested privilege groups. Compares
+the indexed lookup against the old recursive fnmatch scan.
+
+usage: python benchmarks/bench_auth.py [masks] [groups] [checks]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cassbot import AuthMap, mask_matches
+
+
+class LegacyAuthMap(AuthMap):
+    """
+    AuthMap.userHas as it was before lookups were indexed.
+    """
+
+    def userHas(self, user, privname, skip=set()):
+        members = self.whoHas(privname)
+        for mask in members:
+            if mask_matches(mask, user):
+                return True
+        # avoid circular paths
+        newskip = skip | set(members)
+        for m in members:
+            if m in skip:
+                continue
+            if self.userHas(user, m, skip=newskip):
+                return True
+        return False
+
+
+def populate(auth, nmasks, ngroups, rand):
+    groups = ['group%d' % n for n in xrange(ngroups)]
+    for n in xrange(nmasks):
+        if n % 4 == 0:
+            mask = '*!*@host%d.example.*' % n
+        else:
+            mask = 'nick%d!user%d@host%d.example.com' % (n, n, n)
+        auth.addPriv(mask, rand.choice(groups))
+    # chain the groups together, with a cycle for good measure
+    for n in xrange(1, ngroups):
+        auth.addPriv(groups[n], groups[n - 1])
+    auth.addPriv(groups[0], groups[-1])
+    auth.addPriv('group0', 'admin')
+
+
+def users(nmasks, rand):
+    while True:
+        n = rand.randrange(nmasks * 2)
+        yield 'nick%d!user%d@host%d.example.com' % (n, n, n)
+
+
+def run(auth, nmasks, checks, seed):
+    rand = random.Random(seed)
+    gen = users(nmasks, rand)
+    # a realistic mix: most checks come from a small set of active users
+    active = [gen.next() for n in xrange(50)]
+    names = [rand.choice(active) if rand.random() < 0.9 else gen.next()
+             for n in xrange(checks)]
+    start = time.time()
+    for user in names:
+        auth.userHas(user, 'admin')
+    return checks / (time.time() - start)
+
+
+def main(nmasks=2000, ngroups=10, checks=20000):
+    # the old implementation is far too slow to do the full run
+    results = []
+    for cls, n in ((LegacyAuthMap, max(1, checks / 100)), (AuthMap, checks)):
+        auth = cls()
+        populate(auth, nmasks, ngroups, random.Random(1))
+        results.append(run(auth, nmasks, n, 2))
+    before, after = results
+    print '%d masks, %d nested groups: before %.0f checks/s, after %.0f checks/s (%.1fx)' \
+          % (nmasks, ngroups, before, after, after / before)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
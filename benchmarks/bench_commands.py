@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for turning an addressed message into plugin method calls:
+the old shlex.split + string munging + getattr path against split_command
+and the precomputed CommandRouter table.
+
+usage: python benchmarks/bench_commands.py [iterations]
+"""
+
+import os
+import sys
+import time
+import shlex
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import task
+from cassbot import CassBotService, split_command
+
+messages = [
+    'modules',
+    'modenable BotLogger LogsCommand',
+    'blacklist me',
+    'show blacklist',
+    'build cassandra-trunk',
+    'grep "out of memory" compaction',
+    'open-manhole 2222',
+]
+
+
+def old_path(serv, cmdstr):
+    parts = shlex.split(cmdstr.strip())
+    cmd = parts[0].lower().replace('-', '_')
+    mname = 'command_' + cmd
+    found = []
+    for p in serv.command_map.get(cmd, ()):
+        try:
+            found.append(getattr(p, mname))
+        except AttributeError:
+            continue
+    return found, parts[1:]
+
+
+def new_path(serv, cmdstr):
+    parts = split_command(cmdstr)
+    route = serv.router.route(parts[0])
+    return route, parts[1:]
+
+
+def timeit(f, serv, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        for m in messages:
+            f(serv, m)
+    return iterations * len(messages) / (time.time() - start)
+
+
+def main(iterations=20000):
+    serv = CassBotService('tcp:host=localhost:port=6667', reactor=task.Clock())
+    for pname in ('Admin', 'BotLogger', 'BuildCommand', 'OpenManhole'):
+        serv.enable_plugin_by_name(pname)
+    before = timeit(old_path, serv, iterations)
+    after = timeit(new_path, serv, iterations)
+    print 'before %.0f commands/s, after %.0f commands/s (%.1fx)' \
+          % (before, after, after / before)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Measure events/sec through the CassBotCore plugin fan-out, comparing the
+old inlineCallbacks-based watch wrapper against the precompiled dispatch
+path.
+
+usage: python benchmarks/bench_dispatch.py [events] [plugins]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import defer, task
+from twisted.python import log
+from cassbot import (CassBotCore, CassBotService, BaseBotPlugin, enabled_but_not_found,
+                     noop)
+
+
+class LegacyCassBotCore(CassBotCore):
+    """
+    CassBotCore with the watch wrapper as it was before the precompiled
+    dispatch path existed.
+    """
+
+    def make_watch_wrapper(self, mname, realmethod):
+        @defer.inlineCallbacks
+        def wrapper(*a, **kw):
+            realresult = yield realmethod(*a, **kw)
+            watchers = self.service.watcher_map.get(mname, ())
+            for w in watchers:
+                pluginmethod = getattr(w, mname, noop)
+                try:
+                    yield pluginmethod(self, *a, **kw)
+                except Exception:
+                    log.err(None, 'Exception in plugin %s for method %r'
+                                  % (w.name(), mname))
+            defer.returnValue(realresult)
+        wrapper.func_name = 'wrapper_for_%s' % mname
+        return wrapper
+
+
+def make_plugin_class(n, deferred=False):
+    def privmsg(self, bot, user, channel, msg):
+        self.seen += 1
+        if deferred:
+            return defer.succeed(None)
+    def __init__(self):
+        self.seen = 0
+    return type('BenchPlugin%d' % n, (BaseBotPlugin,),
+                {'__init__': __init__, 'privmsg': privmsg})
+
+
+def make_service(classes):
+    serv = CassBotService('tcp:host=localhost:port=6667', reactor=task.Clock())
+    for pclass in classes:
+        # these aren't in the plugin package, so hand them over as if they
+        # had just been found there
+        serv.pluginmap[pclass.name()] = enabled_but_not_found()
+        serv.plugin_class_found(pclass)
+    return serv
+
+
+def hooks_fired(serv):
+    return sum(p.seen for p in serv.pluginmap.itervalues())
+
+
+def run(coreclass, serv, events):
+    bot = coreclass()
+    serv.initialize_proto_state(bot)
+    start = time.time()
+    for i in xrange(events):
+        bot.privmsg('someone!user@host', '#chan', 'just chatting, nothing to see')
+    return events / (time.time() - start)
+
+
+def main(events=100000, nplugins=5):
+    for label, deferred in (('sync hooks', False), ('one Deferred hook', True)):
+        classes = [make_plugin_class(n) for n in xrange(nplugins - 1)]
+        classes.append(make_plugin_class(nplugins, deferred=deferred))
+        serv = make_service(classes)
+        before = run(LegacyCassBotCore, serv, events)
+        after = run(CassBotCore, serv, events)
+        fired = hooks_fired(serv)
+        if fired != 2 * events * nplugins:
+            raise AssertionError('expected %d plugin hook calls, got %d'
+                                 % (2 * events * nplugins, fired))
+        print '%-18s %d plugins: before %9.0f events/s, after %9.0f events/s (%.1fx)' \
+              % (label, nplugins, before, after, after / before)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+A stub CI server, answering build trigger requests the way Hudson does
+(with a 404, after a delay), and a driver that has many users ask a bot
+to build the same few jobs at once. Reports how many requests actually
+reached the server, how many connections they took, and what the users
+were told, to check that BuildCommand coalesces duplicate requests,
+honors its cooldown and reuses connections.
+
+usage: python benchmarks/ci_stub.py [options]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+from twisted.test import proto_helpers
+from twisted.web import resource, server
+from cassbot import CassBotService
+
+
+class StubCI(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, delay):
+        resource.Resource.__init__(self)
+        self.delay = delay
+        self.hits = {}
+        self.connections = set()
+
+    def render_GET(self, request):
+        job = request.postpath[0] if request.postpath else ''
+        self.hits[job] = self.hits.get(job, 0) + 1
+        self.connections.add(id(request.channel))
+        def respond():
+            request.setResponseCode(404)
+            request.write('Not Found')
+            request.finish()
+        call = reactor.callLater(self.delay, respond)
+        request.notifyFinish().addErrback(lambda f: call.cancel())
+        return server.NOT_DONE_YET
+
+
+def settle(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+@defer.inlineCallbacks
+def drive(opts, bot, ci):
+    def ask(n):
+        job = 'job%d' % (n % opts.jobs)
+        bot.lineReceived(':user%d!u@host%d PRIVMSG #builds :%s: build %s'
+                         % (n, n, bot.nickname, job))
+    for rnd in range(opts.rounds):
+        for n in xrange(opts.users):
+            ask(n)
+        yield settle(opts.delay * 2 + 0.5)
+    replies = {}
+    for line in bot.transport.value().splitlines():
+        if line.startswith('PRIVMSG #builds :'):
+            text = line.split(':', 1)[1].split(': ', 1)[-1]
+            text = 'triggered recently' if 'seconds ago' in text else text
+            replies[text] = replies.get(text, 0) + 1
+    print ('%d build commands for %d jobs in %d rounds -> %d requests to the CI'
+           ' server over %d connections'
+           % (opts.users * opts.rounds, opts.jobs, opts.rounds, sum(ci.hits.values()),
+              len(ci.connections)))
+    print 'http client: %r' % (bot.service.http.stats(),)
+    for text, n in sorted(replies.iteritems()):
+        print '%6d x %r' % (n, text)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-u', '--users', type='int', default=50,
+                      help='users asking for a build at once [%default]')
+    parser.add_option('-j', '--jobs', type='int', default=3,
+                      help='distinct jobs asked for [%default]')
+    parser.add_option('-r', '--rounds', type='int', default=2,
+                      help='times everyone asks [%default]')
+    parser.add_option('--delay', type='float', default=0.5,
+                      help='seconds the stub takes to answer [%default]')
+    parser.add_option('--cooldown', type='float', default=60,
+                      help='BuildCommand\'s cooldown per job [%default]')
+    parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = parser.parse_args()
+    if opts.verbose:
+        log.startLogging(sys.stderr)
+
+    ci = StubCI(opts.delay)
+    port = reactor.listenTCP(0, server.Site(ci), interface='127.0.0.1')
+    statedir = tempfile.mkdtemp(prefix='cassbot-ci-')
+    serv = CassBotService('tcp:host=127.0.0.1:port=1',
+                          statefile=os.path.join(statedir, 'cassbot.state.db'))
+    # don't let throttling get in the way
+    serv.state['command_rate'] = serv.state['command_burst'] = opts.users * opts.rounds
+    serv.state['flood_rate'] = serv.state['flood_burst'] = opts.users * opts.rounds
+    serv.configure_throttle()
+    serv.state['plugins']['BuildCommand'] = {
+        'build_url': 'http://127.0.0.1:%d/job' % port.getHost().port,
+        'cooldown': opts.cooldown,
+    }
+    serv.state['plugin_max_in_flight'] = opts.users
+    serv.enable_plugin_by_name('BuildCommand')
+    bot = serv.pfactory.buildProtocol(None)
+    bot.makeConnection(proto_helpers.StringTransport())
+
+    d = drive(opts, bot, ci)
+    d.addErrback(log.err)
+    d.addCallback(lambda _: serv.http.close())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    shutil.rmtree(statedir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
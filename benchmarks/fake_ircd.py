@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+"""
+A stand-in IRC server for scale and soak testing. It speaks enough of the
+protocol for CassBotCore: registration (with ISUPPORT and a MOTD), JOIN,
+PART, NAMES, MODE, TOPIC, PRIVMSG, NOTICE, NICK, QUIT and PING, and it
+can throttle clients the way real servers do (fake lag, and a kill for
+excess flood).
+
+Everyone besides the real, connected clients is a virtual user, which
+only exists inside the server. FakeIRCServer has methods for making
+virtual users join, talk, change nicks and so on, for scripting, and
+LoadGenerator calls them at a configured rate to simulate a busy network.
+
+usage: python benchmarks/fake_ircd.py [options]
+"""
+
+import os
+import sys
+import time
+import random
+from collections import deque
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import protocol, task
+from twisted.protocols import basic
+from twisted.python import log
+from cassbot import TokenBucket
+
+# how the server presents itself
+isupport = ('PREFIX=(ov)@+', 'CHANTYPES=#&', 'CHANMODES=b,k,l,imnpst', 'MODES=4',
+            'NICKLEN=30', 'NETWORK=FakeNet')
+prefixes = (('o', '@'), ('v', '+'))
+
+
+class VirtualUser:
+    def __init__(self, nick):
+        self.nick = nick
+        self.ident = '~' + nick
+        self.host = 'host%d.users.fake' % (hash(nick) % 9973)
+        self.channels = set()
+
+    def mask(self):
+        return '%s!%s@%s' % (self.nick, self.ident, self.host)
+
+    def send(self, line):
+        pass
+
+
+class Channel:
+    def __init__(self, name):
+        self.name = name
+        # nick -> set of mode letters ('o', 'v') the member has
+        self.members = {}
+        self.topic = None
+        self.created = int(time.time())
+
+    def names(self):
+        for nick, modes in self.members.iteritems():
+            prefix = ''.join(p for (m, p) in prefixes if m in modes)
+            yield prefix + nick
+
+
+class FakeIRCServer(protocol.ServerFactory):
+    """
+    The state of the whole simulated network, and the factory for client
+    connections. Methods named after IRC actions (join, part, say, rename,
+    quit, set_mode, kick) act on behalf of any user, virtual or real, and
+    tell everybody who ought to hear about it.
+    """
+
+    servername = 'irc.fake.example'
+
+    def __init__(self, clock=None, flood_rate=0, flood_burst=10, max_backlog=500):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        # client throttling; a flood_rate of 0 turns it off
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+        self.max_backlog = max_backlog
+        # nick -> VirtualUser or IRCServerConnection
+        self.users = {}
+        self.channels = {}
+        self.stats = {'lines_in': 0, 'lines_out': 0, 'privmsgs_in': 0, 'kills': 0}
+
+    def buildProtocol(self, addr):
+        p = IRCServerConnection()
+        p.factory = self
+        return p
+
+    def channel(self, name):
+        c = self.channels.get(name)
+        if c is None:
+            c = self.channels[name] = Channel(name)
+        return c
+
+    def clients(self):
+        return [u for u in self.users.itervalues() if isinstance(u, IRCServerConnection)]
+
+    def tell_channels(self, channels, line, exclude=None):
+        told = set()
+        for chan in channels:
+            for nick in chan.members:
+                if nick not in told and nick != exclude:
+                    told.add(nick)
+                    self.users[nick].send(line)
+
+    def add_user(self, nick):
+        u = self.users[nick] = VirtualUser(nick)
+        return u
+
+    def join(self, nick, channame):
+        u = self.users[nick]
+        chan = self.channel(channame)
+        if nick in chan.members:
+            return
+        # first one in gets ops
+        chan.members[nick] = set('o') if not chan.members else set()
+        u.channels.add(channame)
+        self.tell_channels([chan], ':%s JOIN %s' % (u.mask(), channame))
+        if isinstance(u, IRCServerConnection):
+            if chan.topic:
+                u.reply('332', channame, chan.topic)
+            u.send_names(chan)
+
+    def part(self, nick, channame, message='Leaving'):
+        u = self.users[nick]
+        chan = self.channels.get(channame)
+        if chan is None or nick not in chan.members:
+            return
+        self.tell_channels([chan], ':%s PART %s :%s' % (u.mask(), channame, message))
+        self.remove_member(u, chan)
+
+    def kick(self, kicker, channame, nick, message='Behave'):
+        chan = self.channels.get(channame)
+        if chan is None or nick not in chan.members:
+            return
+        self.tell_channels([chan], ':%s KICK %s %s :%s'
+                                   % (self.prefix_for(kicker), channame, nick, message))
+        self.remove_member(self.users[nick], chan)
+
+    def remove_member(self, u, chan):
+        del chan.members[u.nick]
+        u.channels.discard(chan.name)
+        if not chan.members:
+            del self.channels[chan.name]
+
+    def say(self, nick, target, text, command='PRIVMSG'):
+        u = self.users[nick]
+        line = ':%s %s %s :%s' % (u.mask(), command, target, text)
+        if target in self.channels:
+            self.tell_channels([self.channels[target]], line, exclude=nick)
+        elif target in self.users:
+            self.users[target].send(line)
+
+    def rename(self, oldnick, newnick):
+        u = self.users.pop(oldnick)
+        line = ':%s NICK :%s' % (u.mask(), newnick)
+        u.nick = newnick
+        self.users[newnick] = u
+        chans = [self.channels[c] for c in u.channels]
+        for chan in chans:
+            chan.members[newnick] = chan.members.pop(oldnick)
+        self.tell_channels(chans, line)
+        if isinstance(u, IRCServerConnection):
+            # they always hear about their own rename
+            if not chans:
+                u.send(line)
+
+    def quit(self, nick, message='Quit'):
+        u = self.users.get(nick)
+        if u is None:
+            return
+        chans = [self.channels[c] for c in u.channels]
+        self.tell_channels(chans, ':%s QUIT :%s' % (u.mask(), message), exclude=nick)
+        for chan in chans:
+            self.remove_member(u, chan)
+        del self.users[nick]
+
+    def set_mode(self, setter, channame, sign, mode, nick):
+        chan = self.channels.get(channame)
+        if chan is None or nick not in chan.members:
+            return
+        modes = chan.members[nick]
+        if sign == '+':
+            modes.add(mode)
+        else:
+            modes.discard(mode)
+        self.tell_channels([chan], ':%s MODE %s %s%s %s'
+                                   % (self.prefix_for(setter), channame, sign, mode, nick))
+
+    def prefix_for(self, nick):
+        u = self.users.get(nick)
+        if u is None:
+            # services and such, which aren't really on the network
+            return '%s!services@services.fake' % nick
+        return u.mask()
+
+
+class IRCServerConnection(basic.LineReceiver):
+    """
+    One real client connected to the FakeIRCServer.
+    """
+
+    delimiter = '\r\n'
+    MAX_LENGTH = 4096
+
+    def __init__(self):
+        self.nick = None
+        self.ident = None
+        self.host = None
+        self.registered = False
+        self.channels = set()
+        self.backlog = deque()
+        self.bucket = None
+        self.drain_call = None
+
+    def connectionMade(self):
+        server = self.factory
+        self.host = self.transport.getPeer().host
+        if server.flood_rate:
+            self.bucket = TokenBucket(server.flood_rate, server.flood_burst, server.clock)
+        self.pinger = task.LoopingCall(self.sendLine, 'PING :%s' % server.servername)
+        self.pinger.clock = server.clock
+        self.pinger.start(60, now=False)
+
+    def connectionLost(self, reason):
+        if self.pinger.running:
+            self.pinger.stop()
+        if self.drain_call is not None and self.drain_call.active():
+            self.drain_call.cancel()
+        if self.registered:
+            self.factory.quit(self.nick, 'Connection closed')
+
+    def mask(self):
+        return '%s!%s@%s' % (self.nick, self.ident, self.host)
+
+    def send(self, line):
+        self.factory.stats['lines_out'] += 1
+        self.sendLine(line)
+
+    def reply(self, numeric, *params):
+        params = list(params)
+        if params:
+            params[-1] = ':' + params[-1]
+        self.send(':%s %s %s %s' % (self.factory.servername, numeric,
+                                    self.nick or '*', ' '.join(params)))
+
+    def lineReceived(self, line):
+        self.factory.stats['lines_in'] += 1
+        if self.bucket is None:
+            return self.handle(line)
+        # fake lag: lines beyond the client's allowance wait their turn,
+        # and a client that gets too far ahead is killed
+        self.backlog.append(line)
+        if len(self.backlog) > self.factory.max_backlog:
+            self.factory.stats['kills'] += 1
+            self.send('ERROR :Closing Link: %s (Excess Flood)' % (self.host,))
+            self.transport.loseConnection()
+            self.backlog.clear()
+            return
+        self.drain()
+
+    def drain(self):
+        self.drain_call = None
+        while self.backlog:
+            wait = self.bucket.delay()
+            if wait > 0:
+                self.drain_call = self.factory.clock.callLater(wait, self.drain)
+                return
+            self.bucket.consume()
+            self.handle(self.backlog.popleft())
+
+    def handle(self, line):
+        if not line:
+            return
+        if line.startswith(':'):
+            line = line.split(' ', 1)[1]
+        if ' :' in line:
+            line, trailing = line.split(' :', 1)
+            params = line.split() + [trailing]
+        else:
+            params = line.split()
+        command, params = params[0].upper(), params[1:]
+        method = getattr(self, 'irc_' + command, None)
+        if method is None:
+            if self.registered:
+                self.reply('421', command, 'Unknown command')
+            return
+        if not self.registered and command not in ('NICK', 'USER', 'PASS', 'PONG', 'QUIT'):
+            self.reply('451', 'You have not registered')
+            return
+        try:
+            method(params)
+        except IndexError:
+            self.reply('461', command, 'Not enough parameters')
+
+    def irc_PASS(self, params):
+        pass
+
+    def irc_NICK(self, params):
+        nick = params[0]
+        server = self.factory
+        if nick in server.users:
+            self.reply('433', nick, 'Nickname is already in use')
+            return
+        if self.registered:
+            server.rename(self.nick, nick)
+            return
+        self.nick = nick
+        self.maybe_register()
+
+    def irc_USER(self, params):
+        self.ident = params[0]
+        self.maybe_register()
+
+    def maybe_register(self):
+        if self.nick is None or self.ident is None:
+            return
+        server = self.factory
+        server.users[self.nick] = self
+        self.registered = True
+        self.reply('001', 'Welcome to FakeNet %s' % self.mask())
+        self.reply('002', 'Your host is %s, running fake_ircd' % server.servername)
+        self.reply('003', 'This server was created just now')
+        self.send(':%s 004 %s %s fake_ircd-1 iow bklmnopstv'
+                  % (server.servername, self.nick, server.servername))
+        self.send(':%s 005 %s %s :are supported by this server'
+                  % (server.servername, self.nick, ' '.join(isupport)))
+        self.reply('375', '- %s Message of the day -' % server.servername)
+        self.reply('372', '- Nothing to see here.')
+        self.reply('376', 'End of /MOTD command.')
+
+    def irc_PING(self, params):
+        self.send(':%s PONG %s :%s' % (self.factory.servername,
+                                       self.factory.servername, params[-1]))
+
+    def irc_PONG(self, params):
+        pass
+
+    def irc_JOIN(self, params):
+        for chan in params[0].split(','):
+            if chan[:1] not in '#&':
+                self.reply('403', chan, 'No such channel')
+                continue
+            self.factory.join(self.nick, chan)
+
+    def irc_PART(self, params):
+        message = params[1] if len(params) > 1 else 'Leaving'
+        for chan in params[0].split(','):
+            self.factory.part(self.nick, chan, message)
+
+    def irc_NAMES(self, params):
+        for chan in params[0].split(','):
+            c = self.factory.channels.get(chan)
+            if c is None:
+                self.reply('366', chan, 'End of /NAMES list.')
+            else:
+                self.send_names(c)
+
+    def send_names(self, chan):
+        names = list(chan.names())
+        head = ':%s 353 %s = %s :' % (self.factory.servername, self.nick, chan.name)
+        line = []
+        size = len(head)
+        for name in names:
+            if line and size + len(name) + 1 > 480:
+                self.send(head + ' '.join(line))
+                line = []
+                size = len(head)
+            line.append(name)
+            size += len(name) + 1
+        if line:
+            self.send(head + ' '.join(line))
+        self.reply('366', chan.name, 'End of /NAMES list.')
+
+    def irc_MODE(self, params):
+        target = params[0]
+        server = self.factory
+        if target not in server.channels:
+            if target == self.nick:
+                if len(params) > 1:
+                    self.send(':%s MODE %s :%s' % (self.mask(), self.nick, params[1]))
+                else:
+                    self.reply('221', '+i')
+            else:
+                self.reply('403', target, 'No such channel')
+            return
+        chan = server.channels[target]
+        if len(params) == 1:
+            self.send(':%s 324 %s %s +nt' % (server.servername, self.nick, target))
+            self.send(':%s 329 %s %s %d' % (server.servername, self.nick, target,
+                                            chan.created))
+            return
+        modes, args = params[1], params[2:]
+        sign = '+'
+        for m in modes:
+            if m in '+-':
+                sign = m
+            elif m in 'ov' and args:
+                server.set_mode(self.nick, target, sign, m, args.pop(0))
+
+    def irc_TOPIC(self, params):
+        chan = self.factory.channels.get(params[0])
+        if chan is None:
+            self.reply('403', params[0], 'No such channel')
+        elif len(params) > 1:
+            chan.topic = params[1]
+            self.factory.tell_channels([chan], ':%s TOPIC %s :%s'
+                                               % (self.mask(), chan.name, chan.topic))
+        elif chan.topic:
+            self.reply('332', chan.name, chan.topic)
+        else:
+            self.reply('331', chan.name, 'No topic is set')
+
+    def irc_PRIVMSG(self, params, command='PRIVMSG'):
+        server = self.factory
+        server.stats['privmsgs_in'] += 1
+        for target in params[0].split(','):
+            if target in server.channels or target in server.users:
+                server.say(self.nick, target, params[1], command)
+            else:
+                self.reply('401', target, 'No such nick/channel')
+
+    def irc_NOTICE(self, params):
+        self.irc_PRIVMSG(params, 'NOTICE')
+
+    def irc_QUIT(self, params):
+        message = params[0] if params else 'Quit'
+        self.send('ERROR :Closing Link: %s (Quit: %s)' % (self.host, message))
+        self.transport.loseConnection()
+
+
+class LoadGenerator:
+    """
+    Makes virtual users do things at a given number of events per second,
+    picking events at random according to the given weights. Users who
+    quit are replaced, so the population stays about the same size.
+    """
+
+    default_mix = (('chat', 80), ('join', 5), ('part', 5), ('nick', 4),
+                   ('quit', 3), ('mode', 3))
+    tick = 0.1
+
+    def __init__(self, server, rand, rate, mix=None, channels_per_user=3):
+        self.server = server
+        self.rand = rand
+        self.rate = rate
+        self.channels_per_user = channels_per_user
+        self.choices = []
+        for event, weight in (mix or self.default_mix):
+            self.choices.extend([getattr(self, 'do_' + event)] * weight)
+        self.looper = task.LoopingCall(self.step)
+        self.looper.clock = server.clock
+        self.owed = 0.0
+        self.serial = 0
+        self.events = 0
+
+    def populate(self, nchannels, nusers):
+        self.channames = ['#chan%d' % n for n in xrange(nchannels)]
+        for n in xrange(nusers):
+            self.new_user()
+
+    def new_user(self):
+        self.serial += 1
+        nick = 'v%d' % self.serial
+        self.server.add_user(nick)
+        for chan in self.rand.sample(self.channames, min(self.channels_per_user,
+                                                         len(self.channames))):
+            self.server.join(nick, chan)
+        return nick
+
+    def virtual_user(self):
+        # rand.choice over the dict would mean building a list every time;
+        # retry a few random channels instead
+        for i in xrange(10):
+            chan = self.server.channels.get(self.rand.choice(self.channames))
+            if chan is None or not chan.members:
+                continue
+            nick = self.rand.choice(chan.members.keys())
+            if isinstance(self.server.users[nick], VirtualUser):
+                return nick, chan.name
+        return None, None
+
+    def start(self):
+        self.looper.start(self.tick, now=False)
+
+    def stop(self):
+        if self.looper.running:
+            self.looper.stop()
+
+    def step(self):
+        self.owed += self.rate * self.tick
+        while self.owed >= 1:
+            self.owed -= 1
+            self.rand.choice(self.choices)()
+            self.events += 1
+
+    def do_chat(self):
+        nick, chan = self.virtual_user()
+        if nick is not None:
+            self.server.say(nick, chan, 'message %d from %s' % (self.events, nick))
+
+    def do_join(self):
+        nick, chan = self.virtual_user()
+        if nick is not None:
+            self.server.join(nick, self.rand.choice(self.channames))
+
+    def do_part(self):
+        nick, chan = self.virtual_user()
+        if nick is not None:
+            self.server.part(nick, chan)
+
+    def do_nick(self):
+        nick, chan = self.virtual_user()
+        if nick is not None:
+            self.serial += 1
+            self.server.rename(nick, 'v%d' % self.serial)
+
+    def do_quit(self):
+        nick, chan = self.virtual_user()
+        if nick is not None:
+            self.server.quit(nick, 'Ping timeout: 240 seconds')
+            self.new_user()
+
+    def do_mode(self):
+        nick, chan = self.virtual_user()
+        if nick is not None:
+            self.server.set_mode('ChanServ', chan, self.rand.choice('+-'),
+                                 self.rand.choice('ov'), nick)
+
+
+def add_server_options(parser):
+    parser.add_option('-c', '--channels', type='int', default=200,
+                      help='channels on the network [%default]')
+    parser.add_option('-u', '--users', type='int', default=2000,
+                      help='virtual users [%default]')
+    parser.add_option('--channels-per-user', type='int', default=3,
+                      help='channels each virtual user is in [%default]')
+    parser.add_option('-r', '--rate', type='float', default=200,
+                      help='load generator events per second [%default]')
+    parser.add_option('--flood-rate', type='float', default=0,
+                      help='lines/sec allowed per client, or 0 for no throttling'
+                           ' [%default]; 2 is typical of real servers')
+    parser.add_option('--flood-burst', type='int', default=10,
+                      help='lines a client may send before throttling [%default]')
+    parser.add_option('--max-backlog', type='int', default=500,
+                      help='throttled lines before an Excess Flood kill [%default]')
+    parser.add_option('-s', '--seed', type='int', default=1)
+
+def make_server(opts, clock=None):
+    server = FakeIRCServer(clock, flood_rate=opts.flood_rate,
+                           flood_burst=opts.flood_burst, max_backlog=opts.max_backlog)
+    gen = LoadGenerator(server, random.Random(opts.seed), opts.rate,
+                        channels_per_user=opts.channels_per_user)
+    gen.populate(opts.channels, opts.users)
+    return server, gen
+
+def main():
+    from twisted.internet import reactor
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--port', type='int', default=6667)
+    add_server_options(parser)
+    opts, args = parser.parse_args()
+    log.startLogging(sys.stdout)
+    server, gen = make_server(opts)
+    reactor.listenTCP(opts.port, server)
+    gen.start()
+    def report():
+        log.msg('%d users in %d channels, %d clients; %d events; stats: %r'
+                % (len(server.users), len(server.channels), len(server.clients()),
+                   gen.events, server.stats))
+    reporter = task.LoopingCall(report)
+    reporter.start(10, now=False)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+A stub JIRA server, answering issue lookups with made-up titles (and a
+404 for every tenth ticket) after a delay, and a driver that has users
+mention tickets to a bot with CassandraLinkChecker's ticket enrichment on.
+Some tickets are much more popular than others, as in real life. Reports
+how many lookups reached the server, what the cache answered, and how
+many links went out with and without details.
+
+usage: python benchmarks/jira_stub.py [options]
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+from twisted.test import proto_helpers
+from twisted.web import resource, server
+from cassbot import CassBotService
+
+
+class StubJIRA(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, delay, slow_delay, slow_fraction, rand):
+        resource.Resource.__init__(self)
+        self.delay = delay
+        self.slow_delay = slow_delay
+        self.slow_fraction = slow_fraction
+        self.rand = rand
+        self.hits = 0
+
+    def render_GET(self, request):
+        self.hits += 1
+        ticket = int(request.postpath[-1].rsplit('-', 1)[1])
+        def respond():
+            if ticket % 10 == 0:
+                request.setResponseCode(404)
+                request.write(json.dumps({'errorMessages': ['Issue Does Not Exist']}))
+            else:
+                request.setHeader('content-type', 'application/json')
+                request.write(json.dumps({'key': 'CASSANDRA-%d' % ticket, 'fields': {
+                    'summary': u'Compaction stalls when \u00e9verything is ticket %d' % ticket,
+                    'status': {'name': 'Resolved' if ticket % 3 else 'Open'},
+                }}))
+            request.finish()
+        slow = self.rand.random() < self.slow_fraction
+        call = reactor.callLater(self.slow_delay if slow else self.delay, respond)
+        request.notifyFinish().addErrback(lambda f: call.cancel())
+        return server.NOT_DONE_YET
+
+
+def settle(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+@defer.inlineCallbacks
+def drive(opts, bot, jira, rand):
+    # zipf-ish: ticket n is mentioned about 1/n as often as the first
+    tickets = range(1001, 1001 + opts.tickets)
+    weights = [1.0 / (n + 1) for n in xrange(opts.tickets)]
+    total = sum(weights)
+    def pick():
+        r = rand.random() * total
+        for t, w in zip(tickets, weights):
+            r -= w
+            if r <= 0:
+                return t
+        return tickets[-1]
+    for n in xrange(opts.messages):
+        bot.lineReceived(':user%d!u@host PRIVMSG #cassandra :did you see #%d?'
+                         % (n % 40, pick()))
+        yield settle(opts.interval)
+    yield settle(opts.slow_delay + 0.5)
+    enriched = bare = 0
+    for line in bot.transport.value().splitlines():
+        if line.startswith('PRIVMSG #cassandra :'):
+            if ' [' in line:
+                enriched += 1
+            else:
+                bare += 1
+    lookups = bot.service.metrics.metrics['cassbot_ticket_lookups_total']
+    print ('%d mentions of %d tickets -> %d lookups reached the server'
+           % (opts.messages, opts.tickets, jira.hits))
+    print 'lookups: %s' % ', '.join('%s %d' % (labels[0], n) for (labels, n)
+                                    in sorted(lookups.series.iteritems()))
+    print 'http client: %r' % (bot.service.http.stats(),)
+    print 'links posted: %d with details, %d bare; %d repeats suppressed' % (
+        enriched, bare, bot.service.metrics.references_suppressed.total())
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-m', '--messages', type='int', default=500,
+                      help='messages mentioning a ticket [%default]')
+    parser.add_option('-t', '--tickets', type='int', default=50,
+                      help='distinct tickets mentioned [%default]')
+    parser.add_option('-i', '--interval', type='float', default=0.005,
+                      help='seconds between messages [%default]')
+    parser.add_option('--delay', type='float', default=0.05,
+                      help='seconds the stub usually takes to answer [%default]')
+    parser.add_option('--slow-delay', type='float', default=3,
+                      help='seconds the stub takes when slow [%default]')
+    parser.add_option('--slow-fraction', type='float', default=0.1,
+                      help='fraction of lookups that are slow [%default]')
+    parser.add_option('--budget', type='float', default=1.5,
+                      help='CassandraLinkChecker\'s fetch_budget [%default]')
+    parser.add_option('-w', '--window', type='float', default=0.1,
+                      help='seconds during which a link is not posted again'
+                           ' [%default]')
+    parser.add_option('-s', '--seed', type='int', default=1)
+    parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = parser.parse_args()
+    if opts.verbose:
+        log.startLogging(sys.stderr)
+
+    rand = random.Random(opts.seed)
+    jira = StubJIRA(opts.delay, opts.slow_delay, opts.slow_fraction, rand)
+    port = reactor.listenTCP(0, server.Site(jira), interface='127.0.0.1')
+    statedir = tempfile.mkdtemp(prefix='cassbot-jira-')
+    serv = CassBotService('tcp:host=127.0.0.1:port=1',
+                          statefile=os.path.join(statedir, 'cassbot.state.db'))
+    # don't let throttling get in the way
+    serv.state['flood_rate'] = serv.state['flood_burst'] = opts.messages
+    # or repeat mentions would mostly not get posted at all
+    serv.state['reference_window'] = opts.window
+    serv.configure_reference_cache()
+    serv.state['plugins']['CassandraLinkChecker'] = {
+        'enrich_tickets': True,
+        'ticket_api_template': 'http://127.0.0.1:%d/rest/api/2/issue/CASSANDRA-%%d'
+                               % port.getHost().port,
+        'fetch_budget': opts.budget,
+    }
+    serv.enable_plugin_by_name('CassandraLinkChecker')
+    bot = serv.pfactory.buildProtocol(None)
+    bot.makeConnection(proto_helpers.StringTransport())
+
+    d = drive(opts, bot, jira, rand)
+    d.addErrback(log.err)
+    d.addCallback(lambda _: serv.http.close())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    shutil.rmtree(statedir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+Replay raw IRC traffic through CassBotCore.lineReceived, with a fake
+transport and a deterministic clock, and report lines/sec, per-line
+latency percentiles and peak memory use. Traffic is either generated by
+one of the scenarios below or read from a file of raw server lines (as
+seen on the wire, one per line; ':nick!user@host PRIVMSG #chan :hi').
+
+Work that plugins hand off to the reactor's thread pool is run inline,
+to keep things deterministic, so it shows up in the latency of the line
+that caused it (BotLogger's flushes account for most of the max column).
+
+usage: python benchmarks/replay.py [options] [scenario ...]
+
+scenarios: privmsg names modes nicks mixed (default: all of them)
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import resource
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import task
+from twisted.python import failure, log
+from twisted.test import proto_helpers
+from cassbot import CassBotService
+
+# the simulated clock starts here, so log file names and such look sane
+epoch = 1300000000
+
+chatter = ('anyone seen this before?', 'compaction is stuck again',
+           'try bumping the heap', 'which version?', 'thanks!', 'lol',
+           'see #%d for the details', 'fixed in r%d', 'ok, ##%d then',
+           'that was CASSANDRA-%d', 'brb')
+commands = ('modules', 'stats', 'outqueue', 'show blacklist', 'grep compaction')
+
+
+class ImmediateThreadPool:
+    """
+    Runs 'threaded' work right away, in the calling thread, so the replay
+    stays deterministic and single-threaded.
+    """
+
+    def callInThreadWithCallback(self, onResult, f, *a, **kw):
+        try:
+            result = f(*a, **kw)
+        except Exception:
+            onResult(False, failure.Failure())
+        else:
+            onResult(True, result)
+
+    def callInThread(self, f, *a, **kw):
+        f(*a, **kw)
+
+
+class ReplayClock(task.Clock):
+    """
+    A task.Clock that can stand in for the reactor as far as the bot and
+    its plugins are concerned.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.rightNow = float(epoch)
+        self.threadpool = ImmediateThreadPool()
+
+    def getThreadPool(self):
+        return self.threadpool
+
+    def callFromThread(self, f, *a, **kw):
+        f(*a, **kw)
+
+
+class Population:
+    """
+    The simulated users and channels, from the bot's point of view.
+    """
+
+    def __init__(self, rand, nchannels, nusers):
+        self.rand = rand
+        self.channels = ['#chan%d' % n for n in xrange(nchannels)]
+        self.nicks = ['user%d' % n for n in xrange(nusers)]
+        self.renamed = 0
+
+    def mask(self, nick):
+        return '%s!~%s@host%d.example.com' % (nick, nick, hash(nick) % 997)
+
+    def some_nick(self):
+        return self.rand.choice(self.nicks)
+
+    def some_channel(self):
+        return self.rand.choice(self.channels)
+
+    def rename(self, i):
+        self.renamed += 1
+        self.nicks[i] = 'nick%d' % self.renamed
+        return self.nicks[i]
+
+
+def join_prelude(pop, botnick):
+    """
+    The lines a bot sees when signing on and joining all of pop's channels,
+    with every user in every channel.
+    """
+
+    yield ':irc.example.com 001 %s :Welcome to the simulation' % botnick
+    for chan in pop.channels:
+        yield ':%s!bot@bothost JOIN %s' % (botnick, chan)
+        for line in names_reply(pop, botnick, chan):
+            yield line
+
+def names_reply(pop, botnick, chan):
+    names = [botnick] + ['@' + n if i % 20 == 0 else
+                         '+' + n if i % 7 == 0 else n
+                         for (i, n) in enumerate(pop.nicks)]
+    for i in xrange(0, len(names), 40):
+        yield ':irc.example.com 353 %s = %s :%s' % (botnick, chan,
+                                                    ' '.join(names[i:i + 40]))
+    yield ':irc.example.com 366 %s %s :End of /NAMES list.' % (botnick, chan)
+
+def scenario_privmsg(pop, botnick, nlines):
+    rand = pop.rand
+    for n in xrange(nlines):
+        nick = pop.some_nick()
+        chan = pop.some_channel()
+        r = rand.random()
+        if r < 0.05:
+            text = '%s: %s' % (botnick, rand.choice(commands))
+        elif r < 0.1:
+            text = '\x01ACTION %s\x01' % rand.choice(chatter[:5])
+        else:
+            text = rand.choice(chatter)
+            if '%d' in text:
+                text = text % rand.randrange(1, 20000)
+        yield ':%s PRIVMSG %s :%s' % (pop.mask(nick), chan, text)
+
+def scenario_names(pop, botnick, nlines):
+    n = 0
+    while n < nlines:
+        for line in names_reply(pop, botnick, pop.some_channel()):
+            yield line
+            n += 1
+
+def scenario_modes(pop, botnick, nlines):
+    rand = pop.rand
+    for n in xrange(nlines):
+        nicks = [pop.some_nick() for i in xrange(rand.randint(1, 4))]
+        sign = rand.choice('+-')
+        yield ':%s MODE %s %s%s %s' % (pop.mask(pop.nicks[0]), pop.some_channel(),
+                                       sign, rand.choice('ov') * len(nicks),
+                                       ' '.join(nicks))
+
+def scenario_nicks(pop, botnick, nlines):
+    rand = pop.rand
+    for n in xrange(nlines):
+        i = rand.randrange(len(pop.nicks))
+        oldnick = pop.nicks[i]
+        r = rand.random()
+        if r < 0.6:
+            yield ':%s NICK :%s' % (pop.mask(oldnick), pop.rename(i))
+        elif r < 0.8:
+            chan = pop.some_channel()
+            yield ':%s PART %s :bye' % (pop.mask(oldnick), chan)
+            yield ':%s JOIN %s' % (pop.mask(oldnick), chan)
+        else:
+            yield ':%s QUIT :Ping timeout' % (pop.mask(oldnick),)
+            newnick = pop.rename(i)
+            for chan in pop.channels:
+                yield ':%s JOIN %s' % (pop.mask(newnick), chan)
+
+def scenario_mixed(pop, botnick, nlines):
+    gens = [scenario_privmsg(pop, botnick, nlines * 7 / 10),
+            scenario_modes(pop, botnick, nlines / 10),
+            scenario_nicks(pop, botnick, nlines / 10),
+            scenario_names(pop, botnick, nlines / 10)]
+    weights = [7, 1, 1, 1]
+    while gens:
+        g = pop.rand.choice(sum(([g] * w for (g, w) in zip(gens, weights)), []))
+        try:
+            yield g.next()
+        except StopIteration:
+            i = gens.index(g)
+            del gens[i], weights[i]
+
+scenarios = ('privmsg', 'names', 'modes', 'nicks', 'mixed')
+
+
+def make_bot(plugins, statedir, nickname='cassbot'):
+    clock = ReplayClock()
+    serv = CassBotService('tcp:host=irc.example.com:port=6667', nickname=nickname,
+                          reactor=clock,
+                          statefile=os.path.join(statedir, 'cassbot.state.db'))
+    for pname in plugins:
+        d = serv.enable_plugin_by_name(pname)
+        d.addErrback(log.err, 'Loading plugin %s' % pname)
+    bot = serv.pfactory.buildProtocol(None)
+    bot.makeConnection(proto_helpers.StringTransport())
+    return serv, bot, clock
+
+def replay(bot, clock, lines, interval):
+    """
+    Feed the lines to the bot, advancing the clock by interval seconds
+    after each. Return the number of seconds each line took.
+    """
+
+    latencies = []
+    now = time.time
+    for line in lines:
+        started = now()
+        bot.lineReceived(line)
+        latencies.append(now() - started)
+        clock.advance(interval)
+        bot.transport.clear()
+    return latencies
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def maxrss_mb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run_scenario(name, lines, opts):
+    statedir = tempfile.mkdtemp(prefix='cassbot-replay-')
+    try:
+        serv, bot, clock = make_bot(opts.plugins.split(), statedir)
+        pop = Population(random.Random(opts.seed), opts.channels, opts.users)
+        replay(bot, clock, join_prelude(pop, bot.nickname), opts.interval)
+        if lines is None:
+            lines = globals()['scenario_' + name](pop, bot.nickname, opts.lines)
+        before = maxrss_mb()
+        started = time.time()
+        latencies = replay(bot, clock, lines, opts.interval)
+        elapsed = time.time() - started
+        for pname in serv.pluginmap.keys():
+            serv.disable_plugin(pname)
+    finally:
+        shutil.rmtree(statedir, ignore_errors=True)
+    latencies.sort()
+    us = lambda secs: secs * 1e6
+    print ('%-8s %7d lines %9.0f lines/s   p50 %6.1fus  p90 %6.1fus  p99 %7.1fus'
+           '  max %8.1fus   peak RSS %.1fMB (+%.1fMB)'
+           % (name, len(latencies), len(latencies) / elapsed,
+              us(percentile(latencies, .5)), us(percentile(latencies, .9)),
+              us(percentile(latencies, .99)), us(latencies[-1]),
+              maxrss_mb(), maxrss_mb() - before))
+
+def main():
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('-n', '--lines', type='int', default=50000,
+                      help='lines of traffic per scenario [%default]')
+    parser.add_option('-c', '--channels', type='int', default=20,
+                      help='channels the bot is in [%default]')
+    parser.add_option('-u', '--users', type='int', default=200,
+                      help='users in every channel [%default]')
+    parser.add_option('-p', '--plugins', default='Admin BotLogger CassandraLinkChecker',
+                      help='plugins to enable, space separated [%default]')
+    parser.add_option('-i', '--interval', type='float', default=0.01,
+                      help='simulated seconds between lines [%default]')
+    parser.add_option('-f', '--file',
+                      help='replay raw lines from this file instead')
+    parser.add_option('-s', '--seed', type='int', default=1)
+    opts, args = parser.parse_args()
+    if opts.file:
+        with open(opts.file) as f:
+            lines = [line.rstrip('\r\n') for line in f]
+        run_scenario(os.path.basename(opts.file), lines, opts)
+        return
+    for name in args or scenarios:
+        if name not in scenarios:
+            parser.error('unknown scenario %r' % (name,))
+        run_scenario(name, None, opts)
+
+
+if __name__ == '__main__':
+    main()
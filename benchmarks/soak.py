@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Soak test: run a real CassBotService against the fake ircd, over TCP, with
+the load generator churning away, and check now and then that the bot's
+idea of the network still matches the server's. Anything the bot is
+still holding on to for users who are gone (in channel_memberships,
+chan_modemap or server_modemap) is reported as a leak, along with how
+the sizes of those structures and the process's memory use grow.
+
+The load generator is paused for a moment around each check, so lines
+still on their way to the bot don't look like mismatches.
+
+With --drop-every, the server drops the bot's connection now and then,
+and the check after each drop waits for the bot to get back in sync
+first, so channel state carried over a reconnect gets checked too.
+
+usage: python benchmarks/soak.py [options]
+"""
+
+import os
+import sys
+import shutil
+import resource
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+from cassbot import CassBotService
+from fake_ircd import add_server_options, make_server
+
+
+def check_bot(bot, server):
+    """
+    Compare the bot's channel state against the server's. Return a dict of
+    problem counts and structure sizes.
+    """
+
+    memb = bot.channel_memberships
+    result = {'missing': 0, 'extra': 0, 'stale_chanmodes': 0, 'stale_usermodes': 0,
+              'stale_index': 0, 'members': sum(len(m) for m in memb.itervalues()),
+              'chanmodes': sum(len(m) for m in bot.chan_modemap.itervalues()),
+              'usermodes': len(bot.server_modemap)}
+    for channame in bot.channels:
+        chan = server.channels.get(channame)
+        truth = set(chan.members) if chan is not None else set()
+        known = memb.get(channame, set())
+        result['missing'] += len(truth - known)
+        result['extra'] += len(known - truth)
+    for channame, modemap in bot.chan_modemap.iteritems():
+        chan = server.channels.get(channame)
+        truth = chan.members if chan is not None else {}
+        result['stale_chanmodes'] += sum(1 for nick in modemap
+                                         if nick is not None and nick not in truth)
+    for nick in bot.server_modemap:
+        if nick not in server.users:
+            result['stale_usermodes'] += 1
+    for nick, chans in memb.by_nick.iteritems():
+        result['stale_index'] += sum(1 for c in chans if nick not in memb.get(c, ()))
+    return result
+
+def maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def settle(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+@defer.inlineCallbacks
+def wait_for_sync(opts, serv):
+    """
+    Wait for the bot to get into its channels. Return the bot and how
+    many seconds that took, or None if it never does.
+    """
+
+    elapsed = 0
+    while True:
+        yield settle(1)
+        bot = getattr(serv.networks[serv.default_network], 'prot', None)
+        if bot is not None and len(bot.channels) >= opts.bot_channels \
+                and all(bot.is_channel_synced.get(c) for c in bot.channels):
+            defer.returnValue((bot, elapsed))
+        elapsed += 1
+        if elapsed > opts.duration:
+            defer.returnValue((None, elapsed))
+
+@defer.inlineCallbacks
+def soak(opts, serv, server, gen):
+    problems = 0
+    bot, elapsed = yield wait_for_sync(opts, serv)
+    if bot is None:
+        log.msg('Bot never got synced to its channels')
+        defer.returnValue(1)
+    log.msg('Bot synced to %d channels after %ds' % (len(bot.channels), elapsed))
+    gen.start()
+    first = None
+    elapsed = 0
+    print '%6s %8s %8s %8s %8s %8s %8s %8s %8s %8s' % (
+        'secs', 'events', 'members', 'chmodes', 'umodes', 'missing', 'extra',
+        'stale', 'rss(MB)', 'lines')
+    while elapsed < opts.duration:
+        yield settle(opts.check_every)
+        elapsed += opts.check_every
+        if opts.drop_every and elapsed % opts.drop_every < opts.check_every:
+            server.users[bot.nickname].transport.loseConnection()
+            yield settle(opts.settle)
+            bot, downtime = yield wait_for_sync(opts, serv)
+            if bot is None:
+                log.msg('Bot never got back in sync after being dropped')
+                defer.returnValue(1)
+            log.msg('Bot back in sync %ds after being dropped' % downtime)
+        gen.stop()
+        yield settle(opts.settle)
+        bot = serv.getbot()
+        r = check_bot(bot, server)
+        gen.start()
+        stale = r['stale_chanmodes'] + r['stale_usermodes'] + r['stale_index']
+        bad = r['missing'] + r['extra'] + stale
+        problems += bad
+        print '%6d %8d %8d %8d %8d %8d %8d %8d %8.1f %8d' % (
+            elapsed, gen.events, r['members'], r['chanmodes'], r['usermodes'],
+            r['missing'], r['extra'], stale, maxrss_mb(), server.stats['lines_out'])
+        if first is None:
+            first = (r, maxrss_mb())
+    gen.stop()
+    r0, rss0 = first
+    print ('tracked members %d -> %d, channel mode entries %d -> %d, RSS %.1fMB ->'
+           ' %.1fMB; %d problems seen' % (r0['members'], r['members'], r0['chanmodes'],
+                                         r['chanmodes'], rss0, maxrss_mb(), problems))
+    defer.returnValue(1 if problems else 0)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    add_server_options(parser)
+    parser.add_option('-d', '--duration', type='int', default=300,
+                      help='seconds to run for [%default]')
+    parser.add_option('-b', '--bot-channels', type='int', default=50,
+                      help='channels for the bot to join [%default]')
+    parser.add_option('--check-every', type='int', default=10,
+                      help='seconds between checks [%default]')
+    parser.add_option('--settle', type='float', default=0.5,
+                      help='seconds to pause the load before each check [%default]')
+    parser.add_option('--drop-every', type='int', default=0,
+                      help='seconds between dropping the bot\'s connection'
+                           ' (0 for never) [%default]')
+    parser.add_option('-p', '--plugins', default='Admin BotLogger',
+                      help='plugins to enable, space separated [%default]')
+    parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = parser.parse_args()
+    if opts.verbose:
+        log.startLogging(sys.stderr)
+
+    server, gen = make_server(opts)
+    port = reactor.listenTCP(0, server, interface='127.0.0.1')
+    statedir = tempfile.mkdtemp(prefix='cassbot-soak-')
+    serv = CassBotService('tcp:host=127.0.0.1:port=%d' % port.getHost().port,
+                          nickname='soakbot',
+                          init_channels=gen.channames[:opts.bot_channels],
+                          statefile=os.path.join(statedir, 'cassbot.state.db'))
+    for pname in opts.plugins.split():
+        serv.enable_plugin_by_name(pname)
+    serv.startService()
+
+    exitcode = []
+    def finished(code):
+        exitcode.append(code)
+        serv.stopService()
+        reactor.stop()
+    d = soak(opts, serv, server, gen)
+    d.addErrback(lambda f: (log.err(f), 1)[1])
+    d.addCallback(finished)
+    reactor.run()
+    shutil.rmtree(statedir, ignore_errors=True)
+    sys.exit(exitcode[0] if exitcode else 1)
+
+
+if __name__ == '__main__':
+    main()
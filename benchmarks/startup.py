@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Measure how long the bot takes to start: from launching twistd on tap.py
+until the bot has signed on to a fake ircd and sent its first JOIN. Each
+case is run several times, and the median and best times are reported,
+along with how many plugins the bot loaded (from its log).
+
+cases:
+  manifest    plugin manifest up to date, autoload_modules=Admin
+  cold        no plugin manifest (so every plugin module is imported to
+              build it), autoload_modules=Admin
+  all         plugin manifest up to date, every plugin autoloaded
+
+usage: python benchmarks/startup.py [options] [case ...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+from optparse import OptionParser
+
+topdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, topdir)
+
+from twisted.internet import reactor, defer, protocol
+from twisted.python import log
+from fake_ircd import FakeIRCServer, IRCServerConnection
+from cassbot import PluginManifest
+
+cases = ('manifest', 'cold', 'all')
+
+
+class TimedConnection(IRCServerConnection):
+    def irc_JOIN(self, params):
+        IRCServerConnection.irc_JOIN(self, params)
+        d, self.factory.joined = self.factory.joined, None
+        if d is not None:
+            d.callback(time.time())
+
+
+class TimedServer(FakeIRCServer):
+    joined = None
+
+    def buildProtocol(self, addr):
+        p = TimedConnection()
+        p.factory = self
+        return p
+
+
+class Twistd(protocol.ProcessProtocol):
+    def __init__(self):
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+
+@defer.inlineCallbacks
+def start_once(server, port, statedir, modules):
+    server.joined = defer.Deferred()
+    env = dict(os.environ,
+               nickname='startbot', channels='#startup',
+               server='tcp:host=127.0.0.1:port=%d' % port,
+               statefile=os.path.join(statedir, 'cassbot.state.db'),
+               autoload_modules=' '.join(modules), auto_admin='nobody!*@*',
+               PYTHONPATH=topdir)
+    logfile = os.path.join(statedir, 'twistd.log')
+    proc = Twistd()
+    started = time.time()
+    reactor.spawnProcess(proc, sys.executable,
+                         [sys.executable, '-c', 'from twisted.scripts.twistd import run; run()',
+                          '-n', '--logfile', logfile, '--pidfile', '',
+                          '-y', os.path.join(topdir, 'tap.py')],
+                         env=env, path=statedir)
+    joined = yield server.joined
+    proc.transport.signalProcess(signal.SIGTERM)
+    yield proc.ended
+    with open(logfile) as f:
+        loaded = sum(1 for line in f if 'Instantiating plugin' in line)
+    os.unlink(logfile)
+    os.unlink(env['statefile'])
+    defer.returnValue((joined - started, loaded))
+
+@defer.inlineCallbacks
+def run_cases(opts, names, server, port):
+    statedir = tempfile.mkdtemp(prefix='cassbot-startup-')
+    # where the bot keeps it, next to its state file
+    manifest = PluginManifest(os.path.join(statedir, PluginManifest.filename))
+    manifest.update()
+    everything = sorted(manifest.plugins)
+    try:
+        for name in names:
+            times = []
+            for n in xrange(opts.runs):
+                if name == 'cold':
+                    try:
+                        os.unlink(manifest.path())
+                    except OSError:
+                        pass
+                modules = everything if name == 'all' else ['Admin']
+                secs, loaded = yield start_once(server, port, statedir, modules)
+                times.append(secs)
+            times.sort()
+            print '%-9s median %6.0fms  best %6.0fms  (%d plugins loaded, %d runs)' % (
+                name, times[len(times) // 2] * 1000, times[0] * 1000, loaded, opts.runs)
+    finally:
+        shutil.rmtree(statedir, ignore_errors=True)
+
+def main():
+    parser = OptionParser(usage='%prog [options] [case ...]')
+    parser.add_option('-n', '--runs', type='int', default=5,
+                      help='times to start the bot for each case [%default]')
+    parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = parser.parse_args()
+    for name in args:
+        if name not in cases:
+            parser.error('unknown case %r' % (name,))
+    if opts.verbose:
+        log.startLogging(sys.stderr)
+
+    server = TimedServer()
+    port = reactor.listenTCP(0, server, interface='127.0.0.1').getHost().port
+    d = run_cases(opts, args or cases, server, port)
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,24 +2,45 @@
 
 from __future__ import with_statement
 
+import os
+import re
+import sys
 import time
+import json
 import shlex
+import random
+import signal
+import sqlite3
+import Queue
+import threading
+import traceback
+import multiprocessing
+from collections import deque, OrderedDict
 from functools import wraps
 from itertools import imap, izip
-from fnmatch import fnmatch
+from fnmatch import fnmatch, translate
 from twisted.words.protocols import irc
-from twisted.internet import defer, protocol, endpoints
-from twisted.python import log
-from twisted.plugin import getPlugins, IPlugin
+from twisted.internet import defer, protocol, endpoints, task, threads
+from twisted.python import log, filepath, failure, threadable, threadpool
+from twisted.python.reflect import namedModule
+from twisted.plugin import IPlugin
 from twisted.application import internet, service
 from zope.interface import Interface, implements, directlyProvides
 import cassbot_plugins
+from cassbot_metrics import BotMetrics, channel_label, metrics_http_service
+from cassbot_state import open_state_store, set_aside, PluginStateMap
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+try:
+    from twisted.internet import inotify
+except ImportError:
+    # not on Linux; fall back to polling for plugin changes
+    inotify = None
+
 
 class enabled_but_not_found:
     def __init__(self):
@@ -77,6 +98,13 @@ class IBotPluginInstance(Interface):
         and args is a list of the words which followed the command.
         """
 
+    def commandAliases():
+        """
+        Return a dict mapping alternate names to the names of commands this
+        plugin implements. Commands can also always be abbreviated to any
+        unambiguous prefix at least CommandRouter.min_abbrev letters long.
+        """
+
     def saveState():
         """
         Return some pickleable object which contains all the configuration
@@ -101,6 +129,37 @@ class IBotPluginInstance(Interface):
         state info be available.
         """
 
+    def shutdown():
+        """
+        Called when this instance is being taken out of service: the plugin
+        is being disabled, the bot is stopping, or a reload has put a new
+        instance in its place (which has already been given this one's
+        state). Close files and stop timers here, not in saveState(),
+        which may be called at other times too.
+        """
+
+    def referencePatterns():
+        """
+        Return a list of (key, pattern) pairs, where pattern is a regular
+        expression (as a string) matching some kind of reference this
+        plugin wants to know about in channel and private messages, like
+        ticket numbers. The patterns of all enabled plugins are combined and
+        every message is scanned just once.
+
+        Messages with no digits in them are not scanned at all, unless a
+        pattern is given as a (key, pattern, False) triple instead.
+        Patterns should not use backreferences or named groups.
+        """
+
+    def referencesFound(bot, user, channel, refs):
+        """
+        Called when a privmsg or action contains matches for any of the
+        patterns returned by referencePatterns(). refs is a list of
+        (key, match) pairs in the order they occurred in the message; match
+        supports group(), start() and end() like a regex match object, with
+        group numbers relative to the plugin's own pattern.
+        """
+
 class BaseBotPlugin_meta(type):
     def __new__(cls, name, bases, attrs):
         newcls = super(BaseBotPlugin_meta, cls).__new__(cls, name, bases, attrs)
@@ -157,12 +216,35 @@ class BaseBotPlugin(object):
             if name.startswith('command_') and callable(value):
                 yield name[8:]
 
+    # alternate names for commands; see commandAliases
+    command_aliases = {}
+
+    # seconds before a command is given up on, by command name. commands
+    # not listed get the service's default, and the service state can
+    # override either.
+    command_timeouts = {}
+
+    # how many invocations of this plugin's commands may be running at
+    # once; None for the service's default. a command that times out stops
+    # counting, though a @blocking one goes on running in its thread (see
+    # blocking)
+    max_in_flight = None
+
+    def commandAliases(self):
+        return self.command_aliases
+
     def saveState(self):
         return None
 
     def loadState(self, s):
         pass
 
+    def shutdown(self):
+        pass
+
+    def referencePatterns(self):
+        return ()
+
 
 def noop(*a, **kw):
     pass
@@ -174,6 +256,975 @@ def removekey(dicty, key):
         pass
 
 
+digit_re = re.compile(r'\d')
+
+
+class ReferenceScanner:
+    """
+    Finds the references (to tickets, commits, ...) in each message for all
+    plugins with referencePatterns(), and hands them to the plugins that
+    own them.
+
+    All the patterns are combined into one regex, so a message with no
+    references in it, which is most of them, is scanned once no matter how
+    many trackers are enabled. When that finds something, each pattern is
+    then run on its own from there, so the results are the same as
+    scanning for each pattern separately: in a single alternation, the
+    first pattern to match at a position would hide the others, and
+    whatever it consumed (like the separator ticket_re starts with) could
+    not be part of another pattern's match.
+
+    This sits at the end of the service's dispatch_map for privmsg and
+    action, so it acts like a plugin which runs after all the others.
+    """
+
+    hooks = ('privmsg', 'action')
+
+    def __init__(self):
+        self.patterns = []
+        self.combined = None
+
+    def name(self):
+        return self.__class__.__name__
+
+    def register(self, owner, key, pattern, needs_digit=True):
+        self.patterns.append((owner, key, pattern, needs_digit))
+        self.combined = None
+
+    def unregister(self, owner):
+        """
+        Drop all of owner's patterns. Return True if there were any.
+        """
+
+        before = len(self.patterns)
+        self.patterns = [p for p in self.patterns if p[0] is not owner]
+        self.combined = None
+        return len(self.patterns) != before
+
+    def compile(self):
+        self.compiled = [(owner, key, re.compile(pattern))
+                         for (owner, key, pattern, needs_digit) in self.patterns]
+        self.needs_digit = all(p[3] for p in self.patterns)
+        self.combined = re.compile('|'.join('(?:%s)' % p[2] for p in self.patterns))
+
+    def scan(self, msg):
+        """
+        Return a list of (owner, [(key, match), ...]) pairs for all the
+        references found in msg, each owner's in the order they appear.
+        """
+
+        if not self.patterns:
+            return []
+        if self.combined is None:
+            self.compile()
+        if self.needs_digit and digit_re.search(msg) is None:
+            return []
+        first = self.combined.search(msg)
+        if first is None:
+            return []
+        # no pattern can match before the combined one first does
+        pos = first.start()
+        found = {}
+        owners = []
+        for owner, key, regex in self.compiled:
+            refs = found.get(owner)
+            for m in regex.finditer(msg, pos):
+                if refs is None:
+                    refs = found[owner] = []
+                    owners.append(owner)
+                refs.append((key, m))
+        result = []
+        for o in owners:
+            refs = found[o]
+            refs.sort(key=lambda (key, m): m.start())
+            result.append((o, refs))
+        return result
+
+    def privmsg(self, bot, user, channel, msg):
+        for owner, refs in self.scan(msg):
+            d = defer.maybeDeferred(owner.referencesFound, bot, user, channel, refs)
+            d.addErrback(log.err, 'Exception in plugin %s for referencesFound'
+                                  % (owner.name(),))
+
+    action = privmsg
+
+
+class MembershipMap(dict):
+    """
+    Maps channel names to the set of nicks in each channel, like a plain
+    dict, and also keeps a reverse index of which channels each nick is
+    in, so that renames and quits only need to touch those channels.
+
+    Use the methods here to make changes, so the two sides stay in step.
+    The per-channel sets should be treated as read-only.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.by_nick = {}
+
+    def reset_channel(self, channel):
+        self.remove_channel(channel)
+        self[channel] = set()
+
+    def remove_channel(self, channel):
+        for nick in self.pop(channel, ()):
+            self.unindex(nick, channel)
+
+    def add(self, channel, nick):
+        self.setdefault(channel, set()).add(nick)
+        self.by_nick.setdefault(nick, set()).add(channel)
+
+    def discard(self, channel, nick):
+        members = self.get(channel)
+        if members is not None:
+            members.discard(nick)
+        self.unindex(nick, channel)
+
+    def unindex(self, nick, channel):
+        chans = self.by_nick.get(nick)
+        if chans is not None:
+            chans.discard(channel)
+            if not chans:
+                del self.by_nick[nick]
+
+    def remove_nick(self, nick):
+        """
+        Remove nick from every channel it was in, and return those channels.
+        """
+
+        chans = self.by_nick.pop(nick, ())
+        for channel in chans:
+            self[channel].discard(nick)
+        return chans
+
+    def rename(self, oldnick, newnick):
+        """
+        Replace oldnick with newnick in every channel it was in, and return
+        those channels.
+        """
+
+        chans = self.by_nick.pop(oldnick, ())
+        for channel in chans:
+            members = self[channel]
+            members.discard(oldnick)
+            members.add(newnick)
+        if chans:
+            self.by_nick.setdefault(newnick, set()).update(chans)
+        return chans
+
+    def replace_channel(self, channel, nicks):
+        """
+        Make the given nicks the members of channel, all at once. Return the
+        set of nicks which were removed.
+        """
+
+        old = self.get(channel, set())
+        new = set(nicks)
+        gone = old - new
+        for nick in gone:
+            self.unindex(nick, channel)
+        by_nick = self.by_nick
+        for nick in new - old:
+            by_nick.setdefault(nick, set()).add(channel)
+        self[channel] = new
+        return gone
+
+    def channels_of(self, nick):
+        return self.by_nick.get(nick, frozenset())
+
+
+class CommandParseError(ValueError):
+    pass
+
+quoting_re = re.compile(r'[\'"\\]')
+
+def split_command(cmdstr):
+    """
+    Split a command string into words. The result is the same as
+    shlex.split, but strings without quotes or backslashes (nearly all of
+    them) are just split on whitespace, which is much faster.
+
+    Raises CommandParseError if the quoting is unbalanced.
+    """
+
+    if quoting_re.search(cmdstr) is None:
+        return cmdstr.split()
+    try:
+        return shlex.split(cmdstr)
+    except ValueError, e:
+        raise CommandParseError(str(e))
+
+
+class CommandRouter:
+    """
+    Maps the command names users type to the plugin methods implementing
+    them, via a table precomputed from the service's command_map. Besides
+    the real command names, the table holds plugins' aliases and every
+    unambiguous prefix of at least min_abbrev letters.
+    """
+
+    min_abbrev = 3
+
+    def __init__(self, service):
+        self.service = service
+        self.table = None
+
+    def invalidate(self):
+        self.table = None
+
+    def build(self):
+        # each route is (command name, ((plugin, bound method), ...)), or for
+        # an ambiguous abbreviation, (None, (candidate names, ...))
+        routes = {}
+        for cmd, plugins in self.service.command_map.iteritems():
+            handlers = []
+            for p in plugins:
+                pluginmethod = getattr(p, 'command_' + cmd, None)
+                if pluginmethod is not None:
+                    handlers.append((p, pluginmethod))
+            routes[cmd] = (cmd, tuple(handlers))
+        table = dict(routes)
+
+        seen = set()
+        for plugins in self.service.command_map.itervalues():
+            for p in plugins:
+                if p in seen:
+                    continue
+                seen.add(p)
+                try:
+                    aliases = p.commandAliases()
+                except Exception:
+                    log.err(None, 'Exception in plugin %s for commandAliases request'
+                                  % (p.name(),))
+                    continue
+                for alias, cmd in aliases.iteritems():
+                    alias = alias.lower().replace('-', '_')
+                    if cmd in routes and alias not in table:
+                        table[alias] = routes[cmd]
+
+        prefixes = {}
+        for name, (cmd, handlers) in table.iteritems():
+            for n in xrange(self.min_abbrev, len(name)):
+                prefixes.setdefault(name[:n], set()).add(cmd)
+        for prefix, cmds in prefixes.iteritems():
+            if prefix in table:
+                continue
+            if len(cmds) == 1:
+                table[prefix] = routes[cmds.pop()]
+            else:
+                table[prefix] = (None, tuple(sorted(cmds)))
+        self.table = table
+
+    def route(self, name):
+        if self.table is None:
+            self.build()
+        return self.table.get(name.lower().replace('-', '_'))
+
+
+class TokenBucket:
+    """
+    Holds up to 'burst' tokens, refilled continuously at 'rate' tokens per
+    second as measured by the given clock (anything with a seconds() method,
+    like a reactor).
+    """
+
+    def __init__(self, rate, burst, clock):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.stamp = clock.seconds()
+
+    def refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, n=1):
+        self.refill()
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def delay(self, n=1):
+        """
+        Return the number of seconds until n tokens will be available.
+        """
+        self.refill()
+        if self.tokens >= n:
+            return 0
+        return (n - self.tokens) / self.rate
+
+
+class OutboundQueue:
+    """
+    Paces outgoing messages through a token bucket so that we don't get
+    throttled or killed for flooding. Lines are queued in lanes, and a
+    lane is only serviced when all the lanes before it are empty. Within a
+    lane, targets are serviced round-robin a line at a time, so a long
+    reply to one channel doesn't hold up everybody else.
+    """
+
+    lanes = ('reply', 'link')
+    default_rate = 1.0
+    default_burst = 5
+
+    def __init__(self, send, clock, rate=None, burst=None):
+        self.send = send
+        self.clock = clock
+        self.bucket = TokenBucket(rate or self.default_rate,
+                                  burst or self.default_burst, clock)
+        # lane -> {target: deque of (line, time queued, deferred or None)}
+        self.pending = dict((lane, {}) for lane in self.lanes)
+        # lane -> deque of targets with pending lines, in service order
+        self.rotation = dict((lane, deque()) for lane in self.lanes)
+        self.depth = 0
+        self.delayed_call = None
+        self.sent = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # called with (lane, target, seconds waited) for each line sent
+        self.on_sent = None
+
+    def enqueue(self, target, lines, lane='reply'):
+        """
+        Queue up the given lines to be sent to target. Return a Deferred
+        which fires once the last of them has been sent.
+        """
+
+        if lane not in self.pending:
+            raise ValueError('unknown outbound lane %r' % (lane,))
+        lines = list(lines)
+        d = defer.Deferred()
+        if not lines:
+            d.callback(None)
+            return d
+        q = self.pending[lane].get(target)
+        if q is None:
+            q = self.pending[lane][target] = deque()
+            self.rotation[lane].append(target)
+        now = self.clock.seconds()
+        for line in lines[:-1]:
+            q.append((line, now, None))
+        q.append((lines[-1], now, d))
+        self.depth += len(lines)
+        self.pump()
+        return d
+
+    def pump(self):
+        if self.delayed_call is not None:
+            return
+        while self.depth > 0:
+            wait = self.bucket.delay()
+            if wait > 0:
+                self.delayed_call = self.clock.callLater(wait, self.wakeup)
+                return
+            self.bucket.consume()
+            self.send_next()
+
+    def wakeup(self):
+        self.delayed_call = None
+        self.pump()
+
+    def send_next(self):
+        for lane in self.lanes:
+            rotation = self.rotation[lane]
+            if rotation:
+                break
+        target = rotation.popleft()
+        q = self.pending[lane][target]
+        line, queued_at, d = q.popleft()
+        if q:
+            rotation.append(target)
+        else:
+            del self.pending[lane][target]
+        self.depth -= 1
+
+        waited = self.clock.seconds() - queued_at
+        self.sent += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        try:
+            self.send(target, line)
+        except Exception:
+            log.err(None, 'Sending queued message to %s' % (target,))
+        if self.on_sent is not None:
+            self.on_sent(lane, target, waited)
+        if d is not None:
+            d.callback(None)
+
+    def clear(self):
+        """
+        Drop everything still queued. Deferreds waiting on dropped lines are
+        fired anyway, so nobody waits forever on a dead connection.
+        """
+
+        if self.delayed_call is not None:
+            self.delayed_call.cancel()
+            self.delayed_call = None
+        if self.depth:
+            log.msg('Dropping %d queued outbound lines' % (self.depth,))
+        waiting = []
+        for lane in self.lanes:
+            for q in self.pending[lane].itervalues():
+                waiting.extend(d for (line, queued_at, d) in q if d is not None)
+            self.pending[lane].clear()
+            self.rotation[lane].clear()
+        self.depth = 0
+        for d in waiting:
+            d.callback(None)
+
+    def lane_depths(self):
+        return dict((lane, sum(imap(len, self.pending[lane].itervalues())))
+                    for lane in self.lanes)
+
+    def oldest_wait(self):
+        now = self.clock.seconds()
+        oldest = now
+        for lane in self.lanes:
+            for q in self.pending[lane].itervalues():
+                oldest = min(oldest, q[0][1])
+        return now - oldest
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'lanes': self.lane_depths(),
+            'sent': self.sent,
+            'avg_wait': self.total_wait / self.sent if self.sent else 0.0,
+            'max_wait': self.max_wait,
+            'oldest_wait': self.oldest_wait(),
+        }
+
+
+class JoinScheduler:
+    """
+    Gets a bot into its channels after signing on without flooding the
+    server. Channels are batched into comma-separated JOIN lines, and the
+    priority channels go first. No more than rate lines per second are sent
+    (after an initial burst). MODE queries for channels as they're joined go
+    through the same queue, alternating with the remaining JOINs, so they
+    don't all wait for the JOINs to finish.
+
+    Also keeps track of how long it takes for each channel, and all of them,
+    to be synced.
+    """
+
+    default_rate = 1.0
+    default_burst = 3
+    default_batch = 10
+    # JOIN lines are kept well under the 512 byte limit
+    max_line = 400
+
+    def __init__(self, bot, channels, clock, rate=None, burst=None, batch=None,
+                 priority=()):
+        self.bot = bot
+        self.clock = clock
+        self.bucket = TokenBucket(rate or self.default_rate,
+                                  burst or self.default_burst, clock)
+        channels = [c if c[:1] in irc.CHANNEL_PREFIXES else '#' + c for c in channels]
+        priority = set(c.lower() for c in priority)
+        order = [c for c in channels if c.lower() in priority] \
+              + [c for c in channels if c.lower() not in priority]
+        self.joins = deque(self.batches(order, batch or self.default_batch))
+        self.queries = deque()
+        self.last_was_join = False
+        self.waiting = set(c.lower() for c in order)
+        self.total = len(self.waiting)
+        self.failed = set()
+        self.started = clock.seconds()
+        self.all_synced = None
+        self.delayed_call = None
+
+    def batches(self, channels, batch):
+        line = []
+        size = len('JOIN ')
+        for chan in channels:
+            if line and (len(line) >= batch or size + len(chan) + 1 > self.max_line):
+                yield line
+                line = []
+                size = len('JOIN ')
+            line.append(chan)
+            size += len(chan) + 1
+        if line:
+            yield line
+
+    def start(self):
+        if not self.waiting:
+            self.finished()
+        self.pump()
+
+    def stop(self):
+        if self.delayed_call is not None:
+            self.delayed_call.cancel()
+            self.delayed_call = None
+        self.joins.clear()
+        self.queries.clear()
+
+    def query_mode(self, channel):
+        self.queries.append('MODE %s' % (channel,))
+        self.pump()
+
+    def pump(self):
+        if self.delayed_call is not None:
+            return
+        while self.joins or self.queries:
+            wait = self.bucket.delay()
+            if wait > 0:
+                self.delayed_call = self.clock.callLater(wait, self.wakeup)
+                return
+            self.bucket.consume()
+            self.bot.sendLine(self.next_line())
+
+    def wakeup(self):
+        self.delayed_call = None
+        self.pump()
+
+    def next_line(self):
+        if self.joins and not (self.queries and self.last_was_join):
+            self.last_was_join = True
+            return 'JOIN ' + ','.join(self.joins.popleft())
+        self.last_was_join = False
+        return self.queries.popleft()
+
+    def synced(self, channel):
+        channel = channel.lower()
+        if channel not in self.waiting:
+            return
+        self.waiting.discard(channel)
+        metrics = self.bot.service.metrics
+        metrics.channel_sync_seconds.observe((self.bot.network,), self.elapsed())
+        if not self.waiting:
+            self.finished()
+
+    def join_failed(self, channel):
+        if channel.lower() in self.waiting:
+            self.failed.add(channel)
+            self.synced(channel)
+
+    def finished(self):
+        self.bot.drop_stale()
+        self.all_synced = self.elapsed()
+        self.bot.service.metrics.all_synced_seconds.observe((self.bot.network,),
+                                                            self.all_synced)
+        log.msg('All %d channels on %s synced in %.1fs (%d could not be joined)'
+                % (self.total, self.bot.network, self.all_synced, len(self.failed)))
+
+    def elapsed(self):
+        return self.clock.seconds() - self.started
+
+    def status(self):
+        if self.all_synced is None:
+            return 'synced %d/%d channels so far' % (self.total - len(self.waiting),
+                                                     self.total)
+        status = 'synced %d channels in %.1fs' % (self.total, self.all_synced)
+        if self.failed:
+            status += ' (could not join %s)' % ', '.join(sorted(self.failed))
+        return status
+
+
+class UserThrottle:
+    """
+    A token bucket per user, for deciding whether to accept another command
+    from them. Once there are max_users buckets, the full ones (belonging to
+    users who have gone quiet) are thrown away, so this stays small no
+    matter how many different names come and go. Buckets of users who are
+    still being throttled are kept, even if that means going over
+    max_users for a while.
+    """
+
+    max_users = 1024
+
+    def __init__(self, rate, burst, clock):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets = {}
+        # prune when there are this many buckets. raised when pruning
+        # doesn't find much to throw away, so a crowd of busy users doesn't
+        # mean a prune on every new one
+        self.prune_at = self.max_users
+        # users who have been told they're being throttled, so we don't
+        # answer every single command with another complaint
+        self.warned = set()
+        self.refused = 0
+
+    def admit(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.prune_at:
+                self.prune()
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, self.clock)
+        if bucket.consume():
+            self.warned.discard(key)
+            return True
+        self.refused += 1
+        return False
+
+    def prune(self):
+        for key, bucket in self.buckets.items():
+            bucket.refill()
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+                self.warned.discard(key)
+        self.prune_at = max(self.max_users, 2 * len(self.buckets))
+
+
+class ExpiringLRU:
+    """
+    A mapping of at most maxsize entries, each of which expires ttl seconds
+    (as measured by clock) after it was set, unless set() is given another
+    ttl for it. When full, the least recently used entry is thrown out to
+    make room.
+    """
+
+    def __init__(self, maxsize, ttl, clock):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (expiry time, value), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires <= self.clock.seconds():
+            self.misses += 1
+            return default
+        self.entries[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.entries.pop(key, None)
+        while len(self.entries) >= self.maxsize:
+            self.entries.popitem(last=False)
+        self.entries[key] = (self.clock.seconds() + ttl, value)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        # unlike get(), doesn't count as a use of the entry
+        try:
+            expires, value = self.entries[key]
+        except KeyError:
+            return False
+        return expires > self.clock.seconds()
+
+
+class WorkerError(Exception):
+    """
+    A function run in a worker process raised an exception. The message is
+    the traceback from the worker.
+    """
+
+
+class PoolStats:
+    """
+    Counts the jobs going through a worker pool, so it can be seen when the
+    pool is saturated. Only touched from the reactor thread.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.done = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submitted(self):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return time.time()
+
+    def finished(self, queued_at, started_at, ok=True):
+        self.in_flight -= 1
+        if ok:
+            self.done += 1
+        else:
+            self.failed += 1
+        if started_at is not None:
+            waited = max(0.0, started_at - queued_at)
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def stats(self):
+        finished = self.done + self.failed
+        return {
+            'size': self.size,
+            'busy': min(self.in_flight, self.size),
+            'queued': max(0, self.in_flight - self.size),
+            'peak_in_flight': self.peak_in_flight,
+            'done': self.done,
+            'failed': self.failed,
+            'avg_wait': self.total_wait / finished if finished else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+def timed_call(f, a, kw):
+    # runs in a worker thread
+    started_at = time.time()
+    try:
+        return started_at, True, f(*a, **kw)
+    except Exception:
+        return started_at, False, failure.Failure()
+
+
+class ThreadWorkers:
+    """
+    A bounded thread pool for plugin code that blocks. Jobs beyond the pool
+    size wait in line; results are handed back to the reactor thread.
+    """
+
+    default_size = 4
+
+    def __init__(self, reactor, size=None):
+        self.reactor = reactor
+        self.counts = PoolStats(size or self.default_size)
+        self.pool = self.make_pool()
+
+    def make_pool(self):
+        return threadpool.ThreadPool(0, self.counts.size, name='cassbot-workers')
+
+    def start(self):
+        if not self.pool.started:
+            self.pool.start()
+
+    def stop(self):
+        """
+        Stop the threads once running jobs finish, and return a Deferred
+        firing when they have. The waiting happens in a thread of its own,
+        since jobs may need the reactor (through a ReactorProxy) to finish.
+        A stopped ThreadPool can't be restarted, so a fresh one is set up in
+        case there is more work later.
+        """
+
+        if not self.pool.started:
+            return defer.succeed(None)
+        pool, self.pool = self.pool, self.make_pool()
+        d = defer.Deferred()
+        def stop_pool():
+            pool.stop()
+            self.reactor.callFromThread(d.callback, None)
+        threading.Thread(target=stop_pool, name='cassbot-workers-stop').start()
+        return d
+
+    def resize(self, size):
+        self.counts.size = size or self.default_size
+        self.pool.adjustPoolsize(0, self.counts.size)
+
+    def run(self, f, *a, **kw):
+        """
+        Call f(*a, **kw) in a worker thread, and return a Deferred for the
+        result.
+        """
+
+        self.start()
+        queued_at = self.counts.submitted()
+        d = threads.deferToThreadPool(self.reactor, self.pool, timed_call, f, a, kw)
+        def finished(outcome):
+            started_at, ok, result = outcome
+            self.counts.finished(queued_at, started_at, ok)
+            return result
+        def lost(err):
+            self.counts.finished(queued_at, None, False)
+            return err
+        d.addCallbacks(finished, lost)
+        return d
+
+    def stats(self):
+        return self.counts.stats()
+
+
+def reset_worker_signals():
+    # runs in each new worker process, which is forked with the reactor's
+    # signal handlers in place. those would have SIGTERM (as sent by
+    # ProcessWorkers.stop) ask a reactor that isn't running to stop, so
+    # the worker would carry on and the pool would wait for it forever
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+
+def run_in_worker_process(modname, funcname, a, kw):
+    # runs in the worker process. the cpu_bound wrapper is what lives at
+    # module level, so look the real function up through it. the result
+    # is pickled here so that an unpickleable one is an ordinary failure
+    # instead of a hung pool.
+    started_at = time.time()
+    try:
+        __import__(modname)
+        f = getattr(sys.modules[modname], funcname).func
+        return started_at, True, pickle.dumps(f(*a, **kw), -1)
+    except Exception:
+        return started_at, False, traceback.format_exc()
+
+
+class ProcessWorkers:
+    """
+    A pool of worker processes for CPU-heavy functions (see cpu_bound).
+    The processes are only started when first needed, and there is one
+    such pool per Python process; see process_workers.
+    """
+
+    # seconds to wait for a job's result. a worker process that dies
+    # (rather than raising) never reports back, so don't wait forever
+    job_timeout = 600
+
+    def __init__(self, size=None):
+        self.pool = None
+        self.reactor = None
+        self.pending = set()
+        self.counts = PoolStats(size or multiprocessing.cpu_count())
+
+    def resize(self, size):
+        size = size or multiprocessing.cpu_count()
+        if size != self.counts.size:
+            self.counts.size = size
+            # the next job will start a pool of the new size
+            self.stop()
+
+    def get_pool(self):
+        if self.pool is None:
+            if self.reactor is None:
+                from twisted.internet import reactor
+                self.reactor = reactor
+            self.pool = multiprocessing.Pool(self.counts.size,
+                                             initializer=reset_worker_signals)
+        return self.pool
+
+    def stop(self):
+        """
+        Kill off the worker processes. Anything still in flight is
+        errbacked with a WorkerError.
+        """
+
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool = None
+        pending, self.pending = self.pending, set()
+        for job in pending:
+            self.give_up(job, 'worker processes were shut down')
+
+    def give_up(self, job, why):
+        d, queued_at, timer = job
+        self.pending.discard(job)
+        if timer.active():
+            timer.cancel()
+        self.counts.finished(queued_at, None, False)
+        d.errback(WorkerError(why))
+
+    def run(self, f, *a, **kw):
+        """
+        Call the cpu_bound function f(*a, **kw) in a worker process, and
+        return a Deferred for the result.
+        """
+
+        # the pool pickles the arguments in a thread of its own, and if
+        # that fails the job is dropped without a word (python 2's
+        # apply_async has no error_callback), so find out here first
+        try:
+            pickle.dumps((a, kw), -1)
+        except Exception, e:
+            return defer.fail(WorkerError('arguments to %s can not be pickled: %s'
+                                          % (f.__name__, e)))
+        pool = self.get_pool()
+        d = defer.Deferred()
+        queued_at = self.counts.submitted()
+        timer = self.reactor.callLater(self.job_timeout, lambda: self.give_up(
+                job, 'no result from %s within %ds' % (f.__name__, self.job_timeout)))
+        job = (d, queued_at, timer)
+        self.pending.add(job)
+        def done(result):
+            # runs in the pool's result handler thread
+            self.reactor.callFromThread(self.finished, job, *result)
+        pool.apply_async(run_in_worker_process, (f.__module__, f.__name__, a, kw),
+                         callback=done)
+        return d
+
+    def finished(self, job, started_at, ok, payload):
+        if job not in self.pending:
+            # already given up on, by stop() or the timeout
+            return
+        self.pending.discard(job)
+        d, queued_at, timer = job
+        timer.cancel()
+        self.counts.finished(queued_at, started_at, ok)
+        if ok:
+            d.callback(pickle.loads(payload))
+        else:
+            d.errback(WorkerError(payload))
+
+    def stats(self):
+        return self.counts.stats()
+
+process_workers = ProcessWorkers()
+
+
+class ReactorProxy:
+    """
+    Wraps an object, usually a CassBotCore, for use from a worker thread.
+    Calling a method on the proxy runs it in the reactor thread and waits
+    for the result. Deferreds are not waited for, though: a call like
+    address_msg just gets its lines queued and returns None. Other
+    attributes are read straight from the wrapped object.
+    """
+
+    def __init__(self, target, reactor):
+        self._target = target
+        self._reactor = reactor
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+        def call_in_reactor(*a, **kw):
+            return self._call(value, a, kw)
+        call_in_reactor.func_name = name
+        return call_in_reactor
+
+    def _call(self, f, a, kw):
+        if threadable.isInIOThread():
+            return f(*a, **kw)
+        results = Queue.Queue()
+        def run():
+            try:
+                res = f(*a, **kw)
+            except Exception:
+                results.put((False, failure.Failure()))
+                return
+            if isinstance(res, defer.Deferred):
+                res.addErrback(log.err, 'In %s, called from a worker thread'
+                                        % (f.__name__,))
+                res = None
+            results.put((True, res))
+        self._reactor.callFromThread(run)
+        ok, res = results.get()
+        if not ok:
+            res.raiseException()
+        return res
+
+
 class CassBotCore(irc.IRCClient):
     overrideable = (
         'created',
@@ -204,21 +1255,37 @@ class CassBotCore(irc.IRCClient):
         'topicUpdated',
         'userRenamed',
         'receivedMOTD',
+        'namesReceived',
         'msg'
     )
 
+    # plugin hooks are timed (for cassbot_hook_seconds) on the first and
+    # then every hook_sample'th call of each method, rather than on every
+    # one, to keep the clock reads and histogram updates off most events
+    hook_sample = 16
+
     def __init__(self, nickname='cassbot'):
         # state that will be saved and reset on this object by the service
         self.nickname = nickname
         self.join_channels = ()
+        self.join_options = {}
+        self.joiner = None
         self.cmd_prefix = None
+        self.network = None
+        self.disabled_commands = frozenset()
 
         self.channels = set()
         self.chan_modemap = {}
         self.is_channel_synced = {}
         self.server_modemap = {}
         self.topic_map = {}
-        self.channel_memberships = {}
+        self.channel_memberships = MembershipMap()
+        # channel -> {nick: modes} for NAMES replies still coming in
+        self.names_pending = {}
+        # channel -> the parts ('names', 'topic', 'modes') of what we know
+        # about it that were carried over from a lost connection and have not
+        # been refreshed yet
+        self.stale_channels = {}
         self.is_signed_on = False
         self.init_time = time.time()
 
@@ -228,21 +1295,72 @@ class CassBotCore(irc.IRCClient):
             setattr(self, mname, wrappedmethod)
 
     def make_watch_wrapper(self, mname, realmethod):
-        @defer.inlineCallbacks
+        labels = (mname,)
         def wrapper(*a, **kw):
-            realresult = yield realmethod(*a, **kw)
-            watchers = self.service.watcher_map.get(mname, ())
-            for w in watchers:
-                pluginmethod = getattr(w, mname, noop)
-                try:
-                    yield pluginmethod(self, *a, **kw)
-                except Exception, e:
-                    log.err(None, 'Exception in plugin %s for method %r'
-                                  % (w.name(), mname))
-            defer.returnValue(realresult)
+            n = self.service.metrics.events.inc(labels)
+            timed = (n - 1) % self.hook_sample == 0
+            try:
+                realresult = realmethod(*a, **kw)
+            except Exception:
+                return defer.fail()
+            if isinstance(realresult, defer.Deferred):
+                return realresult.addCallback(
+                    lambda r: self.fan_out(mname, r, a, kw, timed=timed))
+            return self.fan_out(mname, realresult, a, kw, timed=timed)
         wrapper.func_name = 'wrapper_for_%s' % mname
         return wrapper
 
+    def fan_out(self, mname, realresult, a, kw, hooks=None, start=0, timed=False):
+        """
+        Call each plugin hook registered for mname, in order. Hooks are run
+        synchronously for as long as none of them return a Deferred that
+        hasn't fired yet; once one does, the rest of the hooks are chained
+        after it fires. The returned Deferred fires with realresult once all
+        hooks are done. A hook raising an exception or returning a failed
+        Deferred doesn't stop the others. If timed is true, how long each
+        hook took goes into the hook_seconds metric.
+        """
+
+        if hooks is None:
+            hooks = self.service.dispatch_map.get(mname, ())
+        now = time.time
+        started = None
+        for i in xrange(start, len(hooks)):
+            plugin, hook, observe = hooks[i]
+            if timed:
+                started = now()
+            try:
+                res = hook(self, *a, **kw)
+            except Exception:
+                self.hook_failed(None, plugin, mname)
+                continue
+            if isinstance(res, defer.Deferred):
+                # most have already fired, so look before chaining anything
+                outcome = []
+                res.addBoth(outcome.append)
+                if not outcome:
+                    res.addCallback(lambda _, started=started:
+                                    self.hook_done(outcome[0], plugin, mname,
+                                                   observe, started))
+                    res.addCallback(lambda _, i=i: self.fan_out(mname, realresult, a, kw,
+                                                                 hooks, i + 1, timed))
+                    return res
+                self.hook_done(outcome[0], plugin, mname, observe, started)
+                continue
+            if timed:
+                observe(now() - started)
+        return defer.succeed(realresult)
+
+    def hook_done(self, outcome, plugin, mname, observe, started):
+        if isinstance(outcome, failure.Failure):
+            self.hook_failed(outcome, plugin, mname)
+        elif started is not None:
+            observe(time.time() - started)
+
+    def hook_failed(self, err, plugin, mname):
+        self.service.metrics.hook_errors.inc((plugin.name(), mname))
+        log.err(err, 'Exception in plugin %s for method %r' % (plugin.name(), mname))
+
     def add_channel(self, channel):
         self.channels.add(channel)
 
@@ -251,32 +1369,153 @@ class CassBotCore(irc.IRCClient):
         removekey(self.topic_map, channel)
         removekey(self.chan_modemap, channel)
         removekey(self.is_channel_synced, channel)
-        removekey(self.channel_memberships, channel)
+        removekey(self.names_pending, channel)
+        removekey(self.stale_channels, channel)
+        self.channel_memberships.remove_channel(channel)
+
+    def carry_channel_state(self):
+        """
+        Return what we know about the server and our channels, for the next
+        connection to start from (see restore_channel_state).
+        """
+
+        return {
+            'supported': self.supported,
+            'channels': self.channels.union(self.stale_channels),
+            'chan_modemap': self.chan_modemap,
+            'topic_map': self.topic_map,
+            'channel_memberships': self.channel_memberships,
+        }
+
+    def restore_channel_state(self, carried):
+        """
+        Start out with the channel state from a lost connection, all of it
+        marked stale, instead of from nothing. Channels that get rejoined are
+        brought up to date piece by piece, as their NAMES, topic and modes
+        come in; whatever is left over about the others is dropped once the
+        join scheduler is done (see drop_stale).
+        """
+
+        self.supported = carried['supported']
+        self.chan_modemap = carried['chan_modemap']
+        self.topic_map = carried['topic_map']
+        self.channel_memberships = carried['channel_memberships']
+        for channel in carried['channels']:
+            self.stale_channels[channel] = set(('names', 'topic', 'modes'))
+
+    def refreshed(self, channel, part):
+        parts = self.stale_channels.get(channel)
+        if parts is not None:
+            parts.discard(part)
+            if not parts:
+                del self.stale_channels[channel]
+
+    def drop_stale(self):
+        for channel in self.stale_channels.keys():
+            if channel not in self.channels:
+                self.leave_channel(channel)
 
     def dispatch_command(self, user, channel, cmd, args):
-        cmd = cmd.lower().replace('-', '_')
-        mname = 'command_' + cmd
+        metrics = self.service.metrics
+        if not self.admit_command(user, channel):
+            metrics.commands.inc(('', channel_label(channel), 'throttled'))
+            return
+        route = self.service.router.route(cmd)
+        if route is not None and route[0] in self.disabled_commands:
+            route = None
+        if route is None:
+            metrics.commands.inc(('', channel_label(channel), 'not_found'))
+            return self.command_not_found(user, channel, cmd)
+        if route[0] is None:
+            metrics.commands.inc(('', channel_label(channel), 'ambiguous'))
+            return self.address_msg(user, channel, '%r is ambiguous; it could mean: %s'
+                                                   % (cmd, ', '.join(route[1])))
+        cmd, handlers = route
         dlist = []
-        for p in self.service.command_map.get(cmd, ()):
-            try:
-                pluginmethod = getattr(p, mname)
-            except AttributeError:
-                continue
-            d = defer.maybeDeferred(pluginmethod, self, user, channel, args)
-            d.addErrback(self.handle_command_error, p, user, channel, cmd, args)
-            dlist.append(d)
+        for p, pluginmethod in handlers:
+            dlist.append(self.run_command(p, pluginmethod, user, channel, cmd, args))
         if len(dlist) == 0:
             return self.command_not_found(user, channel, cmd)
         return defer.DeferredList(dlist)
 
-    def handle_command_error(self, err, plugin, user, channel, cmd, args):
+    def admit_command(self, user, channel):
+        """
+        Decide whether to accept a command from user right now, using a
+        per-user token bucket. Admins are never throttled, and don't get a
+        bucket at all. The first refusal in a row gets a reply; the rest are
+        dropped silently.
+        """
+
+        serv = self.service
+        if serv.auth.userHas(user, 'admin'):
+            return True
+        # key on user@host, so changing nicks doesn't buy a fresh bucket
+        key = (self.network, user.split('!', 1)[-1])
+        throttle = serv.command_throttle
+        if throttle.admit(key):
+            return True
+        if key not in throttle.warned:
+            throttle.warned.add(key)
+            self.address_msg(user, channel, "You're sending commands too fast;"
+                                            " ignoring you for a bit.")
+        return False
+
+    def run_command(self, plugin, pluginmethod, user, channel, cmd, args):
+        """
+        Call a plugin's command method, unless that plugin already has as many
+        commands in flight as it's allowed. The command is cancelled if it
+        hasn't finished within its timeout.
+        """
+
+        serv = self.service
+        pname = plugin.name()
+        if serv.in_flight.get(pname, 0) >= serv.plugin_max_in_flight(plugin):
+            serv.commands_refused += 1
+            serv.metrics.commands.inc((cmd, channel_label(channel), 'refused'))
+            return self.address_msg(user, channel, 'Too many %s commands are already'
+                                                   ' running; try again later.' % cmd)
+        serv.in_flight[pname] = serv.in_flight.get(pname, 0) + 1
+        started = time.time()
+        d = defer.maybeDeferred(pluginmethod, self, user, channel, args)
+        timeout = serv.command_timeout(plugin, cmd)
+        timer = None
+        if timeout and not d.called:
+            timer = serv.reactor.callLater(timeout, d.cancel)
+        def finished(result):
+            if timer is not None and timer.active():
+                timer.cancel()
+            serv.command_finished(pname)
+            if not isinstance(result, failure.Failure):
+                outcome = 'ok'
+            elif timer is not None and timer.called:
+                outcome = 'timeout'
+            else:
+                outcome = 'error'
+            serv.metrics.command_done(plugin, cmd, channel, started, outcome)
+            return result
+        d.addBoth(finished)
+        d.addErrback(self.handle_command_error, plugin, user, channel, cmd, args,
+                     timer)
+        return d
+
+    def handle_command_error(self, err, plugin, user, channel, cmd, args, timer=None):
+        if err.check(defer.CancelledError) and timer is not None and timer.called:
+            log.msg('Command %r in plugin %s timed out' % (cmd, plugin.name()))
+            return self.address_msg(user, channel, "The %r command timed out." % cmd)
         log.err(err, "Exception in plugin %s while in %r command"
                      % (plugin.name(), cmd))
         return self.address_msg(user, channel,
                                 "Error in the %r command: %s" % (cmd, err.value))
 
-    @defer.inlineCallbacks
-    def address_msg(self, user, channel, msg, prefix=True):
+    def address_msg(self, user, channel, msg, prefix=True, lane='reply'):
+        """
+        Reply to user in channel (or privately, if channel is our own nick).
+        Each line of msg is sent through the outbound queue in the given
+        lane. The returned Deferred fires as soon as they are queued, not
+        once they are sent: commands usually return it, and a backed-up
+        queue shouldn't make them look slow, or time out.
+        """
+
         if '!' in user:
             user = user.split('!', 1)[0]
         transform = lambda m:m
@@ -284,10 +1523,36 @@ class CassBotCore(irc.IRCClient):
             channel = user
         elif prefix:
             transform = lambda m: '%s: %s' % (user, m)
-        for line in msg.split('\n'):
-            yield self.msg(channel, transform(line))
+        self.outqueue.enqueue(channel, imap(transform, msg.split('\n')), lane=lane)
+        return defer.succeed(None)
+
+    def recently_posted(self, user, channel, ref):
+        """
+        Tell whether ref (a link, say) was already posted where a reply to
+        user in channel goes, within the service's reference_window. If it
+        wasn't, it's counted as posted now. For plugins that post links to
+        things people mention, so a busy discussion of a ticket doesn't get
+        the same link over and over.
+        """
+
+        if channel == self.nickname:
+            channel = user.split('!', 1)[0]
+        key = (self.network, channel.lower(), ref)
+        recent = self.service.recent_references
+        # get() rather than 'in', so a reference that keeps coming up counts
+        # as recently used and isn't the first to be evicted
+        if recent.get(key, False):
+            self.service.metrics.references_suppressed.inc((channel_label(channel),))
+            return True
+        recent.set(key, True)
+        return False
 
     def command_not_found(self, user, channel, cmd):
+        pnames = self.service.manifest.plugins_with_command(cmd)
+        if pnames:
+            return self.address_msg(user, channel, "The %r command is in %s, which"
+                                                   " isn't enabled."
+                                                   % (cmd, natural_list(pnames)))
         return self.address_msg(user, channel, "Sorry, I don't understand %r. :(" % cmd)
 
     ### methods called by the protocol
@@ -313,16 +1578,22 @@ class CassBotCore(irc.IRCClient):
         elif self.cmd_prefix is not None and message.startswith(self.cmd_prefix):
             cmdstr = message[len(self.cmd_prefix):]
         if cmdstr is not None:
-            parts = shlex.split(cmdstr.strip())
-            cmd = parts[0]
-            args = parts[1:]
-            self.dispatch_command(user, channel, cmd, args)
+            try:
+                parts = split_command(cmdstr)
+            except CommandParseError, e:
+                return self.address_msg(user, channel, "Couldn't parse that: %s" % e)
+            if parts:
+                self.dispatch_command(user, channel, parts[0], parts[1:])
 
     def joined(self, channel):
-        self.channel_memberships[channel] = set()
+        if channel not in self.stale_channels:
+            self.channel_memberships.reset_channel(channel)
         self.is_channel_synced[channel] = False
         self.add_channel(channel)
-        self.requestChannelMode(channel)
+        if self.joiner is not None:
+            self.joiner.query_mode(channel)
+        else:
+            self.requestChannelMode(channel)
 
     def left(self, channel):
         self.leave_channel(channel)
@@ -360,48 +1631,77 @@ class CassBotCore(irc.IRCClient):
     def signedOn(self):
         self.factory.prot = self
         self.factory.resetDelay()
-        for chan in self.join_channels:
-            self.join(chan)
+        if self.factory.lost_at is not None:
+            downtime = self.service.reactor.seconds() - self.factory.lost_at
+            self.factory.lost_at = None
+            log.msg('Back on %s after %.1fs' % (self.network, downtime))
+            self.service.metrics.reconnect_downtime.observe((self.network,), downtime)
+        self.joiner = JoinScheduler(self, list(self.join_channels), self.service.reactor,
+                                    **self.join_options)
+        self.joiner.start()
         self.is_signed_on = True
         self.sign_on_time = time.time()
 
     def userJoined(self, user, channel):
-        self.channel_memberships.setdefault(channel, set()).add(user)
+        self.channel_memberships.add(channel, user)
 
     def userLeft(self, user, channel):
-        self.channel_memberships.setdefault(channel, set()).discard(user)
+        self.channel_memberships.discard(channel, user)
         removekey(self.chan_modemap.get(channel, {}), user)
 
     def userKicked(self, kickee, channel, kicker, message):
         self.userLeft(kickee, channel)
 
-    def userQuit(self, user, channel):
-        self.userLeft(user, channel)
+    def userQuit(self, user, quitMessage):
+        for channel in self.channel_memberships.remove_nick(user):
+            removekey(self.chan_modemap.get(channel, {}), user)
         self.server_modemap.pop(user, None)
 
     def chanSynced(self, channel):
         self.is_channel_synced[channel] = True
+        if self.joiner is not None:
+            self.joiner.synced(channel)
+
+    def namesReceived(self, channel, names):
+        """
+        Called once a complete NAMES reply for channel has come in, after
+        channel_memberships and chan_modemap have been brought up to date
+        with it. names maps each nick to a frozenset of its prefix modes
+        ('o' for ops, 'v' for voice, etc). Ops and voices from NAMES are not
+        reported through modeChanged.
+        """
 
     def topicUpdated(self, user, channel, newTopic):
         self.topic_map[channel] = newTopic
+        self.refreshed(channel, 'topic')
 
     def userRenamed(self, oldname, newname):
-        for cm in self.channel_memberships.itervalues():
-            if oldname in cm:
-                cm.add(newname)
-                cm.remove(oldname)
-        for modemap in self.chan_modemap.itervalues():
-            modemap[newname] = modemap.pop(oldname, set())
+        for channel in self.channel_memberships.rename(oldname, newname):
+            modemap = self.chan_modemap.get(channel)
+            if modemap is not None and oldname in modemap:
+                modemap[newname] = modemap.pop(oldname)
         modes = self.server_modemap.pop(oldname, None)
         if modes:
             self.server_modemap[newname] = modes
 
+    def connectionMade(self):
+        irc.IRCClient.connectionMade(self)
+        carried, self.factory.carried_state = self.factory.carried_state, None
+        if carried is not None:
+            self.restore_channel_state(carried)
+
     def connectionLost(self, reason):
         self.is_signed_on = False
+        self.outqueue.clear()
+        if self.joiner is not None:
+            self.joiner.stop()
         try:
             del self.factory.prot
         except AttributeError:
             pass
+        self.factory.carried_state = self.carry_channel_state()
+        if self.factory.lost_at is None:
+            self.factory.lost_at = self.service.reactor.seconds()
         return irc.IRCClient.connectionLost(self, reason)
 
     def lineReceived(self, line):
@@ -409,28 +1709,82 @@ class CassBotCore(irc.IRCClient):
             print "LINE: %r" % line
         return irc.IRCClient.lineReceived(self, line)
 
+    def nick_prefixes(self):
+        """
+        Return a dict mapping the prefixes the server puts on nicks in NAMES
+        replies (like '@') to the channel modes they stand for (like 'o'),
+        according to its ISUPPORT PREFIX.
+        """
+
+        return dict((p, mode) for (mode, (p, rank))
+                    in self.supported.getFeature('PREFIX', {}).iteritems())
+
     def irc_RPL_NAMREPLY(self, prefix, params):
+        # just collect names until the end of the reply, then apply them
+        # all at once
         channel, nlist = params[-2:]
-        memb = self.channel_memberships.setdefault(channel, set())
-        chanmap = self.chan_modemap.setdefault(channel, {})
+        prefixes = self.nick_prefixes()
+        names = self.names_pending.setdefault(channel, {})
+        no_modes = frozenset()
         for name in nlist.split():
-            if name.startswith('@'):
-                name = name[1:]
-                self.modeChanged(None, channel, True, 'o', (name,))
-            if name.startswith('+'):
-                name = name[1:]
-                self.modeChanged(None, channel, True, 'v', (name,))
-            memb.add(name)
+            if name[0] not in prefixes:
+                names[name] = no_modes
+                continue
+            # with multi-prefix, there can be several
+            i = 1
+            while i < len(name) and name[i] in prefixes:
+                i += 1
+            names[name[i:]] = frozenset(prefixes[p] for p in name[:i])
 
     def irc_RPL_ENDOFNAMES(self, prefix, params):
         channel = params[-2]
+        names = self.names_pending.pop(channel, {})
+        if channel not in self.channels:
+            # someone asked about a channel we're not in
+            self.namesReceived(channel, names)
+            return
+        self.apply_names(channel, names)
+        if 'topic' in self.stale_channels.get(channel, ()):
+            # the topic comes before NAMES when joining, so there isn't one
+            removekey(self.topic_map, channel)
+            self.refreshed(channel, 'topic')
+        self.refreshed(channel, 'names')
+        self.namesReceived(channel, names)
         self.chanSynced(channel)
 
+    def apply_names(self, channel, names):
+        gone = self.channel_memberships.replace_channel(channel, names)
+        modemap = self.chan_modemap.setdefault(channel, {})
+        for nick in gone:
+            modemap.pop(nick, None)
+        for nick, modes in names.iteritems():
+            if modes:
+                modemap[nick] = set(modes)
+            else:
+                modemap.pop(nick, None)
+
+    def irc_ERR_CANTJOIN(self, prefix, params):
+        channel = params[1]
+        log.msg('Could not join %s: %s' % (channel, params[-1]))
+        if self.joiner is not None:
+            self.joiner.join_failed(channel)
+
+    irc_ERR_NOSUCHCHANNEL = irc_ERR_CANTJOIN
+    irc_ERR_TOOMANYCHANNELS = irc_ERR_CANTJOIN
+    irc_ERR_CHANNELISFULL = irc_ERR_CANTJOIN
+    irc_ERR_INVITEONLYCHAN = irc_ERR_CANTJOIN
+    irc_ERR_BANNEDFROMCHAN = irc_ERR_CANTJOIN
+    irc_ERR_BADCHANNELKEY = irc_ERR_CANTJOIN
+
     def irc_RPL_CHANNELMODEIS(self, prefix, params):
         channel = params[1]
         modes = params[2]
         modeparams = params[3:]
         added, removed = irc.parseModes(modes, modeparams, self.getChannelModeParams())
+        if 'modes' in self.stale_channels.get(channel, ()):
+            # this is the full set, so forget the channel modes we had
+            removekey(self.chan_modemap.get(channel, {}), None)
+            self.refreshed(channel, 'modes')
         for mode, arg in added:
             self.modeChanged(None, channel, True, mode, (arg,))
         for mode, arg in removed:
@@ -453,34 +1807,109 @@ def mask_matches(mask, user):
     uparts = splituser(user)
     return all(imap(fnmatch, uparts, mparts))
 
+wildcard_re = re.compile(r'[*?[]')
+
+def compile_mask(mask):
+    """
+    Return a function which takes a splituser() tuple and tells whether it
+    matches the given mask, with the same results as mask_matches().
+    """
+
+    matchers = []
+    for part in splituser(mask):
+        if wildcard_re.search(part) is None:
+            matchers.append(part.__eq__)
+        else:
+            matchers.append(re.compile(translate(part)).match)
+    nickmatch, usermatch, hostmatch = matchers
+    def matches(uparts):
+        return bool(nickmatch(uparts[0]) and usermatch(uparts[1])
+                    and hostmatch(uparts[2]))
+    return matches
+
 
 class AuthMap:
+    """
+    Privileges are sets of members, where each member is either a user mask
+    or the name of another privilege whose members should be included.
+
+    Lookups are served from a per-privilege index of everything reachable
+    through nested privileges, split into literal masks (checked with one
+    hash lookup) and wildcard masks (compiled once). The index and a bounded
+    cache of recent decisions are thrown away whenever privileges change,
+    so anything modifying self.memberships should go through addPriv and
+    removePriv, or call invalidate() itself.
+    """
+
+    decision_cache_size = 4096
+
     def __init__(self):
         self.memberships = {}
         self.per_channel = {}
+        self.mask_matchers = {}
+        self.invalidate()
+
+    def invalidate(self):
+        self.closures = {}
+        self.decisions = {}
 
     def addPriv(self, mask, privname):
         self.memberships.setdefault(privname, set()).add(mask)
+        self.invalidate()
 
     def removePriv(self, mask, privname):
         try:
             self.memberships[privname].remove(mask)
         except KeyError:
-            pass
+            return
+        self.mask_matchers.pop(mask, None)
+        self.invalidate()
 
-    def userHas(self, user, privname, skip=set()):
-        members = self.whoHas(privname)
-        for mask in members:
-            if mask_matches(mask, user):
-                return True
-        # avoid circular paths
-        newskip = skip | set(members)
-        for m in members:
-            if m in skip:
+    def closure(self, privname):
+        """
+        Return the (literal splituser tuples, wildcard mask matchers) for
+        every member reachable from privname, directly or through nested
+        privileges.
+        """
+
+        try:
+            return self.closures[privname]
+        except KeyError:
+            pass
+        reached = set()
+        stack = [privname]
+        while stack:
+            for m in self.memberships.get(stack.pop(), ()):
+                if m not in reached:
+                    reached.add(m)
+                    stack.append(m)
+        literals = set()
+        wildcards = []
+        for mask in reached:
+            if wildcard_re.search(mask) is None:
+                literals.add(splituser(mask))
                 continue
-            if self.userHas(user, m, skip=newskip):
-                return True
-        return False
+            try:
+                matcher = self.mask_matchers[mask]
+            except KeyError:
+                matcher = self.mask_matchers[mask] = compile_mask(mask)
+            wildcards.append(matcher)
+        self.closures[privname] = c = (literals, wildcards)
+        return c
+
+    def userHas(self, user, privname):
+        key = (user, privname)
+        try:
+            return self.decisions[key]
+        except KeyError:
+            pass
+        literals, wildcards = self.closure(privname)
+        uparts = splituser(user)
+        result = uparts in literals or any(w(uparts) for w in wildcards)
+        if len(self.decisions) >= self.decision_cache_size:
+            self.decisions.clear()
+        self.decisions[key] = result
+        return result
 
     def whoHas(self, privname):
         return self.memberships.get(privname, ())
@@ -509,7 +1938,7 @@ class AuthMap:
 
     @_for_channels
     def channelWhoHas(self, c, privname):
-        return c.addPriv(privname)
+        return c.whoHas(privname)
 
     del _for_channels
 
@@ -521,33 +1950,250 @@ class AuthMap:
     def loadState(self, newstate):
         # throw away current info!
         self.memberships, per_chan_info = newstate
+        self.mask_matchers = {}
+        self.invalidate()
         for k, v in per_chan_info.iteritems():
             self.per_channel[k] = c = AuthMap()
             c.loadState(v)
 
 
 class CassBotFactory(protocol.ReconnectingClientFactory):
+    """
+    Reconnects after losing the connection, waiting longer each time it
+    fails in a row. Each wait is cut short by a random part of up to
+    'jitter' of itself, so bots dropped at the same moment (by a netsplit,
+    say) don't all come back at once.
+
+    Keeps the channel state of the last connection in carried_state for the
+    next one to start from, and the time it was lost in lost_at.
+    """
+
     protocol = CassBotCore
+    initialDelay = 1.0
+    factor = 2.0
+    maxDelay = 300
+    jitter = 0.5
+
+    carried_state = None
+    lost_at = None
+
+    def __init__(self, network=None, endpoint=None):
+        self.network = network
+        self.endpoint = endpoint
 
     def buildProtocol(self, addr):
         p = protocol.ReconnectingClientFactory.buildProtocol(self, addr)
-        self.service.initialize_proto_state(p)
+        self.service.initialize_proto_state(p, self.network)
         return p
 
+    def retry(self, connector=None):
+        # ReconnectingClientFactory's jitter is applied to the delay itself,
+        # so it wanders off over repeated failures. Here it only affects the
+        # wait at hand.
+        if not self.continueTrying:
+            return
+        if connector is None:
+            connector = self.connector
+        self.retries += 1
+        if self.maxRetries is not None and self.retries > self.maxRetries:
+            log.msg('Giving up on %s after %d retries' % (self.network, self.retries))
+            return
+        self.delay = min(self.delay * self.factor, self.maxDelay)
+        wait = self.delay * (1 - self.jitter * random.random())
+        log.msg('Reconnecting to %s in %.1f seconds' % (self.network, wait))
+        def reconnect():
+            self._callID = None
+            connector.connect()
+        self._callID = (self.clock or self.service.reactor).callLater(wait, reconnect)
+
+
+class PluginManifest:
+    """
+    What the plugin package has in it, without importing all of it: for
+    each plugin, the module and class it's in, its commands, hooks and
+    description. It's kept in a JSON file (the service keeps it next to
+    its state file) along with the name, relative to the package, mtime
+    and size of each module file it was built from, so only modules that
+    are new or have changed need to be imported to bring it up to date.
+    The service writes it whenever that happens; to build it ahead of
+    time, run
+
+        python -c 'import cassbot; cassbot.PluginManifest().update()'
+
+    Modules that fail to import are tried again next time.
+    """
+
+    filename = 'plugin_manifest.json'
+
+    def __init__(self, path=None, package=cassbot_plugins):
+        self.manifest_path = path or self.filename
+        self.package = package
+        # module name -> {'file': [filename, mtime, size],
+        #                 'plugins': [entry, ...]}
+        self.modules = None
+        # plugin name -> entry
+        self.plugins = {}
+
+    def path(self):
+        return self.manifest_path
+
+    def load(self):
+        try:
+            with open(self.path()) as f:
+                self.modules = json.load(f)['modules']
+        except (IOError, ValueError, KeyError, TypeError):
+            self.modules = {}
+
+    def save(self):
+        path = self.path()
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'modules': self.modules}, f, indent=1, sort_keys=True)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), e:
+            log.msg('Could not save plugin manifest to %s: %s' % (path, e))
+
+    def update(self, signature=None):
+        """
+        Bring the manifest up to date with the module files (as given by
+        CassBotService.plugin_files_signature()). Return True if anything
+        changed.
+        """
+
+        if self.modules is None:
+            self.load()
+        if signature is None:
+            signature = CassBotService.plugin_files_signature()
+        changed = False
+        current = {}
+        for path, mtime, size in signature:
+            filename = os.path.basename(path)
+            basename = os.path.splitext(filename)[0]
+            if basename == '__init__':
+                continue
+            modname = '%s.%s' % (self.package.__name__, basename)
+            info = self.modules.get(modname)
+            if info is None or info['file'] != [filename, mtime, size] \
+                    or info['plugins'] is None:
+                edited = info is not None and info['file'] != [filename, mtime, size]
+                info = {'file': [filename, mtime, size],
+                        'plugins': self.describe_module(modname, edited)}
+                changed = True
+            current[modname] = info
+        if set(current) != set(self.modules):
+            changed = True
+        self.modules = current
+        self.plugins = dict((entry['name'], entry) for info in current.itervalues()
+                                                   for entry in info['plugins'] or ())
+        if changed:
+            self.save()
+        return changed
+
+    def describe_module(self, modname, edited=False):
+        """
+        List the plugins in a module. If the module's file has been edited
+        since the manifest last looked at it, and it was imported before
+        then, it's reloaded first; otherwise the old import's plugins would
+        be recorded against the new file's signature.
+        """
+
+        try:
+            mod = sys.modules.get(modname)
+            if mod is not None and edited:
+                mod = reload(mod)
+            else:
+                mod = namedModule(modname)
+        except Exception:
+            log.err(None, 'Importing plugin module %s' % modname)
+            return None
+        entries = []
+        for obj in vars(mod).values():
+            if not IBotPlugin.providedBy(obj) or obj is BaseBotPlugin \
+                    or getattr(obj, '__module__', None) != modname:
+                continue
+            entries.append({
+                'name': obj.name(),
+                'module': modname,
+                'class': obj.__name__,
+                'commands': sorted(obj.implementedCommands()),
+                'hooks': sorted(obj.interestingMethods()),
+                'description': (obj.description() or '').strip(),
+            })
+        return entries
+
+    def plugin_class(self, pname):
+        """
+        Import the named plugin's module, if need be, and return its class.
+        """
+
+        entry = self.plugins[pname]
+        return getattr(namedModule(entry['module']), entry['class'])
+
+    def plugins_with_command(self, cmd):
+        return sorted(name for (name, entry) in self.plugins.iteritems()
+                      if cmd in entry['commands'])
+
 
 class CassBotService(service.MultiService):
+    """
+    Runs the bot on one or more IRC networks. All networks share the same
+    plugin instances and AuthMap, but each has its own connection and
+    channel state.
+
+    The network given to the constructor is named default_network, and
+    configured by the top-level 'nickname', 'channels', 'cmd_prefix' etc
+    entries in the state. Others are added with add_network(), and their
+    configuration is kept in state['networks'], falling back to the
+    top-level entries for anything they don't set (except 'channels').
+    """
+
     plugin_scan_period = 240
     default_statefile = 'cassbot.state.db'
+    default_network = 'default'
+
+    # command admission defaults, used when the state doesn't say otherwise
+    default_command_rate = 0.5
+    default_command_burst = 5
+    default_command_timeout = 120
+    default_plugin_max_in_flight = 8
+
+    # seconds during which plugins don't post the same reference to the
+    # same channel twice (see CassBotCore.recently_posted), and how many
+    # (network, channel, reference) entries are remembered for that
+    default_reference_window = 300
+    default_reference_cache_size = 4096
+
+    # seconds to let a plugin finish its commands before reloading it
+    reload_drain_timeout = 10
 
     def __init__(self, desc, nickname='cassbot', init_channels=(), reactor=None,
                  statefile=None):
         service.MultiService.__init__(self)
 
         self.statefile = statefile or self.default_statefile
+        # opened by loadStateFromFile() (or saveStateToFile())
+        self.state_store = None
         self.state = {
             'nickname': nickname,
             'channels': init_channels,
             'cmd_prefix': None,
+            'flood_rate': None,
+            'flood_burst': None,
+            'disabled_commands': (),
+            'priority_channels': (),
+            'join_rate': None,
+            'join_burst': None,
+            'join_batch': None,
+            'worker_threads': None,
+            'worker_processes': None,
+            'command_rate': None,
+            'command_burst': None,
+            'command_timeout': None,
+            'command_timeouts': {},
+            'plugin_max_in_flight': None,
+            'reference_window': None,
+            'reference_cache_size': None,
+            'networks': {},
             'plugins': {},
         }
         self.auth = AuthMap()
@@ -558,42 +2204,305 @@ class CassBotService(service.MultiService):
 
         self.endpoint_desc = desc
         self.endpoint = endpoints.clientFromString(reactor, desc)
+        self.workers = ThreadWorkers(reactor)
+        self.metrics = BotMetrics()
+        # shared by plugins making HTTP requests; see the http property
+        self.http_client = None
+        # strports description to serve metrics over HTTP on, if any. falls
+        # back to state['metrics_endpoint']
+        self.metrics_endpoint = None
+        self.metrics_service = None
+        # plugin name -> number of its commands running right now
+        self.in_flight = {}
+        # plugin name -> [(allowed, Deferred, timeout call)] for
+        # wait_for_plugin_idle
+        self.idle_waiters = {}
+        self.commands_refused = 0
+        self.configure_throttle()
+        self.configure_reference_cache()
+        # network name -> CassBotFactory
+        self.networks = {}
 
         self.watcher_map = {}
+        self.dispatch_map = {}
         self.command_map = {}
+        self.refscanner = ReferenceScanner()
+        self.router = CommandRouter(self)
         self.scanning_now = False
 
+        # plugin discovery cache, and what's watching for it to go stale
+        self.manifest = PluginManifest(os.path.join(
+                os.path.dirname(os.path.abspath(self.statefile)), PluginManifest.filename))
+        self.plugin_files = None
+        self.plugin_watcher = None
+        self.plugin_notifier = None
+        self.plugin_check_call = None
+
         # all 'enabled' or 'loaded' plugins have an entry in here, keyed by
         # the plugin name (as given by the .name() classmethod).
         self.pluginmap = {}
 
-        self.pfactory = CassBotFactory()
+        self.pfactory = self.make_factory(self.default_network, self.endpoint)
 
-    def startService(self):
-        res = service.MultiService.startService(self)
-        self.pfactory.service = self
-        connect_endpoint_without_fuss(self.reactor, self.endpoint, self.pfactory)
+    def make_factory(self, network, endpoint):
+        f = self.networks[network] = CassBotFactory(network, endpoint)
+        f.service = self
+        return f
+
+    def add_network(self, network, desc, nickname=None, channels=(),
+                    cmd_prefix=None):
+        """
+        Add another IRC network to run on, given a name and a client
+        endpoint description. Settings left as None are taken from the
+        default network's. If the service is already running, connect
+        right away.
+        """
+
+        if network in self.networks:
+            raise ValueError('There is already a network named %r' % (network,))
+        self.state.setdefault('networks', {})[network] = {
+            'server': desc,
+            'nickname': nickname,
+            'channels': channels,
+            'cmd_prefix': cmd_prefix,
+        }
+        f = self.make_factory(network, endpoints.clientFromString(self.reactor, desc))
+        if self.running:
+            connect_endpoint_without_fuss(self.reactor, f.endpoint, f)
+        return f
+
+    def remove_network(self, network):
+        if network == self.default_network:
+            raise ValueError("Can't remove the default network")
+        f = self.networks.pop(network)
+        self.state['networks'].pop(network, None)
+        self.disconnect_factory(f)
+
+    def disconnect_factory(self, f):
+        f.stopTrying()
         try:
-            self.loadStateFromFile(self.statefile)
-        except (IOError, ValueError):
+            f.prot.transport.loseConnection()
+        except AttributeError:
             pass
+
+    def network_config(self, network):
+        conf = {
+            'nickname': self.state['nickname'],
+            'channels': self.state.get('channels', ()),
+            'cmd_prefix': self.state.get('cmd_prefix', None),
+            'flood_rate': self.state.get('flood_rate'),
+            'flood_burst': self.state.get('flood_burst'),
+            'disabled_commands': self.state.get('disabled_commands', ()),
+            'priority_channels': self.state.get('priority_channels', ()),
+            'join_rate': self.state.get('join_rate'),
+            'join_burst': self.state.get('join_burst'),
+            'join_batch': self.state.get('join_batch'),
+        }
+        if network is not None and network != self.default_network:
+            conf['channels'] = ()
+            for key, value in self.state['networks'][network].iteritems():
+                if value is not None:
+                    conf[key] = value
+        return conf
+
+    def configure_throttle(self):
+        self.command_throttle = UserThrottle(
+                self.state.get('command_rate') or self.default_command_rate,
+                self.state.get('command_burst') or self.default_command_burst,
+                self.reactor)
+
+    def configure_reference_cache(self):
+        self.recent_references = ExpiringLRU(
+                self.state.get('reference_cache_size') or self.default_reference_cache_size,
+                self.state.get('reference_window') or self.default_reference_window,
+                self.reactor)
+
+    def command_timeout(self, plugin, cmd):
+        """
+        Return the number of seconds cmd may run, or None for no limit.
+        """
+
+        timeouts = self.state.get('command_timeouts', {})
+        if cmd in timeouts:
+            return timeouts[cmd]
+        return getattr(plugin, 'command_timeouts', {}).get(
+                cmd, self.state.get('command_timeout') or self.default_command_timeout)
+
+    def plugin_max_in_flight(self, plugin):
+        return getattr(plugin, 'max_in_flight', None) \
+               or self.state.get('plugin_max_in_flight') \
+               or self.default_plugin_max_in_flight
+
+    @property
+    def http(self):
+        """
+        The HTTPClient (see cassbot_http) for plugins to make requests with.
+        It's only set up when first used, so a bot with no plugins making
+        requests never imports twisted.web.
+        """
+
+        if self.http_client is None:
+            from cassbot_http import HTTPClient
+            self.http_client = HTTPClient(self.reactor)
+        return self.http_client
+
+    def start_metrics_service(self):
+        desc = self.metrics_endpoint or self.state.get('metrics_endpoint')
+        if desc and self.metrics_service is None:
+            self.metrics_service = metrics_http_service(self.metrics, str(desc))
+            self.metrics_service.setServiceParent(self)
+
+    def startService(self):
+        res = service.MultiService.startService(self)
+        self.load_saved_state()
+        self.configure_throttle()
+        self.configure_reference_cache()
+        self.workers.resize(self.state.get('worker_threads'))
+        process_workers.resize(self.state.get('worker_processes'))
+        self.start_metrics_service()
+        for f in self.networks.itervalues():
+            f.service = self
+            connect_endpoint_without_fuss(self.reactor, f.endpoint, f)
+        self.start_plugin_watch()
         return res
 
     def stopService(self):
+        self.stop_plugin_watch()
         self.saveStateToFile(self.statefile)
-        self.pfactory.stopTrying()
-        try:
-            self.getbot().transport.loseConnection()
-        except AttributeError:
-            pass
-        self.pfactory.service = None
-        return service.MultiService.stopService(self)
+        self.state_store.close()
+        self.state_store = None
+        for f in self.networks.itervalues():
+            self.disconnect_factory(f)
+            f.service = None
+        workers_stopped = self.workers.stop()
+        process_workers.stop()
+        if self.http_client is not None:
+            self.http_client.close()
+        return defer.gatherResults([workers_stopped,
+                                    service.MultiService.stopService(self)])
+
+    def available_plugins(self):
+        """
+        Return the names of the available plugins, from the plugin manifest,
+        so without importing them. Discovery is done once and then only
+        redone by check_plugin_files(), when files in the plugin package
+        have changed.
+        """
+
+        if self.plugin_files is None:
+            self.discover_plugins(self.plugin_files_signature())
+        return self.manifest.plugins.keys()
+
+    def get_plugin_classes(self):
+        """
+        Return the available plugin classes. This imports all of them; see
+        available_plugins() for just the names.
+        """
+
+        classes = []
+        for pname in self.available_plugins():
+            try:
+                classes.append(self.manifest.plugin_class(pname))
+            except Exception:
+                log.err(None, 'Importing plugin %s' % pname)
+        return classes
+
+    def discover_plugins(self, signature):
+        self.plugin_files = signature
+        self.manifest.update(signature)
 
     @staticmethod
-    def get_plugin_classes():
-        for p in getPlugins(IBotPlugin, cassbot_plugins):
-            if p is not BaseBotPlugin:
-                yield p
+    def plugin_files_signature():
+        sig = []
+        for dirname in cassbot_plugins.__path__:
+            try:
+                names = os.listdir(dirname)
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith('.py'):
+                    continue
+                path = os.path.join(dirname, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                sig.append((path, st.st_mtime, st.st_size))
+        return frozenset(sig)
+
+    def check_plugin_files(self):
+        """
+        Redo plugin discovery if anything in the plugin package has changed
+        since last time, and load any newly found plugins that were waiting
+        to be enabled. Return True if anything had changed.
+        """
+
+        sig = self.plugin_files_signature()
+        if sig == self.plugin_files:
+            return False
+        self.discover_plugins(sig)
+        for pname in self.manifest.plugins.keys():
+            if isinstance(self.pluginmap.get(pname), enabled_but_not_found):
+                self.plugin_found(pname)
+        return True
+
+    def start_plugin_watch(self):
+        self.plugin_watcher = task.LoopingCall(self.check_plugin_files)
+        self.plugin_watcher.clock = self.reactor
+        self.plugin_watcher.start(self.plugin_scan_period, now=False)
+        if inotify is None:
+            return
+        try:
+            self.plugin_notifier = inotify.INotify(self.reactor)
+            self.plugin_notifier.startReading()
+            for dirname in cassbot_plugins.__path__:
+                if os.path.isdir(dirname):
+                    self.plugin_notifier.watch(filepath.FilePath(dirname),
+                                               callbacks=[self.plugin_dir_changed])
+        except Exception:
+            log.err(None, 'Setting up inotify watch for plugins. Falling back '
+                          'to checking every %s seconds.' % self.plugin_scan_period)
+            self.plugin_notifier = None
+
+    def stop_plugin_watch(self):
+        if self.plugin_watcher is not None and self.plugin_watcher.running:
+            self.plugin_watcher.stop()
+        if self.plugin_notifier is not None:
+            self.plugin_notifier.loseConnection()
+            self.plugin_notifier = None
+
+    def plugin_dir_changed(self, watch, path, mask):
+        # an editor save can be a burst of events; only look once it settles
+        if not path.basename().endswith('.py'):
+            return
+        if self.plugin_check_call is not None and self.plugin_check_call.active():
+            self.plugin_check_call.reset(1)
+        else:
+            self.plugin_check_call = self.reactor.callLater(1, self.check_plugin_files)
+
+    def plugin_found(self, pname):
+        """
+        Import the plugin named in the manifest, and load it if it's waiting
+        to be.
+        """
+
+        try:
+            pclass = self.manifest.plugin_class(pname)
+        except Exception:
+            # it stays waiting, in case the module gets fixed
+            log.err(None, 'Importing plugin %s' % pname)
+            return
+        self.plugin_class_found(pclass)
+
+    def plugin_class_found(self, pclass):
+        pname = pclass.name()
+        p = self.pluginmap.get(pname)
+        if isinstance(p, enabled_but_not_found):
+            # hey, we found it. load it up
+            log.msg('Loading plugin %s (first time)...' % pname)
+            p = self.enable_plugin_class(pclass, p.when_found, pname)
+            if p is not None:
+                self.attach_plugin(p)
 
     def scan_plugins(self):
         # wrap _really_scan_plugins, in case some callback inside
@@ -612,33 +2521,144 @@ class CassBotService(service.MultiService):
             self.scanning_now = False
 
     def _really_scan_plugins(self):
+        """
+        Rebuild all the dispatch maps from scratch. Normally they are just
+        updated as plugins are enabled and disabled, but plugins can ask for
+        this if their interestingMethods() or implementedCommands() change.
+        """
+
         self.watcher_map = {}
         self.command_map = {}
-        for pclass in self.get_plugin_classes():
-            pname = pclass.name()
-            try:
-                p = self.pluginmap[pname]
-            except KeyError:
-                # not enabled
-                continue
-            if isinstance(p, enabled_but_not_found):
-                # hey, we found it. load it up
-                log.msg('Loading plugin %s (first time)...' % pname)
-                p = self.enable_plugin_class(pclass, p.when_found, pname)
-                if p is None:
+        self.dispatch_map = {}
+        self.refscanner = ReferenceScanner()
+        self.router.invalidate()
+        available = self.available_plugins()
+        for pname, p in sorted(self.pluginmap.items()):
+            if not isinstance(p, enabled_but_not_found):
+                self.attach_plugin(p)
+            elif pname in available:
+                self.plugin_found(pname)
+
+    def plugin_interests(self, p):
+        """
+        Return a plugin's (method names, command names, reference patterns).
+        """
+
+        try:
+            methodnames = list(p.interestingMethods())
+        except Exception:
+            log.err(None, 'Exception in plugin %s for interestingMethods request'
+                          % (p.name(),))
+            methodnames = []
+        try:
+            cmdnames = list(p.implementedCommands())
+        except Exception:
+            log.err(None, 'Exception in plugin %s for implementedCommands request'
+                          % (p.name(),))
+            cmdnames = []
+        try:
+            refspecs = list(p.referencePatterns())
+        except Exception:
+            log.err(None, 'Exception in plugin %s for referencePatterns request'
+                          % (p.name(),))
+            refspecs = []
+        return methodnames, cmdnames, refspecs
+
+    def attach_plugin(self, p):
+        """
+        Add a plugin's hooks, commands and reference patterns to the
+        dispatch maps.
+        """
+
+        methodnames, cmdnames, refspecs = self.plugin_interests(p)
+        for methodname in methodnames:
+            self.watcher_map.setdefault(methodname, []).append(p)
+        for cmdname in cmdnames:
+            self.command_map.setdefault(cmdname, []).append(p)
+        if cmdnames:
+            self.router.invalidate()
+        for refspec in refspecs:
+            self.refscanner.register(p, *refspec)
+        if refspecs:
+            methodnames.extend(ReferenceScanner.hooks)
+        self.rebuild_dispatch(methodnames)
+
+    def detach_plugin(self, p):
+        """
+        Remove everything attach_plugin() added for a plugin.
+        """
+
+        methodnames = []
+        for methodname, watchers in self.watcher_map.items():
+            if p in watchers:
+                watchers.remove(p)
+                methodnames.append(methodname)
+                if not watchers:
+                    del self.watcher_map[methodname]
+        for cmdname, handlers in self.command_map.items():
+            if p in handlers:
+                handlers.remove(p)
+                self.router.invalidate()
+                if not handlers:
+                    del self.command_map[cmdname]
+        if self.refscanner.unregister(p):
+            methodnames.extend(ReferenceScanner.hooks)
+        self.rebuild_dispatch(methodnames)
+
+    def swap_plugin(self, old, new):
+        """
+        Put plugin new in old's place in the dispatch maps, keeping its
+        position among the other plugins for any hooks and commands they
+        both have. Like detach_plugin(old) followed by attach_plugin(new),
+        but without changing the order plugins are called in.
+        """
+
+        methodnames, cmdnames, refspecs = self.plugin_interests(new)
+        changed = list(methodnames)
+        for themap, names in ((self.watcher_map, methodnames),
+                              (self.command_map, cmdnames)):
+            names = set(names)
+            for name, plugins in themap.items():
+                if old not in plugins:
                     continue
-            try:
-                for methodname in p.interestingMethods():
-                    self.watcher_map.setdefault(methodname, []).append(p)
-            except Exception:
-                log.err(None, 'Exception in plugin %s for interestingMethods request'
-                              % (p.name(),))
-            try:
-                for cmdname in p.implementedCommands():
-                    self.command_map.setdefault(cmdname, []).append(p)
-            except Exception:
-                log.err(None, 'Exception in plugin %s for implementedCommands request'
-                              % (p.name(),))
+                changed.append(name)
+                if name in names:
+                    plugins[plugins.index(old)] = new
+                    names.discard(name)
+                else:
+                    plugins.remove(old)
+                    if not plugins:
+                        del themap[name]
+            for name in names:
+                themap.setdefault(name, []).append(new)
+        self.router.invalidate()
+        if self.refscanner.unregister(old) or refspecs:
+            changed.extend(ReferenceScanner.hooks)
+        for refspec in refspecs:
+            self.refscanner.register(new, *refspec)
+        self.rebuild_dispatch(changed)
+
+    def rebuild_dispatch(self, methodnames):
+        """
+        Recompile the dispatch_map entries for the given methods, as used by
+        CassBotCore.fan_out: a tuple of (plugin, bound method, latency
+        observer) triples.
+        """
+
+        observer = self.metrics.hook_seconds.observer
+        for methodname in set(methodnames):
+            hooks = []
+            for p in self.watcher_map.get(methodname, ()):
+                hook = getattr(p, methodname, None)
+                if hook is not None:
+                    hooks.append((p, hook, observer((p.name(), methodname))))
+            if methodname in ReferenceScanner.hooks and self.refscanner.patterns:
+                hooks.append((self.refscanner, getattr(self.refscanner, methodname),
+                              observer((self.refscanner.name(), methodname))))
+            if hooks:
+                self.dispatch_map[methodname] = tuple(hooks)
+            else:
+                self.dispatch_map.pop(methodname, None)
 
     def enable_plugin_by_name(self, pname):
         """
@@ -656,7 +2676,11 @@ class CassBotService(service.MultiService):
         if p is None:
             p = self.pluginmap[pname] = enabled_but_not_found()
         if isinstance(p, enabled_but_not_found):
-            self.scan_plugins()
+            if pname in self.available_plugins():
+                self.plugin_found(pname)
+            else:
+                # maybe it's new
+                self.check_plugin_files()
             return p.when_found
         return defer.succeed(p)
 
@@ -683,6 +2707,91 @@ class CassBotService(service.MultiService):
         deferred.callback(p)
         return p
 
+    @defer.inlineCallbacks
+    def reload_plugin(self, pname, allowed_in_flight=0):
+        """
+        Reimport a plugin's module and replace the plugin with an instance
+        of its new class, handing its state over with saveState() and
+        loadState(). The old instance gets up to reload_drain_timeout
+        seconds to finish the commands it's running (all but
+        allowed_in_flight of them, for a plugin reloading itself) first,
+        and keeps taking new ones until then. The swap itself happens all
+        at once, without a rescan.
+
+        Return a Deferred firing with the new instance. If anything goes
+        wrong, the old instance stays in place.
+        """
+
+        old = self.pluginmap.get(pname)
+        if old is None or isinstance(old, enabled_but_not_found):
+            raise KeyError('Plugin %s is not loaded' % pname)
+        drained = yield self.wait_for_plugin_idle(pname, allowed_in_flight,
+                                                  self.reload_drain_timeout)
+        if not drained:
+            log.msg('Reloading plugin %s with %d commands still running'
+                    % (pname, self.in_flight.get(pname, 0)))
+        if self.pluginmap.get(pname) is not old:
+            raise ValueError('Plugin %s changed while waiting to reload it' % pname)
+        started = time.time()
+        oldclass = type(old)
+        mod = reload(sys.modules[oldclass.__module__])
+        newclass = getattr(mod, oldclass.__name__, None)
+        if not isinstance(newclass, type) or newclass.name() != pname:
+            raise ValueError('%s no longer has a plugin named %s' % (mod.__name__, pname))
+        # get the new instance ready before touching anything, so the old
+        # one is still whole if that fails
+        new = newclass()
+        try:
+            pstate = old.saveState()
+            if pstate is not None:
+                new.loadState(pstate)
+        except Exception:
+            self.shutdown_plugin(new)
+            raise
+        if pstate is not None:
+            self.state['plugins'][pname] = pstate
+        self.pluginmap[pname] = new
+        self.swap_plugin(old, new)
+        self.shutdown_plugin(old)
+        log.msg('Reloaded plugin %s in %.1fms' % (pname, (time.time() - started) * 1000))
+        defer.returnValue(new)
+
+    def command_finished(self, pname):
+        n = self.in_flight[pname] - 1
+        if n <= 0:
+            del self.in_flight[pname]
+            n = 0
+        else:
+            self.in_flight[pname] = n
+        waiters = self.idle_waiters.get(pname)
+        if waiters:
+            for waiter in [w for w in waiters if n <= w[0]]:
+                waiters.remove(waiter)
+                waiter[2].cancel()
+                waiter[1].callback(True)
+            if not waiters:
+                del self.idle_waiters[pname]
+
+    def wait_for_plugin_idle(self, pname, allowed=0, timeout=None):
+        """
+        Return a Deferred firing with True once no more than allowed
+        commands of the named plugin are running, or with False if timeout
+        seconds pass first.
+        """
+
+        if self.in_flight.get(pname, 0) <= allowed:
+            return defer.succeed(True)
+        d = defer.Deferred()
+        def expired():
+            waiters = self.idle_waiters[pname]
+            waiters.remove(waiter)
+            if not waiters:
+                del self.idle_waiters[pname]
+            d.callback(False)
+        waiter = (allowed, d, self.reactor.callLater(timeout, expired))
+        self.idle_waiters.setdefault(pname, []).append(waiter)
+        return d
+
     def disable_plugin(self, pname):
         """
         Disable the plugin with the given name. If it was actually loaded and
@@ -701,13 +2810,33 @@ class CassBotService(service.MultiService):
                 self.state['plugins'].pop(pname, None)
             else:
                 self.state['plugins'][pname] = pstate
-        self.scan_plugins()
+            self.detach_plugin(p)
+            self.shutdown_plugin(p)
 
-    def initialize_proto_state(self, proto):
-        proto.nickname = self.state['nickname']
-        proto.join_channels = self.state.get('channels', ())
-        proto.cmd_prefix = self.state.get('cmd_prefix', None)
+    def shutdown_plugin(self, p):
+        try:
+            p.shutdown()
+        except Exception:
+            log.err(None, 'Shutting down plugin %s' % p.name())
+
+    def initialize_proto_state(self, proto, network=None):
+        conf = self.network_config(network)
+        proto.network = network or self.default_network
+        proto.nickname = conf['nickname']
+        proto.join_channels = conf['channels']
+        proto.join_options = {
+            'rate': conf['join_rate'],
+            'burst': conf['join_burst'],
+            'batch': conf['join_batch'],
+            'priority': conf['priority_channels'],
+        }
+        proto.cmd_prefix = conf['cmd_prefix']
+        proto.disabled_commands = frozenset(conf['disabled_commands'])
         proto.service = self
+        proto.outqueue = OutboundQueue(proto.msg, self.reactor,
+                                       rate=conf['flood_rate'],
+                                       burst=conf['flood_burst'])
+        proto.outqueue.on_sent = self.metrics.message_sent
 
     def initialize_plugin_state(self, plugin):
         try:
@@ -720,33 +2849,121 @@ class CassBotService(service.MultiService):
             except Exception:
                 log.err(None, "Trying to load state in plugin %s" % plugin.name())
 
+    def open_state_store(self, statefile):
+        """
+        Return the StateStore (see cassbot_state) to keep state in. Old
+        pickle state files are migrated to SQLite.
+        """
+
+        return open_state_store(statefile)
+
+    def load_saved_state(self):
+        """
+        Load the state file, as at startup. If it can't be read (a corrupt
+        database, or an old pickle file that can't be unpickled), it is
+        kept aside under another name, and the bot starts out with the
+        state it was given instead.
+        """
+
+        try:
+            self.loadStateFromFile(self.statefile)
+        except (IOError, ValueError, EOFError, pickle.UnpicklingError,
+                sqlite3.DatabaseError):
+            log.err(None, 'Loading state from %s' % (self.statefile,))
+            self.discard_state_store()
+            log.msg('Starting with empty state; the unreadable state file is'
+                    ' kept as %s' % (set_aside(self.statefile),))
+            self.loadStateFromFile(self.statefile)
+
+    def discard_state_store(self):
+        if self.state_store is not None:
+            try:
+                self.state_store.close()
+            except sqlite3.Error:
+                pass
+            self.state_store = None
+
     def saveStateToFile(self, statefile):
+        """
+        Disable all plugins, saving their state, and write out whatever in
+        the state has changed since it was loaded or last saved.
+        """
+
         self.state['plugins_enabled'] = self.pluginmap.keys()
         for pname in self.state['plugins_enabled']:
             self.disable_plugin(pname)
-        self.state['auth_map'] = self.auth.saveState()
-        with open(statefile, 'w') as sfile:
-            pickle.dump(self.state, sfile, -1)
+        if self.state_store is None or self.state_store.path != statefile:
+            self.state_store = self.open_state_store(statefile)
+        statemap = plugins = self.state['plugins']
+        if isinstance(statemap, PluginStateMap):
+            plugins = statemap.changes()
+        settings = dict((k, v) for (k, v) in self.state.iteritems() if k != 'plugins')
+        self.state_store.save(settings, plugins, self.auth.saveState())
+        if isinstance(statemap, PluginStateMap):
+            # only now, so that if the save fails they're tried again next time
+            statemap.saved(plugins)
 
     def loadStateFromFile(self, statefile):
-        with open(statefile, 'r') as sfile:
-            self.state = pickle.load(sfile)
-        auth_dat = self.state.get('auth_map')
-        if auth_dat is not None:
-            self.auth.loadState(auth_dat)
+        """
+        Load the settings and auth map from the state store. Plugin states
+        are only read as plugins get enabled.
+        """
+
+        added = self.state.get('networks', {})
+        if self.state_store is not None:
+            self.state_store.close()
+        store = self.state_store = self.open_state_store(statefile)
+        plugins = PluginStateMap(store)
+        if store.is_empty():
+            # nothing saved yet; keep what we've been given
+            given = self.state['plugins']
+            if isinstance(given, PluginStateMap):
+                given = given.changes()
+            for pname, pstate in given.iteritems():
+                plugins[pname] = pstate
+        else:
+            # read everything before replacing anything, so a store that
+            # turns out to be unreadable leaves the state as it was
+            settings = store.load_settings()
+            authstate = store.load_auth()
+            self.state = settings
+            self.auth.loadState(authstate)
+        self.state['plugins'] = plugins
+        # networks added before the state was loaded are kept, and networks
+        # from the saved state are set up
+        networks = self.state.setdefault('networks', {})
+        for name, conf in added.iteritems():
+            networks.setdefault(name, conf)
+        for name, conf in networks.iteritems():
+            if name not in self.networks:
+                self.make_factory(name, endpoints.clientFromString(self.reactor,
+                                                                   conf['server']))
         for pname in self.state.get('plugins_enabled', ()):
             d = self.enable_plugin_by_name(pname)
             d.addErrback(log.err, "Loading plugin %s" % pname)
 
     def __str__(self):
-        return '<%s object [%s]%s>' % (
+        return '<%s object %s>' % (
             self.__class__.__name__,
-            self.endpoint_desc,
-            ' (connected)' if hasattr(self.pfactory, 'prot') else ''
+            ', '.join('[%s %s]%s' % (name, self.network_desc(name),
+                                     ' (connected)' if hasattr(f, 'prot') else '')
+                      for (name, f) in sorted(self.networks.iteritems()))
         )
 
-    def getbot(self):
-        return self.pfactory.prot
+    def network_desc(self, network):
+        if network == self.default_network:
+            return self.endpoint_desc
+        return self.state['networks'][network]['server']
+
+    def getbot(self, network=None):
+        return self.networks[network or self.default_network].prot
+
+    def getbots(self):
+        """
+        Return the connected CassBotCore instances for all networks.
+        """
+
+        return [f.prot for f in self.networks.itervalues() if hasattr(f, 'prot')]
 
 
 def require_priv(privname):
@@ -792,6 +3009,42 @@ def require_priv_in_channel(privname):
         return wrapper
     return make_wrapper
 
+def blocking(f):
+    """
+    Decorator meant to be applied to command_* methods and event hooks on
+    cassbot plugins which block, on file I/O or some synchronous library,
+    for example. The method is run on the service's worker thread pool,
+    with the bot wrapped in a ReactorProxy, and the caller gets a Deferred
+    for the result. Put this below require_priv and friends, so that the
+    privilege check happens before a thread is tied up.
+
+    A thread can't be interrupted, so when such a command times out only
+    the caller stops waiting; the method runs on to the end, and its result
+    is thrown away. Those leftovers no longer count against the plugin's
+    max_in_flight, so the limit on how many threads they can tie up is the
+    size of the service's ThreadWorkers pool (state['worker_threads']);
+    past that, jobs wait in line.
+    """
+    @wraps(f)
+    def wrapper(self, bot, *a, **kw):
+        serv = bot.service
+        return serv.workers.run(f, self, ReactorProxy(bot, serv.reactor), *a, **kw)
+    return wrapper
+
+def cpu_bound(f):
+    """
+    Decorator for module-level functions that do heavy computation, like
+    parsing a large response. Calling the decorated function runs it in a
+    worker process and returns a Deferred for the result, so its arguments
+    and return value have to be pickleable. The undecorated function is
+    still available as the .func attribute.
+    """
+    @wraps(f)
+    def wrapper(*a, **kw):
+        return process_workers.run(f, *a, **kw)
+    wrapper.func = f
+    return wrapper
+
 
 def natural_list(items):
     if len(items) == 0:
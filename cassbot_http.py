@@ -0,0 +1,129 @@
+# cassbot HTTP client
+
+"""
+An HTTP client for plugins to share (as CassBotService.http), so they
+don't each open a fresh connection per request the way client.getPage
+does. Connections are kept alive in one HTTPConnectionPool, every
+request has a connect timeout and an overall timeout, and identical
+requests made while one is already in flight just wait for its result
+instead of going out again.
+"""
+
+from twisted.internet import defer
+from twisted.web import client, http_headers
+from twisted.python import failure, log
+
+
+class HTTPTimeout(Exception):
+    pass
+
+
+class HTTPResponse:
+    def __init__(self, code, phrase, body):
+        self.code = code
+        self.phrase = phrase
+        self.body = body
+
+    def __str__(self):
+        return '%d %s' % (self.code, self.phrase)
+
+
+class HTTPClient:
+    """
+    request() fires with an HTTPResponse for any response the server
+    gives, whatever its status, or fails with HTTPTimeout (or whatever
+    went wrong with the connection).
+
+    Cancelling the Deferred for a coalesced request only stops that caller
+    waiting; the request itself keeps going for anyone else waiting on it.
+    """
+
+    connect_timeout = 10
+    # less than the default command timeout, so commands waiting on a
+    # request get to say why it failed
+    timeout = 20
+    max_per_host = 4
+    # seconds to keep idle connections around
+    idle_timeout = 120
+    user_agent = 'cassbot'
+
+    def __init__(self, reactor, connect_timeout=None, timeout=None):
+        self.reactor = reactor
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if timeout is not None:
+            self.timeout = timeout
+        self.pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = self.max_per_host
+        self.pool.cachedConnectionTimeout = self.idle_timeout
+        self.agent = client.Agent(reactor, connectTimeout=self.connect_timeout,
+                                  pool=self.pool)
+        # (method, url) -> Deferreds of callers waiting on the request
+        self.in_flight = {}
+        self.requests_made = 0
+        self.requests_coalesced = 0
+
+    def request(self, url, method='GET'):
+        key = (method, url)
+        waiters = self.in_flight.get(key)
+        first = waiters is None
+        if first:
+            waiters = self.in_flight[key] = []
+            self.requests_made += 1
+        else:
+            self.requests_coalesced += 1
+        d = defer.Deferred(lambda d: waiters.remove(d))
+        # before sending, since the request can fail right away (on a bad
+        # url, say), and done() only answers the waiters it finds
+        waiters.append(d)
+        if first:
+            self.send(method, url).addBoth(self.done, key)
+        return d
+
+    def send(self, method, url):
+        headers = http_headers.Headers({'User-Agent': [self.user_agent]})
+        d = self.agent.request(method, url, headers)
+        d.addCallback(self.read_response)
+        timer = self.reactor.callLater(self.timeout, d.cancel)
+        def finished(result):
+            if timer.active():
+                timer.cancel()
+            elif isinstance(result, failure.Failure):
+                # cancelled by the timer, wherever it got to. leave out the
+                # query string, which might hold a token
+                return failure.Failure(HTTPTimeout(
+                        'No response from %s within %ds'
+                        % (url.split('?', 1)[0], self.timeout)))
+            return result
+        return d.addBoth(finished)
+
+    def read_response(self, response):
+        d = client.readBody(response)
+        d.addCallback(lambda body: HTTPResponse(response.code, response.phrase, body))
+        return d
+
+    def done(self, result, key):
+        for d in self.in_flight.pop(key):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        if isinstance(result, failure.Failure):
+            # handled by the waiters (if there were any left)
+            return None
+
+    def stats(self):
+        return {
+            'in_flight': len(self.in_flight),
+            'made': self.requests_made,
+            'coalesced': self.requests_coalesced,
+        }
+
+    def close(self):
+        """
+        Close any idle kept-alive connections. Returns a Deferred.
+        """
+
+        d = self.pool.closeCachedConnections()
+        d.addErrback(log.err, 'Closing cached HTTP connections')
+        return d
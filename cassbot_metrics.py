@@ -0,0 +1,288 @@
+# cassbot metrics
+
+"""
+Counters and latency histograms for the bot, kept in memory and exposed
+in the Prometheus text format (see metrics_http_service), or summarized for
+humans by the Admin plugin's stats command.
+
+Every metric has a fixed list of label names, and each distinct tuple of
+label values gets its own series. Keep label values to a small set:
+that's why channel labels go through channel_label(), so private
+conversations don't make a new series per nick.
+"""
+
+import time
+from bisect import bisect_left
+
+
+def channel_label(channel):
+    if channel[:1] in '#&+!':
+        return channel
+    return '(private)'
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, escape_label(v)) for (n, v) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+def format_value(v):
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+
+    def inc(self, labels=(), n=1):
+        """
+        Add n to the series for labels, and return its new value.
+        """
+
+        value = self.series[labels] = self.series.get(labels, 0) + n
+        return value
+
+    def get(self, labels=()):
+        return self.series.get(labels, 0)
+
+    def total(self):
+        return sum(self.series.itervalues())
+
+    def render(self):
+        for labels, value in sorted(self.series.iteritems()):
+            yield '%s%s %s' % (self.name, format_labels(self.labelnames, labels),
+                               format_value(value))
+
+
+class Histogram:
+    """
+    Observations are counted into fixed buckets, given by their upper
+    bounds. The default buckets suit latencies in seconds, from 100us to
+    30s.
+    """
+
+    kind = 'histogram'
+    default_bounds = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                      .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, doc, labelnames=(), bounds=None):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.bounds = tuple(bounds or self.default_bounds)
+        # labels -> [bucket counts (the last for values past all bounds),
+        #            sum, count]
+        self.series = {}
+
+    def get_series(self, labels):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.bounds) + 1), 0.0, 0]
+        return s
+
+    def observe(self, labels, value):
+        s = self.get_series(labels)
+        s[0][bisect_left(self.bounds, value)] += 1
+        s[1] += value
+        s[2] += 1
+
+    def observer(self, labels):
+        """
+        Return a function f such that f(value) is the same as
+        observe(labels, value), but quicker, for use on hot paths.
+        """
+
+        s = self.get_series(labels)
+        buckets = s[0]
+        bounds = self.bounds
+        def observe(value):
+            buckets[bisect_left(bounds, value)] += 1
+            s[1] += value
+            s[2] += 1
+        return observe
+
+    def count(self, labels):
+        s = self.series.get(labels)
+        return s[2] if s else 0
+
+    def mean(self, labels):
+        s = self.series.get(labels)
+        if not s or not s[2]:
+            return 0.0
+        return s[1] / s[2]
+
+    def quantile(self, labels, q):
+        """
+        Estimate the q-quantile (0 < q <= 1) of the observations, as the
+        upper bound of the bucket it falls in.
+        """
+
+        s = self.series.get(labels)
+        if not s or not s[2]:
+            return 0.0
+        wanted = q * s[2]
+        seen = 0
+        for bound, n in zip(self.bounds, s[0]):
+            seen += n
+            if seen >= wanted:
+                return bound
+        return float('inf')
+
+    def render(self):
+        for labels, (buckets, total, count) in sorted(self.series.iteritems()):
+            cumulative = 0
+            for bound, n in zip(self.bounds, buckets):
+                cumulative += n
+                yield '%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.labelnames, labels, 'le="%s"' % bound),
+                    cumulative)
+            yield '%s_bucket%s %d' % (
+                self.name, format_labels(self.labelnames, labels, 'le="+Inf"'),
+                count)
+            yield '%s_sum%s %r' % (self.name, format_labels(self.labelnames, labels),
+                                   total)
+            yield '%s_count%s %d' % (self.name, format_labels(self.labelnames, labels),
+                                     count)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.start_time = time.time()
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('There is already a metric named %r' % (metric.name,))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        """
+        Return the counter with the given name, making it if need be, so
+        plugins can ask for theirs again after being reloaded.
+        """
+
+        m = self.metrics.get(name)
+        if m is None:
+            m = self.add(Counter(name, doc, labelnames))
+        return m
+
+    def histogram(self, name, doc, labelnames=(), bounds=None):
+        m = self.metrics.get(name)
+        if m is None:
+            m = self.add(Histogram(name, doc, labelnames, bounds))
+        return m
+
+    def uptime(self):
+        return time.time() - self.start_time
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+
+        lines = []
+        for name, metric in sorted(self.metrics.iteritems()):
+            lines.append('# HELP %s %s' % (name, metric.doc))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+# for things measured in seconds to minutes
+sync_bounds = (.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+# commands can run until they time out, which is 120s by default and can
+# be set higher
+command_bounds = Histogram.default_bounds + (60, 120, 300, 600, 1800)
+
+
+class BotMetrics(MetricsRegistry):
+    """
+    The registry used by CassBotService, with the metrics the core keeps
+    itself already in place.
+    """
+
+    def __init__(self):
+        MetricsRegistry.__init__(self)
+        self.events = self.counter(
+                'cassbot_events_total',
+                'Calls of each overrideable CassBotCore method.',
+                ('hook',))
+        self.hook_seconds = self.histogram(
+                'cassbot_hook_seconds',
+                'Time spent in plugin hooks, until any Deferred they return fires.'
+                ' Only a sample of calls is timed (see CassBotCore.hook_sample).',
+                ('plugin', 'hook'))
+        self.hook_errors = self.counter(
+                'cassbot_hook_errors_total',
+                'Exceptions raised by plugin hooks.',
+                ('plugin', 'hook'))
+        self.commands = self.counter(
+                'cassbot_commands_total',
+                'Commands received, by outcome.',
+                ('command', 'channel', 'outcome'))
+        self.command_seconds = self.histogram(
+                'cassbot_command_seconds',
+                'Time taken by plugin command methods.',
+                ('plugin', 'command'), bounds=command_bounds)
+        self.messages_sent = self.counter(
+                'cassbot_messages_sent_total',
+                'Lines sent from the outbound queue.',
+                ('channel',))
+        self.outbound_wait = self.histogram(
+                'cassbot_outbound_wait_seconds',
+                'Time lines spent in the outbound queue.',
+                ('lane',))
+        self.references_suppressed = self.counter(
+                'cassbot_references_suppressed_total',
+                'References not posted again because they were posted recently.',
+                ('channel',))
+        self.channel_sync_seconds = self.histogram(
+                'cassbot_channel_sync_seconds',
+                'Time from signing on until each channel was synced.',
+                ('network',), bounds=sync_bounds)
+        self.all_synced_seconds = self.histogram(
+                'cassbot_all_synced_seconds',
+                'Time from signing on until all channels were synced.',
+                ('network',), bounds=sync_bounds)
+        self.reconnect_downtime = self.histogram(
+                'cassbot_reconnect_downtime_seconds',
+                'Time from losing a connection until signed on again.',
+                ('network',), bounds=sync_bounds)
+
+    def command_done(self, plugin, cmd, channel, started, outcome):
+        self.command_seconds.observe((plugin.name(), cmd), time.time() - started)
+        self.commands.inc((cmd, channel_label(channel), outcome))
+
+    def message_sent(self, lane, target, waited):
+        self.messages_sent.inc((channel_label(target),))
+        self.outbound_wait.observe((lane,), waited)
+
+
+def metrics_http_service(registry, desc):
+    """
+    Return a service serving the registry's metrics over HTTP, on the given
+    strports description. A bare port number only listens on localhost.
+    """
+
+    # only pay for twisted.web when metrics are actually served
+    from twisted.web import server
+    from twisted.application import strports
+    from cassbot_metrics_web import MetricsResource
+    if desc.isdigit():
+        desc = 'tcp:%s:interface=127.0.0.1' % desc
+    return strports.service(desc, server.Site(MetricsResource(registry)))
@@ -0,0 +1,21 @@
+# cassbot metrics over HTTP
+
+"""
+The twisted.web resource serving BotMetrics in the Prometheus text
+format. Kept apart from cassbot_metrics so that importing cassbot doesn't
+import twisted.web; see metrics_http_service.
+"""
+
+from twisted.web import resource
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.registry.render()
@@ -1,3 +1,7 @@
+import os
 from twisted.plugin import pluginPackagePaths
+# made absolute, so plugin discovery keeps working if the process changes
+# directory after this is imported (as twistd and trial can)
+__path__[:] = [os.path.abspath(p) for p in __path__]
 __path__.extend(pluginPackagePaths(__name__))
 __all__ = []
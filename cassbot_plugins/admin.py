@@ -1,12 +1,28 @@
+import time
 from cassbot import (BaseBotPlugin, enabled_but_not_found, require_priv,
-                     require_priv_in_channel)
+                     process_workers)
 from twisted.internet import defer
-from twisted.python import failure
-from twisted.plugin import getModule
+from twisted.python import failure, log
 
 def makelist(i):
     return ', '.join(sorted(i)) if i else 'none'
 
+def duration(secs):
+    if secs < 1:
+        return '%.1fms' % (secs * 1000)
+    if secs < 60:
+        return '%.1fs' % secs
+    if secs < 3600:
+        return '%dm%02ds' % divmod(int(secs), 60)
+    return '%dh%02dm' % divmod(int(secs) / 60, 60)
+
+def p95(h, labels):
+    # past the last bucket, all that's known is it's more than that
+    q = h.quantile(labels, .95)
+    if q == float('inf'):
+        return '>' + duration(h.bounds[-1])
+    return duration(q)
+
 class Admin(BaseBotPlugin):
     @defer.inlineCallbacks
     def command_modules(self, bot, user, channel, args):
@@ -22,7 +38,7 @@ class Admin(BaseBotPlugin):
                 notfound.add(name)
             else:
                 loaded.add(name)
-        available = set(p.name() for p in bot.service.get_plugin_classes()) \
+        available = set(bot.service.available_plugins()) \
                     - notfound - loaded
 
         output = ['loaded modules: %s' % makelist(loaded)]
@@ -31,6 +47,113 @@ class Admin(BaseBotPlugin):
         output.append('other available modules: %s' % makelist(available))
         yield bot.address_msg(user, channel, '\n'.join(output))
 
+    def command_outqueue(self, bot, user, channel, args):
+        s = bot.outqueue.stats()
+        lanes = ', '.join('%s: %d' % (lane, s['lanes'][lane])
+                          for lane in bot.outqueue.lanes)
+        return bot.address_msg(user, channel,
+                'outbound queue: %d lines pending (%s); %d sent, avg wait %.1fs,'
+                ' max wait %.1fs, oldest pending %.1fs'
+                % (s['depth'], lanes, s['sent'], s['avg_wait'], s['max_wait'],
+                   s['oldest_wait']))
+
+    def command_workers(self, bot, user, channel, args):
+        output = []
+        for kind, workers in (('threads', bot.service.workers),
+                              ('processes', process_workers)):
+            s = workers.stats()
+            output.append('worker %s: %d/%d busy, %d queued (peak %d in flight);'
+                          ' %d done, %d failed, avg wait %.1fs, max wait %.1fs'
+                          % (kind, s['busy'], s['size'], s['queued'],
+                             s['peak_in_flight'], s['done'], s['failed'],
+                             s['avg_wait'], s['max_wait']))
+        return bot.address_msg(user, channel, '\n'.join(output))
+
+    def command_inflight(self, bot, user, channel, args):
+        serv = bot.service
+        running = ', '.join('%s: %d' % item for item in sorted(serv.in_flight.iteritems()))
+        throttle = serv.command_throttle
+        return bot.address_msg(user, channel,
+                'commands running: %s. %d refused for plugins at their limit;'
+                ' %d refused from users over their rate, %d being throttled now.'
+                % (running or 'none', serv.commands_refused, throttle.refused,
+                   len(throttle.warned)))
+
+    def command_stats(self, bot, user, channel, args):
+        sections = ('hooks', 'commands', 'channels')
+        if len(args) > 1 or (args and args[0] not in sections):
+            return bot.address_msg(user, channel, 'usage: stats [%s]'
+                                                  % '|'.join(sections))
+        m = bot.service.metrics
+        if args:
+            return bot.address_msg(user, channel,
+                                   getattr(self, 'stats_' + args[0])(m, 10))
+        uptime = m.uptime()
+        events = m.events.total()
+        outcomes = {}
+        for (cmd, chan, outcome), n in m.commands.series.iteritems():
+            outcomes[outcome] = outcomes.get(outcome, 0) + n
+        sent = m.messages_sent.total()
+        wait = sum(m.outbound_wait.mean(k) * m.outbound_wait.count(k)
+                   for k in m.outbound_wait.series)
+        output = [
+            'up %s; %d events (%.1f/s); commands: %s; %d lines sent, avg queue'
+            ' wait %s' % (duration(uptime), events, events / uptime,
+                          ', '.join('%d %s' % (n, o) for (o, n) in sorted(outcomes.iteritems()))
+                          or 'none',
+                          sent, duration(wait / sent if sent else 0)),
+        ]
+        output.extend(getattr(self, 'stats_' + s)(m, 3) for s in sections)
+        return bot.address_msg(user, channel, '\n'.join(output))
+
+    def stats_hooks(self, m, n):
+        h = m.hook_seconds
+        slowest = sorted(h.series, key=h.mean, reverse=True)[:n]
+        return 'slowest hooks (avg/p95/timed calls): %s' % (', '.join(
+                '%s.%s %s/%s/%d' % (plugin, hook, duration(h.mean((plugin, hook))),
+                                    p95(h, (plugin, hook)),
+                                    h.count((plugin, hook)))
+                for (plugin, hook) in slowest) or 'none')
+
+    def stats_commands(self, m, n):
+        h = m.command_seconds
+        busiest = sorted(h.series, key=h.count, reverse=True)[:n]
+        return 'busiest commands (calls/avg/p95): %s' % (', '.join(
+                '%s %d/%s/%s' % (cmd, h.count((plugin, cmd)),
+                                 duration(h.mean((plugin, cmd))),
+                                 p95(h, (plugin, cmd)))
+                for (plugin, cmd) in busiest) or 'none')
+
+    def stats_channels(self, m, n):
+        counts = {}
+        for (cmd, chan, outcome), c in m.commands.series.iteritems():
+            counts[chan] = counts.get(chan, 0) + c
+        sent = dict((chan, c) for ((chan,), c) in m.messages_sent.series.iteritems())
+        busiest = sorted(set(counts) | set(sent),
+                         key=lambda chan: counts.get(chan, 0) + sent.get(chan, 0),
+                         reverse=True)[:n]
+        return 'busiest channels (commands/lines sent): %s' % (', '.join(
+                '%s %d/%d' % (chan, counts.get(chan, 0), sent.get(chan, 0))
+                for chan in busiest) or 'none')
+
+    def command_networks(self, bot, user, channel, args):
+        serv = bot.service
+        output = []
+        for name, f in sorted(serv.networks.iteritems()):
+            prot = getattr(f, 'prot', None)
+            if prot is None:
+                status = 'not connected'
+            else:
+                status = 'connected as %s, in %d channels' % (prot.nickname,
+                                                             len(prot.channels))
+                if prot.joiner is not None:
+                    status += '; ' + prot.joiner.status()
+            desc = serv.network_desc(name)
+            if f is bot.factory:
+                name += ' (this one)'
+            output.append('%s [%s]: %s' % (name, desc, status))
+        return bot.address_msg(user, channel, '\n'.join(output))
+
     @require_priv('admin')
     @defer.inlineCallbacks
     def command_modenable(self, bot, user, channel, args):
@@ -73,15 +196,19 @@ class Admin(BaseBotPlugin):
             yield bot.address_msg(user, channel, 'usage: modreload [modulenames]')
             return
         for arg in args:
-            output = self.do_mod_reload(bot.service, arg)
+            output = yield self.do_mod_reload(bot.service, arg)
             yield bot.address_msg(user, channel, output)
 
     def do_mod_reload(self, serv, modname):
-        try:
-            p = serv.pluginmap[modname]
-        except KeyError:
-            return 'Module %s is not loaded.' % modname
-        mod = getModule(p.__module__).load()
-        reload(mod)
-        bot.service.disable_plugin(modname)
-        return self.do_mod_enable(self, serv, modname)
+        p = serv.pluginmap.get(modname)
+        if p is None or isinstance(p, enabled_but_not_found):
+            return defer.succeed('Module %s is not loaded.' % modname)
+        started = time.time()
+        # this command is one of ours, so it doesn't need to finish first
+        d = serv.reload_plugin(modname, 1 if modname == self.name() else 0)
+        def reloaded(newp):
+            return 'Module %s reloaded in %s.' % (modname, duration(time.time() - started))
+        def failed(err):
+            log.err(err, 'Reloading plugin %s' % modname)
+            return 'Problem reloading %s: [%s] %s' % (modname, err.type.__name__, err.value)
+        return d.addCallbacks(reloaded, failed)
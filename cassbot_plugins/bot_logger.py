@@ -1,20 +1,236 @@
+from __future__ import with_statement
+
+import os
+import gzip
+import time
+import shutil
+import threading
 from cassbot import BaseBotPlugin, natural_list
-from twisted.internet import defer
+from cassbot_plugins.log_index import LogIndex, split_logline
+from twisted.internet import defer, task, threads
 from twisted.python import log
 
+def log_dirname(channel):
+    return channel.lower().replace(os.sep, '_').lstrip('.') or '_'
+
+
+class ChannelLogSink:
+    """
+    Writes log lines to one file per channel per day, as
+    <logdir>/<channel>/<YYYY-MM-DD>.log.
+
+    Lines are buffered in memory and written out by a worker thread,
+    whenever the buffer grows past flush_size bytes or every
+    flush_interval seconds, so the reactor never waits on the disk. If
+    compress is set, each day's file is gzipped (also in the worker
+    thread) once a channel's log rolls over to the next day.
+
+    If an indexer is given, its add() method is called with the path,
+    offset and contents of every line written.
+    """
+
+    def __init__(self, logdir, reactor, flush_size=65536, flush_interval=2.0,
+                 compress=False, indexer=None):
+        self.logdir = logdir
+        self.reactor = reactor
+        self.flush_size = flush_size
+        self.compress = compress
+        self.indexer = indexer
+
+        # path -> list of lines. buffer_lock covers this and self.rotated,
+        # which are swapped out by the writer thread
+        self.buffers = {}
+        self.buffered = 0
+        self.rotated = []
+        self.buffer_lock = threading.Lock()
+        # held by whoever is writing files
+        self.file_lock = threading.Lock()
+
+        # channel -> path of the file it is currently logging to
+        self.current = {}
+        # Deferreds from flush(), fired when the writer thread finishes
+        self.waiting = []
+        # path -> size the file will be once everything buffered is written
+        self.sizes = {}
+        self.writing = False
+
+        self.flusher = task.LoopingCall(self.flush)
+        self.flusher.clock = reactor
+        self.flusher.start(flush_interval, now=False)
+
+    def path_for(self, channel, when):
+        return os.path.join(self.logdir, log_dirname(channel),
+                            time.strftime('%Y-%m-%d.log', time.localtime(when)))
+
+    def write(self, channel, line):
+        when = self.reactor.seconds()
+        path = self.path_for(channel, when)
+        line = '%s %s\n' % (time.strftime('%H:%M:%S', time.localtime(when)), line)
+        with self.buffer_lock:
+            prev = self.current.get(channel)
+            if prev != path:
+                self.current[channel] = path
+                if prev is not None:
+                    self.sizes.pop(prev, None)
+                    if self.compress:
+                        self.rotated.append(prev)
+            offset = self.sizes.get(path)
+            if offset is None:
+                try:
+                    offset = os.path.getsize(path)
+                except OSError:
+                    offset = 0
+            self.sizes[path] = offset + len(line)
+            self.buffers.setdefault(path, []).append(line)
+            self.buffered += len(line)
+            full = self.buffered >= self.flush_size
+        if self.indexer is not None:
+            self.indexer.add(path, offset, line)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand buffered lines to the writer thread, unless it's already busy
+        (in which case it will pick them up before it finishes). Return a
+        Deferred which fires once they're on disk.
+        """
+
+        if not self.writing and not self.buffers:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if not self.writing:
+            self.writing = True
+            w = threads.deferToThreadPool(self.reactor,
+                                          self.reactor.getThreadPool(),
+                                          self.write_pending)
+            w.addErrback(log.err, 'Writing IRC logs')
+            w.addBoth(self.done_writing)
+        return d
+
+    def done_writing(self, _):
+        self.writing = False
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def take_pending(self):
+        with self.buffer_lock:
+            pending, self.buffers = self.buffers, {}
+            rotated, self.rotated = self.rotated, []
+            self.buffered = 0
+        return pending, rotated
+
+    def write_pending(self):
+        while True:
+            with self.file_lock:
+                pending, rotated = self.take_pending()
+                if not pending and not rotated:
+                    return
+                self.write_files(pending)
+                for path in rotated:
+                    self.compress_file(path)
+
+    def write_files(self, pending):
+        for path, lines in pending.iteritems():
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(path, 'a') as f:
+                f.write(''.join(lines))
+
+    def compress_file(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as src:
+            with gzip.open(path + '.gz', 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+        os.remove(path)
+
+    def close(self):
+        """
+        Stop the periodic flush and synchronously write out whatever is
+        left, after any write already in progress.
+        """
+
+        if self.flusher.running:
+            self.flusher.stop()
+        with self.file_lock:
+            pending, rotated = self.take_pending()
+            self.write_files(pending)
+            for path in rotated:
+                self.compress_file(path)
+
+
 class BotLogger(BaseBotPlugin):
     eterno_blacklist = {'#cassandra': ('evn',), '#cassandra-dev': ('evn',)}
 
+    # log name for events that don't belong to any one channel
+    server_log = '_server'
+
+    # needed to search the logs of channels one isn't in
+    search_priv = 'log_search'
+
     def __init__(self):
         self.per_channel_blacklist = \
                 dict((chan, set(blist))
                      for (chan, blist) in self.eterno_blacklist.iteritems())
+        # defaults to a directory named 'irclogs' next to the state file
+        self.log_dir = None
+        self.flush_size = 65536
+        self.flush_interval = 2.0
+        self.compress = False
+        self.index_logs = True
+        self.sink = None
+        self.index = None
+
+    def shutdown(self):
+        # being disabled, reloaded or shut down, so get everything onto disk
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
 
     def saveState(self):
-        return self.per_channel_blacklist
+        return {
+            'blacklist': self.per_channel_blacklist,
+            'log_dir': self.log_dir,
+            'flush_size': self.flush_size,
+            'flush_interval': self.flush_interval,
+            'compress': self.compress,
+            'index_logs': self.index_logs,
+        }
 
     def loadState(self, state):
-        self.per_channel_blacklist = state
+        if 'blacklist' not in state:
+            # older states were just the blacklist
+            state = {'blacklist': state}
+        self.per_channel_blacklist = state['blacklist']
+        self.log_dir = state.get('log_dir', self.log_dir)
+        self.flush_size = state.get('flush_size', self.flush_size)
+        self.flush_interval = state.get('flush_interval', self.flush_interval)
+        self.compress = state.get('compress', self.compress)
+        self.index_logs = state.get('index_logs', self.index_logs)
+
+    def get_sink(self, bot):
+        if self.sink is None:
+            logdir = self.log_dir
+            if logdir is None:
+                logdir = os.path.join(
+                    os.path.dirname(os.path.abspath(bot.service.statefile)),
+                    'irclogs')
+            if self.index_logs:
+                self.index = LogIndex(logdir, os.path.join(logdir, '.index'),
+                                      bot.service.reactor)
+            self.sink = ChannelLogSink(logdir, bot.service.reactor,
+                                       flush_size=self.flush_size,
+                                       flush_interval=self.flush_interval,
+                                       compress=self.compress,
+                                       indexer=self.index)
+        return self.sink
 
     def command_blacklist(self, bot, user, chan, args):
         bl = self.per_channel_blacklist.setdefault(chan, set())
@@ -68,24 +284,104 @@ class BotLogger(BaseBotPlugin):
             return bot.address_msg(user, chan, 'Blacklist for %s: %s'
                                                % (chan, natural_list(bl)))
 
-    def irclog(self, *a, **kw):
-        kw['mtype'] = 'irclog'
-        return log.msg(*a, **kw)
+    def command_grep(self, bot, user, chan, args):
+        return self.search_logs(bot, user, chan, args, 5,
+                'usage: grep [#channel] word [word2 [...]]. Shows the most recent'
+                ' logged lines containing all the given words.')
+
+    def command_lastlog(self, bot, user, chan, args):
+        return self.search_logs(bot, user, chan, args, 1,
+                'usage: lastlog [#channel] word [word2 [...]]. Shows the last'
+                ' logged line containing all the given words.')
+
+    def search_logs(self, bot, user, chan, args, limit, usage):
+        """
+        Search the logs for the channel where the command was given. Other
+        channels' logs can be searched by naming the channel in the first
+        argument, if the user is in that channel or has the search_priv
+        privilege; when asked privately without naming a channel, all
+        channel logs on this network are searched, for holders of
+        search_priv only. Nobody's private conversations are searched.
+        """
+
+        if args and args[0][:1] in '#&':
+            search_chan, args = args[0], args[1:]
+        elif chan == bot.nickname:
+            search_chan = None
+        else:
+            search_chan = chan
+        if not args:
+            return bot.address_msg(user, chan, usage)
+        if not self.may_search(bot, user, chan, search_chan):
+            where = 'all channels' if search_chan is None else search_chan
+            return bot.address_msg(user, chan, 'Searching the logs for %s requires'
+                                               ' being in it or privilege %s.'
+                                               % (where, self.search_priv))
+        self.get_sink(bot)
+        if self.index is None:
+            return bot.address_msg(user, chan, 'Log indexing is not enabled.')
+        if search_chan is None:
+            # this network's channel logs only
+            prefix = self.logname(bot, '').lower()
+            wanted = lambda relpath: (relpath.startswith(prefix) and
+                                      relpath[len(prefix):][:1] in '#&')
+        else:
+            chandir = log_dirname(self.logname(bot, search_chan)) + os.sep
+            wanted = lambda relpath: relpath.startswith(chandir)
+        d = self.index.search(args, wanted=wanted, limit=limit,
+                              ready=self.sink.flush())
+        d.addCallback(self.report_matches, bot, user, chan, args)
+        return d
+
+    def may_search(self, bot, user, chan, search_chan):
+        if search_chan is not None and search_chan.lower() == chan.lower():
+            return True
+        if bot.service.auth.userHas(user, self.search_priv):
+            return True
+        if search_chan is None:
+            return False
+        nick = user.split('!', 1)[0]
+        return search_chan in bot.channel_memberships.channels_of(nick)
+
+    def report_matches(self, matches, bot, user, chan, words):
+        if not matches:
+            return bot.address_msg(user, chan, 'No logged lines match %s.'
+                                               % natural_list(map(repr, words)))
+        output = []
+        for relpath, line in reversed(matches):
+            stamp, text = split_logline(line)
+            day = os.path.basename(relpath)[:-len('.log')]
+            output.append('%s %s %s' % (day, stamp, text))
+        return bot.address_msg(user, chan, '\n'.join(output))
+
+    def logname(self, bot, channel):
+        """
+        Logs for networks other than the default one are kept apart by
+        prefixing the network name (IRC channel names can't contain ':').
+        """
+
+        if bot.network in (None, bot.service.default_network):
+            return channel
+        return '%s:%s' % (bot.network, channel)
+
+    def irclog(self, bot, channel, line):
+        self.get_sink(bot).write(self.logname(bot, channel), line)
 
     def signedOn(self, bot):
-        self.irclog("Signed on as %s." % (bot.nickname,))
+        self.irclog(bot, self.server_log, "Signed on as %s." % (bot.nickname,))
 
     def joined(self, bot, channel):
-        self.irclog("Joined %s." % (channel,))
+        self.irclog(bot, channel, "Joined %s." % (channel,))
 
     def left(self, bot, channel):
-        self.irclog("Left %s." % (channel,))
+        self.irclog(bot, channel, "Left %s." % (channel,))
 
     def noticed(self, bot, user, chan, msg):
-        self.irclog("NOTICE -!- [%s] <%s> %s" % (chan, user, msg))
+        logname = self.server_log if chan == bot.nickname else chan
+        self.irclog(bot, logname, "NOTICE -!- [%s] <%s> %s" % (chan, user, msg))
 
     def modeChanged(self, bot, user, chan, being_set, modes, args):
-        self.irclog("MODE -!- %s %s modes %r in %r for %r" % (
+        self.irclog(bot, chan, "MODE -!- %s %s modes %r in %r for %r" % (
             user,
             'set' if being_set else 'unset',
             modes,
@@ -93,42 +389,57 @@ class BotLogger(BaseBotPlugin):
             args
         ))
 
+    def namesReceived(self, bot, chan, names):
+        if chan not in bot.channels:
+            return
+        ops = sum(1 for modes in names.itervalues() if 'o' in modes)
+        self.irclog(bot, chan, 'NAMES -!- %d users in %s (%d ops)'
+                               % (len(names), chan, ops))
+
     def kickedFrom(self, bot, chan, kicker, msg):
-        self.irclog('KICKED -!- from %s by %s [%s]' % (chan, kicker, msg))
+        self.irclog(bot, chan, 'KICKED -!- from %s by %s [%s]' % (chan, kicker, msg))
 
     def nickChanged(self, bot, nick):
-        self.irclog('NICKCHANGE -!- my nick changed to %s' % (nick,))
+        self.irclog(bot, self.server_log, 'NICKCHANGE -!- my nick changed to %s'
+                                          % (nick,))
 
     def userJoined(self, bot, user, chan):
-        self.irclog('%s joined %s' % (user, chan))
+        self.irclog(bot, chan, '%s joined %s' % (user, chan))
 
     def userLeft(self, bot, user, chan):
-        self.irclog('%s left %s' % (user, chan))
+        self.irclog(bot, chan, '%s left %s' % (user, chan))
 
     def userQuit(self, bot, user, msg):
-        self.irclog('%s quit [%s]' % (user, msg))
+        self.irclog(bot, self.server_log, '%s quit [%s]' % (user, msg))
 
     def userKicked(self, bot, kickee, chan, kicker, msg):
-        self.irclog('%s was kicked from %s by %s [%s]' % (kickee, chan, kicker, msg))
+        self.irclog(bot, chan, '%s was kicked from %s by %s [%s]'
+                               % (kickee, chan, kicker, msg))
 
     def topicUpdated(self, bot, user, chan, newtopic):
-        self.irclog('[%s] -!- topic changed by %s to %r' % (chan, user, newtopic))
+        self.irclog(bot, chan, '[%s] -!- topic changed by %s to %r'
+                               % (chan, user, newtopic))
 
     def userRenamed(self, bot, oldname, newname):
-        self.irclog('RENAME %s is now known as %s' % (oldname, newname))
+        self.irclog(bot, self.server_log, 'RENAME %s is now known as %s'
+                                          % (oldname, newname))
 
     def receivedMOTD(self, bot, motd):
-        self.irclog('MOTD %s' % (motd,))
+        self.irclog(bot, self.server_log, 'MOTD %s' % (motd,))
 
     def msg(self, bot, dest, msg, length=None):
-        self.irclog('[%s] <%s> %s' % (dest, bot.nickname, msg))
+        self.irclog(bot, dest, '[%s] <%s> %s' % (dest, bot.nickname, msg))
 
     def action(self, bot, user, chan, data):
         user = user.split('!', 1)[0]
+        if chan == bot.nickname:
+            chan = user
         if user not in self.per_channel_blacklist.get(chan, ()):
-            self.irclog('[%s] * %s %s' % (chan, user, data))
+            self.irclog(bot, chan, '[%s] * %s %s' % (chan, user, data))
 
     def privmsg(self, bot, user, channel, msg):
         user = user.split('!', 1)[0]
+        if channel == bot.nickname:
+            channel = user
         if user not in self.per_channel_blacklist.get(channel, ()):
-            self.irclog('[%s] <%s> %s' % (channel, user, msg))
+            self.irclog(bot, channel, '[%s] <%s> %s' % (channel, user, msg))
@@ -1,26 +1,52 @@
 from cassbot import BaseBotPlugin
-from twisted.web import client, error
 from twisted.internet import defer
 
 class BuildCommand(BaseBotPlugin):
     build_token = 'xxxxxxxxxxxx'
     build_url = 'http://hudson.zones.apache.org/hudson/job'
+    # seconds after triggering a job during which asking again does nothing
+    cooldown = 60
+    command_timeouts = {'build': 30}
+
+    def __init__(self):
+        # job -> time it was last triggered
+        self.last_triggered = {}
+
+    def loadState(self, conf):
+        self.build_url = conf.get('build_url', self.build_url)
+        self.build_token = conf.get('build_token', self.build_token)
+        self.cooldown = conf.get('cooldown', self.cooldown)
+
+    def saveState(self):
+        return {
+            'build_url': self.build_url,
+            'build_token': self.build_token,
+            'cooldown': self.cooldown,
+        }
 
     @defer.inlineCallbacks
     def command_build(self, bot, user, channel, args):
         if not args:
-            yield bot.msg(channel, "usage: build <buildname>")
+            # unprefixed, as it always was, but paced like everything else
+            yield bot.address_msg(user, channel, "usage: build <buildname>",
+                                  prefix=False)
             return
-        url = '%s/%s/polling?token=%s' % (self.build_url, args[0], self.build_token)
-        msg = "request sent!"
-        try:
-            res = yield client.getPage(url)
-        except error.Error, e:
-            # Hudson returns a 404 even when this request succeeds :/
-            if e.status == '404':
-                pass
-            else:
-                msg = str(e)
+        job = args[0]
+        now = bot.service.reactor.seconds()
+        last = self.last_triggered.get(job)
+        if last is not None and now - last < self.cooldown:
+            yield bot.address_msg(user, channel,
+                                  "%s was triggered %d seconds ago; not triggering"
+                                  " it again yet." % (job, now - last))
+            return
+        url = '%s/%s/polling?token=%s' % (self.build_url, job, self.build_token)
+        # concurrent requests for the same job are coalesced by the client,
+        # so everyone asking gets the answer to the one request
+        res = yield bot.service.http.request(url)
+        # Hudson returns a 404 even when this request succeeds :/
+        if 200 <= res.code < 300 or res.code == 404:
+            self.last_triggered[job] = bot.service.reactor.seconds()
+            msg = "request sent!"
+        else:
+            msg = str(res)
         bot.address_msg(user, channel, msg)
-
-
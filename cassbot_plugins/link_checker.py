@@ -1,7 +1,9 @@
 import re
+import json
 from itertools import chain
 from twisted.internet import defer
-from cassbot import BaseBotPlugin
+from twisted.python import log
+from cassbot import BaseBotPlugin, ExpiringLRU
 
 class CassandraLinkChecker(BaseBotPlugin):
     ticket_url_template = 'http://issues.apache.org/jira/browse/CASSANDRA-%d'
@@ -11,29 +13,141 @@ class CassandraLinkChecker(BaseBotPlugin):
     commit_re = re.compile(r'\br(\d+)\b')
     low_ticket_cutoff = 10
 
-    def checktickets(self, msg):
+    # when enabled, ticket links are posted along with the ticket's title
+    # and status, as fetched from this url
+    enrich_tickets = False
+    ticket_api_template = \
+        'https://issues.apache.org/jira/rest/api/2/issue/CASSANDRA-%d?fields=summary,status'
+    # seconds to wait for a ticket's details before posting the bare link
+    # anyway. the fetch goes on, so the details are there for next time
+    fetch_budget = 1.5
+    summary_cache_size = 2048
+    summary_ttl = 3600
+    # for tickets that couldn't be looked up
+    negative_ttl = 300
+    max_summary_len = 100
+
+    def __init__(self):
+        self.summaries = None
+
+    def loadState(self, conf):
+        for key in ('enrich_tickets', 'ticket_api_template', 'fetch_budget',
+                    'summary_cache_size', 'summary_ttl', 'negative_ttl'):
+            if key in conf:
+                setattr(self, key, conf[key])
+
+    def saveState(self):
+        return {
+            'enrich_tickets': self.enrich_tickets,
+            'ticket_api_template': self.ticket_api_template,
+            'fetch_budget': self.fetch_budget,
+            'summary_cache_size': self.summary_cache_size,
+            'summary_ttl': self.summary_ttl,
+            'negative_ttl': self.negative_ttl,
+        }
+
+    def referencePatterns(self):
+        return [('ticket', self.ticket_re.pattern),
+                ('commit', self.commit_re.pattern)]
+
+    def ticket_numbers(self, matches):
         tickets = []
-        for match in self.ticket_re.finditer(msg):
+        for match in matches:
             ticket = int(match.group(2))
             if ticket > self.low_ticket_cutoff or match.group(1) == '##':
                 if ticket not in tickets:
                     tickets.append(ticket)
-                    yield self.post_ticket(ticket)
+                    yield ticket
 
     def post_ticket(self, ticket_num):
         return self.ticket_url_template % (ticket_num,)
 
-    def checkrevs(self, msg):
-        for match in self.commit_re.finditer(msg):
+    def describe_ticket(self, bot, ticket_num):
+        """
+        Return a Deferred firing with the line to post for the ticket: its
+        link, with its title and status if they can be had (from the cache,
+        or a fetch) within fetch_budget seconds.
+        """
+
+        url = self.post_ticket(ticket_num)
+        reactor = bot.service.reactor
+        if self.summaries is None:
+            self.summaries = ExpiringLRU(self.summary_cache_size, self.summary_ttl,
+                                         reactor)
+        lookups = bot.service.metrics.counter(
+                'cassbot_ticket_lookups_total',
+                'Ticket detail lookups by CassandraLinkChecker, by result.',
+                ('result',))
+        cached = self.summaries.get(ticket_num, False)
+        if cached is not False:
+            lookups.inc(('cached',))
+            return defer.succeed(self.format_ticket(url, cached))
+        result = defer.Deferred()
+        timer = reactor.callLater(self.fetch_budget, result.callback, url)
+        def fetched(summary):
+            if timer.active():
+                timer.cancel()
+                lookups.inc(('fetched',))
+                result.callback(self.format_ticket(url, summary))
+            else:
+                lookups.inc(('late',))
+        self.fetch_ticket(bot, ticket_num).addCallback(fetched)
+        return result
+
+    def fetch_ticket(self, bot, ticket_num):
+        """
+        Fetch the ticket's (status, title) into the cache, or None if it
+        can't be had. Mentions of a ticket while it's being fetched share
+        the one request (see HTTPClient).
+        """
+
+        d = bot.service.http.request(self.ticket_api_template % (ticket_num,))
+        def got_response(res):
+            if res.code != 200:
+                if res.code != 404:
+                    log.msg('Looking up CASSANDRA-%d: %s' % (ticket_num, res))
+                return None
+            fields = json.loads(res.body)['fields']
+            return (fields['status']['name'], fields['summary'])
+        def failed(err):
+            log.msg('Looking up CASSANDRA-%d: %s' % (ticket_num, err.getErrorMessage()))
+            return None
+        def cache(summary):
+            if summary is None:
+                self.summaries.set(ticket_num, None, self.negative_ttl)
+            else:
+                self.summaries.set(ticket_num, summary)
+            return summary
+        d.addCallback(got_response)
+        d.addErrback(failed)
+        return d.addCallback(cache)
+
+    def format_ticket(self, url, summary):
+        if summary is None:
+            return url
+        status, title = summary
+        if len(title) > self.max_summary_len:
+            title = title[:self.max_summary_len - 3] + '...'
+        return (u'%s : %s [%s]' % (url, title, status)).encode('utf-8')
+
+    def checkrevs(self, matches):
+        for match in matches:
             commit = int(match.group(1))
             yield self.commit_url_template % (commit,)
 
     @defer.inlineCallbacks
-    def privmsg(self, bot, user, channel, msg):
-        for r in chain(self.checktickets(msg), self.checkrevs(msg)):
-            yield bot.address_msg(user, channel, r, prefix=False)
-
-    @defer.inlineCallbacks
-    def action(self, bot, user, channel, msg):
-        for r in chain(self.checktickets(msg), self.checkrevs(msg)):
-            yield bot.address_msg(user, channel, r, prefix=False)
+    def referencesFound(self, bot, user, channel, refs):
+        tickets = [m for (key, m) in refs if key == 'ticket']
+        commits = [m for (key, m) in refs if key == 'commit']
+        ticket_nums = [t for t in self.ticket_numbers(tickets)
+                       if not bot.recently_posted(user, channel, self.post_ticket(t))]
+        if self.enrich_tickets:
+            # look them all up at once, then post them in order
+            lines = [self.describe_ticket(bot, t) for t in ticket_nums]
+        else:
+            lines = [self.post_ticket(t) for t in ticket_nums]
+        revs = [r for r in self.checkrevs(commits)
+                if not bot.recently_posted(user, channel, r)]
+        for r in chain(lines, revs):
+            r = yield r
+            yield bot.address_msg(user, channel, r, prefix=False, lane='link')
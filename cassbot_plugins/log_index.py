@@ -0,0 +1,475 @@
+"""
+Incremental full-text index over the files written by BotLogger.
+
+New log lines are indexed into an in-memory table of term -> postings,
+where a posting is a (file id, byte offset) pair pointing at the line. Every
+so often that table is written out to an immutable segment file, which is
+memory-mapped for lookups, and once there are too many segments they are
+merged into one. Segment writes and merges happen in a worker thread.
+
+Segment layout (all little-endian):
+
+    header:     magic, number of terms, offset of the term directory
+    postings:   (file id, offset) pairs, grouped by term, in term order
+    terms:      the term strings, back to back
+    directory:  (term offset, term length, postings offset, posting count)
+                for each term, in term order, so it can be binary searched
+"""
+
+from __future__ import with_statement
+
+import os
+import re
+import gzip
+import mmap
+import heapq
+import struct
+from itertools import groupby
+from twisted.internet import defer, task, threads
+from twisted.python import log
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+MAGIC = 'CBIX'
+HEADER = struct.Struct('<4sIQ')
+POSTING = struct.Struct('<IQ')
+DIRENT = struct.Struct('<QIQI')
+
+term_re = re.compile(r'\w+')
+
+def line_terms(text):
+    return set(t for t in term_re.findall(text.lower()) if 1 < len(t) <= 64)
+
+def split_logline(line):
+    """
+    Split a line as written by ChannelLogSink into its timestamp and text.
+    """
+    if line[8:9] == ' ':
+        return line[:8], line[9:]
+    return '', line
+
+
+def write_segment(path, termlists):
+    """
+    Write a segment file from an iterable of (term, postings) pairs, in
+    term order.
+    """
+
+    tmp = path + '.tmp'
+    entries = []
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        pos = HEADER.size
+        for term, postings in termlists:
+            f.write(''.join(POSTING.pack(fid, off) for (fid, off) in postings))
+            entries.append((term, pos, len(postings)))
+            pos += POSTING.size * len(postings)
+        dirents = []
+        for term, post_off, count in entries:
+            f.write(term)
+            dirents.append(DIRENT.pack(pos, len(term), post_off, count))
+            pos += len(term)
+        f.write(''.join(dirents))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(entries), pos))
+    os.rename(tmp, path)
+
+def sorted_termlists(table):
+    for term in sorted(table):
+        yield term, sorted(set(table[term]))
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.nterms, self.dir_offset = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not an index segment' % (path,))
+
+    def entry(self, i):
+        return DIRENT.unpack_from(self.map, self.dir_offset + i * DIRENT.size)
+
+    def postings(self, post_off, count):
+        flat = struct.unpack_from('<' + 'IQ' * count, self.map, post_off)
+        return zip(flat[::2], flat[1::2])
+
+    def lookup(self, term):
+        lo, hi = 0, self.nterms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            term_off, term_len, post_off, count = self.entry(mid)
+            found = self.map[term_off:term_off + term_len]
+            if found < term:
+                lo = mid + 1
+            elif found > term:
+                hi = mid
+            else:
+                return self.postings(post_off, count)
+        return []
+
+    def iterterms(self):
+        for i in xrange(self.nterms):
+            term_off, term_len, post_off, count = self.entry(i)
+            yield self.map[term_off:term_off + term_len], \
+                  self.postings(post_off, count)
+
+
+def merge_segments(segments, path):
+    merged = heapq.merge(*[s.iterterms() for s in segments])
+    write_segment(path, ((term, sorted(set(p for (t, plist) in group for p in plist)))
+                         for (term, group) in groupby(merged, lambda tp: tp[0])))
+
+
+class LogIndex:
+    """
+    Index of the log files under logdir, kept in indexdir. Call add() for
+    each line as it is written, and search() to find lines.
+    """
+
+    memtable_limit = 100000
+    max_segments = 8
+    segment_interval = 300
+
+    def __init__(self, logdir, indexdir, reactor):
+        self.logdir = logdir
+        self.indexdir = indexdir
+        self.reactor = reactor
+
+        # file id -> path of the log file, relative to logdir
+        self.files = []
+        self.file_ids = {}
+        self.path_ids = {}
+        # file id -> how many bytes of the file the segments on disk cover
+        self.indexed = {}
+        self.segments = []
+        self.next_segment = 0
+
+        # term -> list of postings not yet written to a segment
+        self.memtable = {}
+        self.mem_postings = 0
+        self.mem_indexed = {}
+        # memtables in the middle of being written out
+        self.frozen = []
+        self.writing = False
+        self.merging = False
+        # once closed, writes and merges still running in worker threads
+        # are ignored when they finish
+        self.closed = False
+
+        if not os.path.isdir(indexdir):
+            os.makedirs(indexdir)
+        self.load_manifest()
+        self.catch_up()
+
+        self.flusher = task.LoopingCall(self.flush)
+        self.flusher.clock = reactor
+        self.flusher.start(self.segment_interval, now=False)
+
+    def manifest_path(self):
+        return os.path.join(self.indexdir, 'manifest')
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path(), 'rb') as f:
+                manifest = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            manifest = {}
+        self.files = manifest.get('files', [])
+        self.file_ids = dict((rel, fid) for (fid, rel) in enumerate(self.files))
+        self.indexed = manifest.get('indexed', {})
+        self.next_segment = manifest.get('next_segment', 0)
+        names = set(manifest.get('segments', ()))
+        for name in manifest.get('segments', ()):
+            try:
+                self.segments.append(Segment(os.path.join(self.indexdir, name)))
+            except (IOError, ValueError, struct.error):
+                log.err(None, 'Loading log index segment %s' % (name,))
+        # clear out anything left behind by an interrupted write or merge
+        for name in os.listdir(self.indexdir):
+            if name.startswith('seg-') and name not in names:
+                os.remove(os.path.join(self.indexdir, name))
+
+    def save_manifest(self):
+        tmp = self.manifest_path() + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({
+                'files': self.files,
+                'indexed': self.indexed,
+                'next_segment': self.next_segment,
+                'segments': [s.name for s in self.segments],
+            }, f, -1)
+        os.rename(tmp, self.manifest_path())
+
+    def file_id(self, relpath):
+        try:
+            return self.file_ids[relpath]
+        except KeyError:
+            fid = self.file_ids[relpath] = len(self.files)
+            self.files.append(relpath)
+            return fid
+
+    def new_segment_path(self):
+        name = 'seg-%08d' % (self.next_segment,)
+        self.next_segment += 1
+        return os.path.join(self.indexdir, name)
+
+    def add(self, path, offset, line):
+        """
+        Index a line which is being written to the log file at path, at the
+        given offset.
+        """
+
+        try:
+            fid = self.path_ids[path]
+        except KeyError:
+            fid = self.path_ids[path] = \
+                    self.file_id(os.path.relpath(path, self.logdir))
+        terms = line_terms(split_logline(line)[1])
+        for term in terms:
+            self.memtable.setdefault(term, []).append((fid, offset))
+        self.mem_postings += len(terms)
+        self.mem_indexed[fid] = offset + len(line)
+        if self.mem_postings >= self.memtable_limit:
+            self.flush()
+
+    def flush(self):
+        """
+        Start writing the current memtable out to a new segment.
+        """
+
+        if self.writing or self.closed or not self.memtable:
+            return
+        frozen = (self.memtable, self.mem_indexed)
+        self.memtable = {}
+        self.mem_postings = 0
+        self.mem_indexed = {}
+        self.frozen.append(frozen)
+        self.writing = True
+        path = self.new_segment_path()
+        d = threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(),
+                                      write_segment, path,
+                                      sorted_termlists(frozen[0]))
+        d.addCallback(lambda _: self.memtable_written(path, frozen))
+        d.addErrback(log.err, 'Writing log index segment')
+        d.addBoth(self.done_writing)
+
+    def done_writing(self, _):
+        self.writing = False
+        if self.mem_postings >= self.memtable_limit:
+            self.flush()
+
+    def memtable_written(self, path, frozen):
+        if self.closed:
+            # close() has written it out itself
+            return
+        self.segment_written(path, frozen[1])
+        self.frozen.remove(frozen)
+
+    def segment_written(self, path, indexed):
+        if self.closed:
+            # what this covered gets indexed again by catch_up() next time
+            return
+        self.segments.append(Segment(path))
+        for fid, upto in indexed.iteritems():
+            self.indexed[fid] = max(self.indexed.get(fid, 0), upto)
+        self.save_manifest()
+        self.maybe_merge()
+
+    def maybe_merge(self):
+        if self.merging or len(self.segments) <= self.max_segments:
+            return
+        self.merging = True
+        to_merge = list(self.segments)
+        path = self.new_segment_path()
+        d = threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(),
+                                      merge_segments, to_merge, path)
+        d.addCallback(lambda _: self.segments_merged(to_merge, path))
+        d.addErrback(log.err, 'Merging log index segments')
+        d.addBoth(self.done_merging)
+
+    def segments_merged(self, merged, path):
+        if self.closed:
+            # the manifest still lists the old segments
+            return
+        self.segments = [Segment(path)] + self.segments[len(merged):]
+        self.save_manifest()
+        # searches still running against the old segments keep their maps
+        for s in merged:
+            os.remove(s.path)
+
+    def done_merging(self, _):
+        self.merging = False
+
+    def catch_up(self):
+        """
+        Index anything in logdir the segments don't cover yet: logs from
+        before indexing was turned on, or lines that were still in the
+        memtable when the bot last stopped.
+        """
+
+        ranges = []
+        for dirpath, dirnames, filenames in os.walk(self.logdir):
+            dirnames[:] = [d for d in dirnames
+                           if os.path.join(dirpath, d) != self.indexdir]
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith('.log'):
+                    relpath = os.path.relpath(path, self.logdir)
+                    start = self.indexed.get(self.file_ids.get(relpath), 0)
+                    size = os.path.getsize(path)
+                    if size > start:
+                        ranges.append((self.file_id(relpath), path, start, size))
+                elif filename.endswith('.log.gz'):
+                    relpath = os.path.relpath(path, self.logdir)[:-3]
+                    if relpath not in self.file_ids:
+                        ranges.append((self.file_id(relpath), path, 0, None))
+        if not ranges:
+            return
+        log.msg('Indexing %d log files' % (len(ranges),))
+        path = self.new_segment_path()
+        d = threads.deferToThreadPool(self.reactor, self.reactor.getThreadPool(),
+                                      self.index_ranges, ranges, path)
+        d.addCallback(lambda indexed: self.segment_written(path, indexed))
+        d.addErrback(log.err, 'Indexing existing log files')
+
+    def index_ranges(self, ranges, path):
+        table = {}
+        indexed = {}
+        for fid, filepath, start, end in ranges:
+            opener = gzip.open if filepath.endswith('.gz') else open
+            with opener(filepath, 'rb') as f:
+                f.seek(start)
+                offset = start
+                for line in f:
+                    if end is not None and offset >= end:
+                        break
+                    for term in line_terms(split_logline(line)[1]):
+                        table.setdefault(term, []).append((fid, offset))
+                    offset += len(line)
+            indexed[fid] = offset
+        write_segment(path, sorted_termlists(table))
+        return indexed
+
+    def search(self, words, wanted=None, limit=5, ready=None):
+        """
+        Find the most recent lines containing all of the given words
+        (case-insensitively). If given, wanted is called with the relative
+        path of each log file and should say whether to include it.
+
+        Only lines indexed before the call are considered, but if ready is
+        given (say, a Deferred for pending lines reaching the disk), the
+        files aren't read until it fires.
+
+        Return a Deferred firing with up to limit (relative path, line)
+        pairs, newest first.
+        """
+
+        terms = set()
+        for w in words:
+            terms.update(line_terms(w))
+        if not terms:
+            return defer.succeed([])
+        # anything not yet on disk has to be gathered on the reactor thread
+        unwritten = {}
+        for term in terms:
+            postings = unwritten[term] = list(self.memtable.get(term, ()))
+            for table, indexed in self.frozen:
+                postings.extend(table.get(term, ()))
+        segments = list(self.segments)
+        files = list(self.files)
+        if ready is None:
+            ready = defer.succeed(None)
+        return ready.addCallback(lambda _: threads.deferToThreadPool(
+                self.reactor, self.reactor.getThreadPool(), self.run_search,
+                words, terms, unwritten, segments, files, wanted, limit))
+
+    def run_search(self, words, terms, unwritten, segments, files, wanted, limit):
+        candidates = None
+        for term in terms:
+            found = set(unwritten[term])
+            for s in segments:
+                found.update(s.lookup(term))
+            candidates = found if candidates is None else candidates & found
+            if not candidates:
+                return []
+        if wanted is not None:
+            candidates = [c for c in candidates if wanted(files[c[0]])]
+        # log files are named by date, so this is newest first
+        candidates = sorted(candidates, reverse=True,
+                            key=lambda (fid, off): (os.path.basename(files[fid]), off))
+        needles = [w.lower() for w in words]
+        results = []
+        unpacked = {}
+        for fid, offset in candidates:
+            line = self.read_line(files[fid], offset, unpacked)
+            if line and all(n in line.lower() for n in needles):
+                results.append((files[fid], line))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def read_line(self, relpath, offset, unpacked=None):
+        """
+        Read the line at offset in a log file. Compressed files can't be
+        seeked into without decompressing everything before the offset, so
+        if a dict is given as unpacked, each compressed file is decompressed
+        into it the first time, and later lines are read from there. That
+        makes a search over a compressed day cost one read of the whole file
+        rather than one per hit.
+        """
+
+        path = os.path.join(self.logdir, relpath)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            if unpacked is not None and relpath in unpacked:
+                data = unpacked[relpath]
+            else:
+                try:
+                    with gzip.open(path + '.gz', 'rb') as gz:
+                        data = gz.read()
+                except IOError:
+                    return None
+                if unpacked is not None:
+                    unpacked[relpath] = data
+            end = data.find('\n', offset)
+            return data[offset:end if end >= 0 else len(data)]
+        with f:
+            f.seek(offset)
+            return f.readline().rstrip('\n')
+
+    def close(self):
+        """
+        Write out whatever is still in memory, synchronously, including
+        memtables a worker thread is still busy writing. Those writes, and
+        any merge in progress, are left to finish on their own; their
+        results are ignored, and the files they leave behind are cleaned up
+        when the index is next loaded.
+        """
+
+        self.closed = True
+        if self.flusher.running:
+            self.flusher.stop()
+        pending = self.frozen + [(self.memtable, self.mem_indexed)]
+        self.frozen = []
+        self.memtable = {}
+        self.mem_postings = 0
+        self.mem_indexed = {}
+        table = {}
+        for memtable, indexed in pending:
+            for term, postings in memtable.iteritems():
+                table.setdefault(term, []).extend(postings)
+        if table:
+            path = self.new_segment_path()
+            write_segment(path, sorted_termlists(table))
+            self.segments.append(Segment(path))
+        for memtable, indexed in pending:
+            for fid, upto in indexed.iteritems():
+                self.indexed[fid] = max(self.indexed.get(fid, 0), upto)
+        self.save_manifest()
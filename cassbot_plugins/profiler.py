@@ -0,0 +1,125 @@
+import os
+import re
+import time
+import pstats
+import cProfile
+import cassbot_plugins
+from cassbot import BaseBotPlugin, require_priv, blocking
+from twisted.python import log
+
+# how pstats names the reactor's wait for events, which is idle time
+idle_re = re.compile(r"<method '(poll|select|control)' of ")
+
+class Profiler(BaseBotPlugin):
+    """
+    Runs cProfile against the reactor thread for a while, on request, and
+    reports where the time went, grouped by plugin.
+    """
+
+    max_seconds = 600
+    default_top = 10
+
+    def __init__(self):
+        self.profile = None
+        self.finish_call = None
+
+    def shutdown(self):
+        # being disabled, reloaded or shut down; don't leave the profiler
+        # hooked in
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile = None
+            self.finish_call.cancel()
+            self.finish_call = None
+
+    @require_priv('admin')
+    def command_profile(self, bot, user, channel, args):
+        try:
+            seconds = float(args[0])
+            top = int(args[1]) if len(args) > 1 else self.default_top
+            if len(args) > 2 or not 0 < seconds <= self.max_seconds or top < 1:
+                raise ValueError
+        except (IndexError, ValueError):
+            return bot.address_msg(user, channel,
+                    'usage: profile <seconds> [top-n]. Profiles the reactor thread'
+                    ' for up to %d seconds, then shows the top n functions by time'
+                    ' spent in them, grouped by module.' % self.max_seconds)
+        if self.profile is not None:
+            return bot.address_msg(user, channel, 'Already profiling; try again later.')
+        self.profile = cProfile.Profile()
+        self.finish_call = bot.service.reactor.callLater(
+                seconds, self.finish, bot, user, channel, seconds, top)
+        self.profile.enable()
+        return bot.address_msg(user, channel, 'Profiling for %s seconds.' % seconds)
+
+    def finish(self, bot, user, channel, seconds, top):
+        prof, self.profile = self.profile, None
+        self.finish_call = None
+        # has to happen in the thread being profiled
+        prof.disable()
+        plugin_names = {}
+        for pname, p in bot.service.pluginmap.iteritems():
+            plugin_names.setdefault(type(p).__module__, []).append(pname)
+        d = self.write_report(bot, user, channel, prof, seconds, top, plugin_names)
+        d.addErrback(log.err, 'Reporting on the profile')
+        return d
+
+    @blocking
+    def write_report(self, bot, user, channel, prof, seconds, top, plugin_names):
+        # sorting through the stats and saving them can take a while for a
+        # long profile, so that's done in a worker thread
+        dumpdir = os.path.dirname(os.path.abspath(bot.service.statefile))
+        dumpfile = os.path.join(dumpdir, time.strftime('cassbot-profile-%Y%m%d-%H%M%S.pstats'))
+        stats = pstats.Stats(prof)
+        try:
+            stats.dump_stats(dumpfile)
+        except (IOError, OSError), e:
+            log.msg('Could not save profile to %s: %s' % (dumpfile, e))
+            dumpfile = None
+        idle = sum(v[2] for (k, v) in stats.stats.iteritems()
+                   if idle_re.match(k[2]))
+        output = ['Profiled %s seconds: %d calls, busy for %.2fs, idle for %.2fs.'
+                  % (seconds, stats.total_calls, stats.total_tt - idle, idle)]
+        output.extend(self.report(plugin_names, stats, top))
+        if dumpfile is not None:
+            output.append('Full stats saved to %s' % dumpfile)
+        return bot.address_msg(user, channel, '\n'.join(output))
+
+    def report(self, plugin_names, stats, top):
+        """
+        Take the top functions by internal time, and group them by the
+        plugin (or other module) they belong to. plugin_names maps module
+        names to the names of the plugins loaded from them.
+        """
+
+        plugin_dirs = [os.path.abspath(d) for d in cassbot_plugins.__path__]
+
+        funcs = sorted((item for item in stats.stats.iteritems()
+                        if not idle_re.match(item[0][2])),
+                       key=lambda item: item[1][2], reverse=True)
+        groups = {}
+        order = []
+        for (filename, lineno, funcname), (cc, nc, tt, ct, callers) in funcs[:top]:
+            group = self.group_name(filename, plugin_dirs, plugin_names)
+            if group not in groups:
+                groups[group] = []
+                order.append(group)
+            groups[group].append('%s %.3fs/%d calls' % (funcname, tt, nc))
+        return ['%s: %s' % (g, ', '.join(groups[g])) for g in order]
+
+    def group_name(self, filename, plugin_dirs, plugin_names):
+        dirname, basename = os.path.split(os.path.abspath(filename))
+        modname = os.path.splitext(basename)[0]
+        if dirname in plugin_dirs:
+            names = plugin_names.get('cassbot_plugins.' + modname)
+            if names:
+                return '/'.join(sorted(names))
+            return 'cassbot_plugins.' + modname
+        if basename.startswith('cassbot') and basename.endswith('.py'):
+            return modname
+        if '/twisted/' in filename:
+            return 'twisted'
+        if filename.startswith('~') or filename.startswith('<'):
+            # builtins, as pstats names them
+            return 'builtins'
+        return modname
@@ -20,14 +20,17 @@ class ZendeskLinkChecker(BaseBotPlugin):
             'ticket_letter': self.ticket_letter
         }
 
-    def check_for_references(self, msg):
-        for match in self.sprt_ticket_re.finditer(msg):
+    def referencePatterns(self):
+        return [('ticket', self.sprt_ticket_re.pattern)]
+
+    def check_for_references(self, matches):
+        for match in matches:
             ticket = int(match.group(1))
             yield '%s%d' % (self.tickets_url, ticket)
 
     @defer.inlineCallbacks
-    def privmsg(self, bot, user, channel, msg):
-        for r in self.check_for_references(msg):
-            yield bot.address_msg(user, channel, r, prefix=False)
-
-    action = privmsg
+    def referencesFound(self, bot, user, channel, refs):
+        for r in self.check_for_references(m for (key, m) in refs):
+            if bot.recently_posted(user, channel, r):
+                continue
+            yield bot.address_msg(user, channel, r, prefix=False, lane='link')
@@ -0,0 +1,366 @@
+# cassbot state storage
+
+"""
+Where CassBotService keeps its state between runs. A store holds three
+kinds of things:
+
+ - settings: the top-level entries of the service's state dict
+   ('nickname', 'channels', 'networks', ...), each pickled on its own
+ - plugin states: whatever each plugin's saveState() returned, one entry
+   per plugin, only read when that plugin is enabled (see PluginStateMap)
+ - the AuthMap, as (channel, privilege, member) rows, with '' as the
+   channel for global privileges
+
+Saving only writes the entries that changed since they were loaded or
+last saved. SQLiteStateStore is the one normally used; PickleStateStore
+reads and writes the old format, where the whole state dict was pickled
+into one file, and open_state_store() migrates those to SQLite.
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import shutil
+import sqlite3
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from twisted.python import log
+
+sqlite_magic = 'SQLite format 3\0'
+
+
+def auth_rows(authstate):
+    """
+    Turn an AuthMap.saveState() result into a set of (channel, privilege,
+    member) rows.
+    """
+
+    rows = set()
+    memberships, per_channel = authstate
+    for priv, members in memberships.iteritems():
+        rows.update(('', priv, m) for m in members)
+    for channel, (chan_memberships, unused) in per_channel.iteritems():
+        for priv, members in chan_memberships.iteritems():
+            rows.update((channel, priv, m) for m in members)
+    return rows
+
+def auth_state(rows):
+    """
+    The reverse of auth_rows().
+    """
+
+    memberships = {}
+    per_channel = {}
+    for channel, priv, member in rows:
+        if channel:
+            chan_memberships = per_channel.setdefault(channel, ({}, {}))[0]
+            chan_memberships.setdefault(priv, set()).add(member)
+        else:
+            memberships.setdefault(priv, set()).add(member)
+    return (memberships, per_channel)
+
+
+class StateStore:
+    """
+    Base class for state stores. Subclasses implement the read_* and
+    write methods; this keeps track of what was last read or written, so
+    save() can hand write() only what changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # ('setting' or 'plugin', name) -> pickled value, as last read or
+        # written (kept pickled, since the values themselves may be changed
+        # in place)
+        self.known = {}
+        self.known_auth = set()
+
+    def load_settings(self):
+        settings = {}
+        for key, blob in self.read_settings():
+            self.known[('setting', key)] = blob
+            settings[key] = pickle.loads(blob)
+        return settings
+
+    def load_plugin(self, pname):
+        """
+        Return the saved state for the named plugin, or raise KeyError.
+        """
+
+        blob = self.read_plugin(pname)
+        if blob is None:
+            raise KeyError(pname)
+        self.known[('plugin', pname)] = blob
+        return pickle.loads(blob)
+
+    def load_auth(self):
+        self.known_auth = set(self.read_auth())
+        return auth_state(self.known_auth)
+
+    def save(self, settings, plugins, authstate):
+        """
+        Save the given settings, the given plugin states (a dict of plugin
+        name to state, or to None for plugins whose state should be
+        removed) and the AuthMap state, writing only what changed. Settings
+        not given are removed.
+        """
+
+        changes = []
+        for key, value in settings.iteritems():
+            changes.append((('setting', key), value))
+        for pname, value in plugins.iteritems():
+            changes.append((('plugin', pname), value))
+        puts = {}
+        deletes = set(k for k in self.known if k[0] == 'setting' and k[1] not in settings)
+        for k, value in changes:
+            if value is None and k[0] == 'plugin':
+                if k in self.known or self.read_plugin(k[1]) is not None:
+                    deletes.add(k)
+                continue
+            if k in self.known and self.unchanged(self.known[k], value):
+                continue
+            puts[k] = pickle.dumps(value, 2)
+        rows = auth_rows(authstate)
+        added = rows - self.known_auth
+        removed = self.known_auth - rows
+        if not (puts or deletes or added or removed):
+            return
+        self.write(puts, deletes, added, removed)
+        self.known.update(puts)
+        for k in deletes:
+            self.known.pop(k, None)
+        self.known_auth = rows
+
+    def unchanged(self, blob, value):
+        # pickles of equal values aren't always the same bytes, so compare
+        # the values themselves. values without __eq__ always get written
+        try:
+            return pickle.loads(blob) == value
+        except Exception:
+            return False
+
+    def close(self):
+        pass
+
+
+class SQLiteStateStore(StateStore):
+    schema = (
+        'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value BLOB)',
+        'CREATE TABLE IF NOT EXISTS plugins (name TEXT PRIMARY KEY, state BLOB)',
+        'CREATE TABLE IF NOT EXISTS auth (channel TEXT, priv TEXT, member TEXT,'
+        ' PRIMARY KEY (channel, priv, member))',
+    )
+
+    def __init__(self, path):
+        StateStore.__init__(self, path)
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            for statement in self.schema:
+                self.db.execute(statement)
+
+    def is_empty(self):
+        return self.db.execute('SELECT 1 FROM settings LIMIT 1').fetchone() is None
+
+    def read_settings(self):
+        return [(key, str(value)) for (key, value)
+                in self.db.execute('SELECT key, value FROM settings')]
+
+    def read_plugin(self, pname):
+        row = self.db.execute('SELECT state FROM plugins WHERE name = ?',
+                              (pname,)).fetchone()
+        return None if row is None else str(row[0])
+
+    def read_auth(self):
+        return self.db.execute('SELECT channel, priv, member FROM auth')
+
+    def write(self, puts, deletes, added, removed):
+        tables = {'setting': ('settings', 'key', 'value'),
+                  'plugin': ('plugins', 'name', 'state')}
+        with self.db:
+            for (kind, name), blob in puts.iteritems():
+                table, keycol, valcol = tables[kind]
+                self.db.execute('INSERT OR REPLACE INTO %s (%s, %s) VALUES (?, ?)'
+                                % (table, keycol, valcol), (name, sqlite3.Binary(blob)))
+            for kind, name in deletes:
+                table, keycol, valcol = tables[kind]
+                self.db.execute('DELETE FROM %s WHERE %s = ?' % (table, keycol), (name,))
+            self.db.executemany('DELETE FROM auth WHERE channel = ? AND priv = ?'
+                                ' AND member = ?', removed)
+            self.db.executemany('INSERT INTO auth (channel, priv, member)'
+                                ' VALUES (?, ?, ?)', added)
+
+    def close(self):
+        self.db.close()
+
+
+class PickleStateStore(StateStore):
+    """
+    The old format: the whole state dict, with the plugin states in
+    'plugins' and the AuthMap in 'auth_map', pickled into one file. Every
+    save rewrites all of it.
+    """
+
+    def __init__(self, path):
+        StateStore.__init__(self, path)
+        try:
+            with open(path, 'rb') as f:
+                self.state = pickle.load(f)
+        except IOError:
+            self.state = {}
+
+    def is_empty(self):
+        return not self.state
+
+    def read_settings(self):
+        return [(key, pickle.dumps(value, 2)) for (key, value) in self.state.iteritems()
+                if key not in ('plugins', 'auth_map')]
+
+    def read_plugin(self, pname):
+        try:
+            return pickle.dumps(self.state.get('plugins', {})[pname], 2)
+        except KeyError:
+            return None
+
+    def read_auth(self):
+        authstate = self.state.get('auth_map')
+        return auth_rows(authstate) if authstate is not None else ()
+
+    def write(self, puts, deletes, added, removed):
+        plugins = self.state.setdefault('plugins', {})
+        for (kind, name), blob in puts.iteritems():
+            if kind == 'setting':
+                self.state[name] = pickle.loads(blob)
+            else:
+                plugins[name] = pickle.loads(blob)
+        for kind, name in deletes:
+            (self.state if kind == 'setting' else plugins).pop(name, None)
+        self.state['auth_map'] = auth_state(
+                (set(auth_rows(self.state['auth_map'])) if 'auth_map' in self.state
+                 else set()) - removed | added)
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump(self.state, f, -1)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def open_state_store(path):
+    """
+    Open the SQLite state store at path, first migrating it from the old
+    pickle format if that's what is there. The old file is kept, with
+    '.pickle' added to its name. The new database is built beside it and
+    only then moved into its place, so if the migration fails, the old
+    file is still there to try again with.
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(len(sqlite_magic))
+    except IOError:
+        head = None
+    if not head or head == sqlite_magic:
+        return SQLiteStateStore(path)
+    old = PickleStateStore(path)
+    backup = path + '.pickle'
+    tmp = path + '.tmp'
+    log.msg('Migrating state in %s to SQLite; the old file will be kept as %s'
+            % (path, backup))
+    # left over from an earlier attempt, maybe
+    for leftover in (tmp, tmp + '-wal', tmp + '-shm'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    store = SQLiteStateStore(tmp)
+    try:
+        store.save(old.load_settings(), old.state.get('plugins', {}), old.load_auth())
+    finally:
+        store.close()
+    shutil.copy2(path, backup)
+    os.rename(tmp, path)
+    return SQLiteStateStore(path)
+
+
+def set_aside(path):
+    """
+    Move the state file at path, and any SQLite -wal and -shm files that
+    go with it, out of the way, keeping them with '.bad-<time>' added to
+    their names. Return the new name of the state file.
+    """
+
+    bad = '%s.bad-%s' % (path, time.strftime('%Y%m%d-%H%M%S'))
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.rename(path + suffix, bad + suffix)
+    return bad
+
+
+class PluginStateMap:
+    """
+    Stands in for the dict of plugin states in the service's state, as
+    state['plugins'], reading each plugin's state from the store only when
+    it's asked for. Remembers which plugins' states were set or removed,
+    for saving.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # plugin name -> state, or None if removed
+        self.states = {}
+        self.dirty = set()
+
+    def __getitem__(self, pname):
+        if pname not in self.states:
+            try:
+                self.states[pname] = self.store.load_plugin(pname)
+            except KeyError:
+                self.states[pname] = None
+        value = self.states[pname]
+        if value is None:
+            raise KeyError(pname)
+        return value
+
+    def get(self, pname, default=None):
+        try:
+            return self[pname]
+        except KeyError:
+            return default
+
+    def __contains__(self, pname):
+        return self.get(pname) is not None
+
+    def __setitem__(self, pname, value):
+        self.states[pname] = value
+        self.dirty.add(pname)
+
+    def pop(self, pname, *default):
+        try:
+            value = self[pname]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        self.states[pname] = None
+        self.dirty.add(pname)
+        return value
+
+    def changes(self):
+        """
+        Return a dict of the plugin states set or removed (as None) since
+        they were last marked saved.
+        """
+
+        return dict((pname, self.states[pname]) for pname in self.dirty)
+
+    def saved(self, changes):
+        """
+        Mark changes (as returned by changes()) as saved, once the store
+        has them. Plugins whose state was set again in the meantime stay
+        dirty.
+        """
+
+        for pname, value in changes.iteritems():
+            if self.states.get(pname) is value:
+                self.dirty.discard(pname)
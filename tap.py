@@ -8,10 +8,19 @@ nickname = os.environ.get('nickname', 'CassBotJr')
 channels = shlex.split(os.environ.get('channels', ''))
 server = os.environ.get('server', 'tcp:host=irc.freenode.net:port=6667')
 statefile = os.environ.get('statefile', 'cassbot.state.db')
+# extra networks, as name=endpoint. their channels go in 'channels' as
+# name:#channel
+networks = [n.split('=', 1) for n in shlex.split(os.environ.get('networks', ''))]
 
 application = service.Application(nickname)
-bot = CassBotService(server, nickname=nickname, init_channels=channels,
+bot = CassBotService(server, nickname=nickname,
+                     init_channels=[c for c in channels if ':' not in c],
                      statefile=statefile)
+bot.metrics_endpoint = os.environ.get('metrics') or None
+for netname, netserver in networks:
+    bot.add_network(netname, netserver,
+                    channels=[c.split(':', 1)[1] for c in channels
+                              if c.startswith(netname + ':')])
 bot.setServiceParent(application)
 
 def setup():
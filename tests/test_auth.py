@@ -0,0 +1,59 @@
+from twisted.trial import unittest
+from cassbot import AuthMap
+
+
+class AuthMapTests(unittest.TestCase):
+    def setUp(self):
+        self.auth = AuthMap()
+
+    def test_literal_and_wildcard_masks(self):
+        self.auth.addPriv('alice!~a@example.com', 'op')
+        self.auth.addPriv('*!*@*.trusted.org', 'op')
+        self.assertTrue(self.auth.userHas('alice!~a@example.com', 'op'))
+        self.assertFalse(self.auth.userHas('alice!~a@example.net', 'op'))
+        self.assertTrue(self.auth.userHas('bob!b@host.trusted.org', 'op'))
+        self.assertFalse(self.auth.userHas('bob!b@host.trusted.org', 'admin'))
+
+    def test_nested_privileges(self):
+        self.auth.addPriv('admin', 'op')
+        self.auth.addPriv('op', 'voice')
+        self.auth.addPriv('carol!c@h', 'admin')
+        self.assertTrue(self.auth.userHas('carol!c@h', 'voice'))
+        self.assertFalse(self.auth.userHas('dave!d@h', 'voice'))
+
+    def test_cycles(self):
+        self.auth.addPriv('b', 'a')
+        self.auth.addPriv('a', 'b')
+        self.auth.addPriv('erin!e@h', 'b')
+        self.assertTrue(self.auth.userHas('erin!e@h', 'a'))
+
+    def test_changes_invalidate_cached_decisions(self):
+        self.auth.addPriv('op', 'voice')
+        self.assertFalse(self.auth.userHas('frank!f@h', 'voice'))
+        self.auth.addPriv('frank!f@h', 'op')
+        self.assertTrue(self.auth.userHas('frank!f@h', 'voice'))
+        self.auth.removePriv('frank!f@h', 'op')
+        self.assertFalse(self.auth.userHas('frank!f@h', 'voice'))
+        # removing something that isn't there is fine
+        self.auth.removePriv('nobody', 'nothing')
+
+    def test_decision_cache_is_bounded(self):
+        self.auth.decision_cache_size = 3
+        self.auth.addPriv('*!*@*', 'any')
+        for n in range(10):
+            self.assertTrue(self.auth.userHas('u%d!u@h' % n, 'any'))
+        self.assertTrue(len(self.auth.decisions) <= 3)
+
+    def test_channel_privileges(self):
+        self.auth.addChannelPriv('#a', 'gina!g@h', 'op')
+        self.assertTrue(self.auth.channelUserHas('#a', 'gina!g@h', 'op'))
+        self.assertFalse(self.auth.channelUserHas('#b', 'gina!g@h', 'op'))
+        self.assertFalse(self.auth.userHas('gina!g@h', 'op'))
+
+    def test_save_and_load(self):
+        self.auth.addPriv('op', 'voice')
+        self.auth.addChannelPriv('#a', 'hank!h@h', 'op')
+        other = AuthMap()
+        other.loadState(self.auth.saveState())
+        self.assertTrue(other.channelUserHas('#a', 'hank!h@h', 'op'))
+        self.assertEqual(set(other.whoHas('voice')), set(['op']))
@@ -0,0 +1,165 @@
+import os
+import gzip
+import time
+from twisted.internet import defer, reactor, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import CassBotService
+from cassbot_plugins.bot_logger import ChannelLogSink
+
+
+class FakeIndex:
+    def __init__(self):
+        self.searches = []
+
+    def search(self, words, wanted=None, limit=5, ready=None):
+        self.searches.append((words, wanted))
+        return defer.succeed([])
+
+    def close(self):
+        pass
+
+
+class RecordingIndexer:
+    def __init__(self):
+        self.added = []
+
+    def add(self, path, offset, line):
+        self.added.append((path, offset, line))
+
+
+class ChannelLogSinkTests(unittest.TestCase):
+    def setUp(self):
+        self.logdir = self.mktemp()
+        self.clock = task.Clock()
+        self.clock.advance(time.mktime((2026, 10, 15, 23, 59, 0, 0, 0, -1)))
+
+    def sink(self, **kw):
+        # never fills up or flushes by itself; close() writes it all out
+        return ChannelLogSink(self.logdir, self.clock, flush_size=1 << 20,
+                              flush_interval=3600, **kw)
+
+    def read(self, *parts):
+        path = os.path.join(self.logdir, *parts)
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            return f.read()
+
+    def write_across_midnight(self, sink):
+        sink.write('#Chan', 'one')
+        sink.write('#other', 'elsewhere')
+        self.clock.advance(120)
+        sink.write('#Chan', 'two')
+        sink.close()
+
+    def test_rotates_by_day(self):
+        self.write_across_midnight(self.sink())
+        self.assertEqual(sorted(os.listdir(os.path.join(self.logdir, '#chan'))),
+                         ['2026-10-15.log', '2026-10-16.log'])
+        self.assertEqual(self.read('#chan', '2026-10-15.log'), '23:59:00 one\n')
+        self.assertEqual(self.read('#chan', '2026-10-16.log'), '00:01:00 two\n')
+        self.assertEqual(self.read('#other', '2026-10-15.log'), '23:59:00 elsewhere\n')
+
+    def test_compresses_finished_days(self):
+        self.write_across_midnight(self.sink(compress=True))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.logdir, '#chan'))),
+                         ['2026-10-15.log.gz', '2026-10-16.log'])
+        self.assertEqual(self.read('#chan', '2026-10-15.log.gz'), '23:59:00 one\n')
+        # #other hasn't logged anything on the new day yet
+        self.assertEqual(os.listdir(os.path.join(self.logdir, '#other')),
+                         ['2026-10-15.log'])
+
+    def test_indexer_offsets(self):
+        indexer = RecordingIndexer()
+        sink = self.sink(indexer=indexer)
+        sink.write('#chan', 'one')
+        sink.write('#chan', 'two')
+        sink.close()
+        path = os.path.join(self.logdir, '#chan', '2026-10-15.log')
+        self.assertEqual(indexer.added, [(path, 0, '23:59:00 one\n'),
+                                         (path, 13, '23:59:00 two\n')])
+        # a new sink appends, and picks up from the end of the file
+        sink = self.sink(indexer=indexer)
+        sink.write('#chan', 'three')
+        sink.close()
+        self.assertEqual(indexer.added[-1], (path, 26, '23:59:00 three\n'))
+        self.assertEqual(len(self.read('#chan', '2026-10-15.log')), 41)
+
+    def test_flush_in_worker_thread(self):
+        sink = ChannelLogSink(self.logdir, reactor, flush_size=1)
+        self.addCleanup(sink.close)
+        sink.write('#chan', 'full already')
+        self.assertTrue(sink.writing)
+        def check(_):
+            [name] = os.listdir(os.path.join(self.logdir, '#chan'))
+            self.assertTrue(self.read('#chan', name).endswith(' full already\n'))
+            self.assertFalse(sink.writing)
+        return sink.flush().addCallback(check)
+
+
+class LogSearchTests(unittest.TestCase):
+    def setUp(self):
+        self.logdir = self.mktemp()
+        os.makedirs(self.logdir)
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                                   statefile=self.mktemp())
+        self.serv.state['plugins']['BotLogger'] = {
+            'blacklist': {}, 'log_dir': self.logdir, 'index_logs': False,
+        }
+        self.serv.enable_plugin_by_name('BotLogger')
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+        self.logger = self.serv.pluginmap['BotLogger']
+        self.logger.get_sink(self.bot)
+        self.logger.index = FakeIndex()
+        self.replies = []
+        self.bot.address_msg = lambda user, chan, msg: self.replies.append(msg)
+        self.bot.channel_memberships.add('#here', 'me')
+        self.bot.channel_memberships.add('#there', 'other')
+
+    def grep(self, chan, *args):
+        self.logger.command_grep(self.bot, 'me!m@host', chan, list(args))
+
+    def assertRefused(self):
+        self.assertEqual(self.logger.index.searches, [])
+        self.assertEqual(len(self.replies), 1)
+        self.assertIn('requires being in it or privilege log_search', self.replies[0])
+
+    def test_current_channel(self):
+        self.grep('#there', 'word')
+        [(words, wanted)] = self.logger.index.searches
+        self.assertTrue(wanted(os.path.join('#there', '2026-10-16.log')))
+        self.assertFalse(wanted(os.path.join('#here', '2026-10-16.log')))
+
+    def test_other_channel_refused(self):
+        self.grep('#here', '#there', 'word')
+        self.assertRefused()
+
+    def test_other_channel_as_member(self):
+        self.grep('#elsewhere', '#here', 'word')
+        self.assertEqual(len(self.logger.index.searches), 1)
+
+    def test_private_search_refused(self):
+        self.grep(self.bot.nickname, 'word')
+        self.assertRefused()
+
+    def test_private_search_of_other_channel_refused(self):
+        self.grep(self.bot.nickname, '#there', 'word')
+        self.assertRefused()
+
+    def test_privileged_search_stays_on_network(self):
+        self.serv.auth.addPriv('me!*@*', 'log_search')
+        self.grep(self.bot.nickname, 'word')
+        [(words, wanted)] = self.logger.index.searches
+        self.assertTrue(wanted(os.path.join('#there', '2026-10-16.log')))
+        self.assertFalse(wanted(os.path.join('other:#there', '2026-10-16.log')))
+        self.assertFalse(wanted(os.path.join('_server', '2026-10-16.log')))
+        self.assertFalse(wanted(os.path.join('someone', '2026-10-16.log')))
+
+    def test_privileged_search_on_other_network(self):
+        self.serv.auth.addPriv('me!*@*', 'log_search')
+        self.bot.network = 'other'
+        self.grep(self.bot.nickname, 'word')
+        [(words, wanted)] = self.logger.index.searches
+        self.assertTrue(wanted(os.path.join('other:#there', '2026-10-16.log')))
+        self.assertFalse(wanted(os.path.join('#there', '2026-10-16.log')))
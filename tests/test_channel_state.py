@@ -0,0 +1,139 @@
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import CassBotService, MembershipMap
+
+
+class MembershipMapTests(unittest.TestCase):
+    def setUp(self):
+        self.members = MembershipMap()
+        for channel, nick in (('#a', 'x'), ('#a', 'y'), ('#b', 'x')):
+            self.members.add(channel, nick)
+
+    def test_reverse_index(self):
+        self.assertEqual(self.members.channels_of('x'), set(['#a', '#b']))
+        self.assertEqual(self.members.channels_of('nobody'), frozenset())
+        self.members.discard('#a', 'x')
+        self.assertEqual(self.members.channels_of('x'), set(['#b']))
+        self.members.discard('#b', 'x')
+        self.assertNotIn('x', self.members.by_nick)
+
+    def test_remove_nick(self):
+        self.assertEqual(self.members.remove_nick('x'), set(['#a', '#b']))
+        self.assertEqual(self.members, {'#a': set(['y']), '#b': set()})
+        self.assertEqual(self.members.remove_nick('x'), ())
+
+    def test_rename(self):
+        self.members.add('#b', 'z')
+        self.assertEqual(self.members.rename('x', 'z'), set(['#a', '#b']))
+        self.assertEqual(self.members['#a'], set(['y', 'z']))
+        self.assertEqual(self.members['#b'], set(['z']))
+        self.assertEqual(self.members.channels_of('z'), set(['#a', '#b']))
+        self.assertNotIn('x', self.members.by_nick)
+
+    def test_replace_and_remove_channel(self):
+        self.assertEqual(self.members.replace_channel('#a', ['y', 'w']), set(['x']))
+        self.assertEqual(self.members.channels_of('x'), set(['#b']))
+        self.assertEqual(self.members.channels_of('w'), set(['#a']))
+        self.members.remove_channel('#a')
+        self.assertNotIn('#a', self.members)
+        self.assertNotIn('w', self.members.by_nick)
+        self.assertEqual(self.members.channels_of('y'), frozenset())
+
+
+class MembershipTrackingTests(unittest.TestCase):
+    def setUp(self):
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                                   statefile=self.mktemp())
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+        for channel in ('#a', '#b'):
+            self.line(':cassbot!bot@host JOIN %s' % channel)
+
+    def line(self, line):
+        self.bot.lineReceived(line)
+
+    def members(self):
+        return self.bot.channel_memberships
+
+    def test_join_part_kick(self):
+        self.line(':x!u@h JOIN #a')
+        self.line(':x!u@h JOIN #b')
+        self.line(':y!u@h JOIN #a')
+        self.assertEqual(self.members().channels_of('x'), set(['#a', '#b']))
+        self.line(':x!u@h PART #a')
+        self.line(':op!u@h KICK #b x :bye')
+        self.assertEqual(self.members()['#a'], set(['y']))
+        self.assertEqual(self.members()['#b'], set())
+        self.assertEqual(self.members().channels_of('x'), frozenset())
+
+    def test_quit_and_rename_clear_modes(self):
+        self.line(':x!u@h JOIN #a')
+        self.line(':x!u@h JOIN #b')
+        self.line(':op!u@h MODE #a +o x')
+        self.line(':x!u@h NICK xx')
+        self.assertEqual(self.members().channels_of('xx'), set(['#a', '#b']))
+        self.assertEqual(self.bot.chan_modemap['#a'], {'xx': set(['o'])})
+        self.line(':xx!u@h QUIT :gone')
+        self.assertEqual(self.members(), {'#a': set(), '#b': set()})
+        self.assertEqual(self.bot.chan_modemap['#a'], {})
+
+    def test_leaving_a_channel_unindexes_it(self):
+        self.line(':x!u@h JOIN #a')
+        self.line(':x!u@h JOIN #b')
+        self.line(':cassbot!bot@host PART #a')
+        self.assertNotIn('#a', self.members())
+        self.assertEqual(self.members().channels_of('x'), set(['#b']))
+
+
+class NamesTests(unittest.TestCase):
+    def setUp(self):
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                                   statefile=self.mktemp())
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+        self.received = []
+        self.synced = []
+        self.bot.namesReceived = lambda channel, names: self.received.append((channel, names))
+        self.bot.chanSynced = self.synced.append
+        self.line(':server 005 cassbot PREFIX=(qov)~@+ :are supported by this server')
+        self.line(':cassbot!bot@host JOIN #a')
+
+    def line(self, line):
+        self.bot.lineReceived(line)
+
+    def names(self, channel, *chunks):
+        for chunk in chunks:
+            self.line(':server 353 cassbot = %s :%s' % (channel, chunk))
+        self.line(':server 366 cassbot %s :End of /NAMES list.' % channel)
+
+    def test_nick_prefixes(self):
+        self.assertEqual(self.bot.nick_prefixes(), {'~': 'q', '@': 'o', '+': 'v'})
+
+    def test_reply_applied_once_at_end(self):
+        self.line(':server 353 cassbot = #a :@x +y')
+        self.assertEqual(self.bot.channel_memberships['#a'], set())
+        self.assertEqual(self.received, [])
+        self.names('#a', 'w ~@z')
+        self.assertEqual(self.received, [('#a', {
+            'x': frozenset('o'), 'y': frozenset('v'),
+            'z': frozenset('qo'), 'w': frozenset()})])
+        self.assertEqual(self.synced, ['#a'])
+        self.assertEqual(self.bot.channel_memberships['#a'], set(['w', 'x', 'y', 'z']))
+        self.assertEqual(self.bot.chan_modemap['#a'],
+                         {'x': set('o'), 'y': set('v'), 'z': set('qo')})
+        self.assertNotIn('#a', self.bot.names_pending)
+
+    def test_reply_replaces_members_and_modes(self):
+        self.names('#a', '@x +y z')
+        self.names('#a', 'x +z')
+        self.assertEqual(self.bot.channel_memberships['#a'], set(['x', 'z']))
+        self.assertEqual(self.bot.channel_memberships.channels_of('y'), frozenset())
+        self.assertEqual(self.bot.chan_modemap['#a'], {'z': set('v')})
+
+    def test_other_channel_only_reported(self):
+        self.names('#elsewhere', '@x')
+        self.assertEqual(self.received, [('#elsewhere', {'x': frozenset('o')})])
+        self.assertEqual(self.synced, [])
+        self.assertNotIn('#elsewhere', self.bot.channel_memberships)
+        self.assertNotIn('#elsewhere', self.bot.chan_modemap)
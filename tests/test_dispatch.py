@@ -0,0 +1,122 @@
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import BaseBotPlugin, CassBotService
+
+
+def make_plugin(name, calls, behavior=None):
+    def userJoined(self, bot, user, channel):
+        calls.append((name, user, channel))
+        if behavior is not None:
+            return behavior()
+    return type(name, (BaseBotPlugin,), {'userJoined': userJoined})()
+
+
+class FanOutTests(unittest.TestCase):
+    def setUp(self):
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                                   statefile=self.mktemp())
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+        self.calls = []
+
+    def add(self, name, behavior=None):
+        p = make_plugin(name, self.calls, behavior)
+        self.serv.pluginmap[name] = p
+        self.serv.attach_plugin(p)
+        return p
+
+    def hook_errors(self, name):
+        return self.serv.metrics.hook_errors.get((name, 'userJoined'))
+
+    def hook_calls(self, name):
+        return self.serv.metrics.hook_seconds.count((name, 'userJoined'))
+
+    def names(self):
+        return [name for (name, user, channel) in self.calls]
+
+    def test_hooks_fire_in_order(self):
+        for name in ('A', 'B', 'C'):
+            self.add(name)
+        d = self.bot.userJoined('someone', '#c')
+        self.successResultOf(d)
+        self.assertEqual(self.calls, [(name, 'someone', '#c') for name in 'ABC'])
+        # and the bot's own method ran too
+        self.assertIn('someone', self.bot.channel_memberships['#c'])
+        self.assertEqual([self.hook_calls(name) for name in 'ABC'], [1, 1, 1])
+
+    def test_sync_error_does_not_stop_others(self):
+        self.add('A', lambda: 1 / 0)
+        self.add('B')
+        self.successResultOf(self.bot.userJoined('someone', '#c'))
+        self.assertEqual(self.names(), ['A', 'B'])
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+        self.assertEqual(self.hook_errors('A'), 1)
+        self.assertEqual(self.hook_calls('B'), 1)
+
+    def test_failed_deferred_does_not_stop_others(self):
+        self.add('A', lambda: defer.fail(ValueError('nope')))
+        self.add('B')
+        self.successResultOf(self.bot.userJoined('someone', '#c'))
+        self.assertEqual(self.names(), ['A', 'B'])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.hook_errors('A'), 1)
+
+    def test_fired_deferred_continues_synchronously(self):
+        self.add('A', lambda: defer.succeed('ignored'))
+        self.add('B')
+        d = self.bot.userJoined('someone', '#c')
+        self.assertEqual(self.names(), ['A', 'B'])
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(self.hook_calls('A'), 1)
+
+    def test_pending_deferred_holds_later_hooks(self):
+        waiting = defer.Deferred()
+        self.add('A')
+        self.add('B', lambda: waiting)
+        self.add('C')
+        d = self.bot.userJoined('someone', '#c')
+        self.assertNoResult(d)
+        self.assertEqual(self.names(), ['A', 'B'])
+        waiting.callback('whatever')
+        self.assertEqual(self.names(), ['A', 'B', 'C'])
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual([self.hook_calls(name) for name in 'ABC'], [1, 1, 1])
+
+    def test_pending_deferred_failing(self):
+        waiting = defer.Deferred()
+        self.add('A', lambda: waiting)
+        self.add('B')
+        d = self.bot.userJoined('someone', '#c')
+        waiting.errback(ValueError('late'))
+        self.successResultOf(d)
+        self.assertEqual(self.names(), ['A', 'B'])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual(self.hook_errors('A'), 1)
+
+    def test_detached_plugin_not_called(self):
+        a = self.add('A')
+        self.add('B')
+        self.serv.detach_plugin(a)
+        self.successResultOf(self.bot.userJoined('someone', '#c'))
+        self.assertEqual(self.names(), ['B'])
+
+    def test_hooks_timed_on_a_sample(self):
+        self.bot.hook_sample = 4
+        self.add('A')
+        self.add('B', lambda: 1 / 0)
+        waiting = []
+        def later():
+            waiting.append(defer.Deferred())
+            return waiting[-1]
+        self.add('C', later)
+        for i in range(9):
+            self.bot.userJoined('someone%d' % i, '#c')
+            waiting[-1].callback(None)
+        self.assertEqual(len(self.calls), 27)
+        self.assertEqual(self.serv.metrics.events.get(('userJoined',)), 9)
+        # the 1st, 5th and 9th
+        self.assertEqual([self.hook_calls(name) for name in 'AC'], [3, 3])
+        # but every error is counted
+        self.assertEqual(self.hook_errors('B'), 9)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 9)
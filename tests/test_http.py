@@ -0,0 +1,75 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from cassbot_http import HTTPClient, HTTPResponse, HTTPTimeout
+
+
+class StubAgent:
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, bodyProducer=None):
+        d = defer.Deferred()
+        self.requests.append((method, url, d))
+        return d
+
+
+class HTTPClientTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = HTTPClient(self.clock)
+        self.agent = self.client.agent = StubAgent()
+        # skip reading a real body
+        self.client.read_response = lambda response: response
+
+    def test_coalesces_identical_requests(self):
+        d1 = self.client.request('http://example.com/a')
+        d2 = self.client.request('http://example.com/a')
+        d3 = self.client.request('http://example.com/b')
+        self.assertEqual(len(self.agent.requests), 2)
+        self.assertEqual(self.client.stats(),
+                         {'in_flight': 2, 'made': 2, 'coalesced': 1})
+        res = HTTPResponse(200, 'OK', 'body')
+        self.agent.requests[0][2].callback(res)
+        self.assertIdentical(self.successResultOf(d1), res)
+        self.assertIdentical(self.successResultOf(d2), res)
+        self.assertNoResult(d3)
+        self.assertEqual(self.client.stats()['in_flight'], 1)
+
+    def test_cancel_one_waiter(self):
+        d1 = self.client.request('http://example.com/a')
+        d2 = self.client.request('http://example.com/a')
+        d1.cancel()
+        self.failureResultOf(d1, defer.CancelledError)
+        res = HTTPResponse(200, 'OK', 'body')
+        self.agent.requests[0][2].callback(res)
+        self.assertIdentical(self.successResultOf(d2), res)
+
+    def test_failure_reaches_all_waiters(self):
+        d1 = self.client.request('http://example.com/a')
+        d2 = self.client.request('http://example.com/a')
+        self.agent.requests[0][2].errback(ValueError('nope'))
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+        self.assertEqual(self.client.in_flight, {})
+
+    def test_timeout_hides_query_string(self):
+        d = self.client.request('http://example.com/a?token=secret')
+        self.clock.advance(self.client.timeout)
+        f = self.failureResultOf(d, HTTPTimeout)
+        self.assertNotIn('secret', f.getErrorMessage())
+        self.assertEqual(self.client.in_flight, {})
+
+
+class SynchronousFailureTests(unittest.TestCase):
+    def test_bad_scheme_fails_request(self):
+        client = HTTPClient(task.Clock())
+        d = client.request('foo://nowhere/x')
+        self.failureResultOf(d)
+        self.assertEqual(client.in_flight, {})
+
+    def test_coalesced_after_synchronous_failure(self):
+        client = HTTPClient(task.Clock())
+        self.failureResultOf(client.request('foo://nowhere/x'))
+        # nothing left behind for a second request to wait on
+        self.failureResultOf(client.request('foo://nowhere/x'))
+        self.assertEqual(client.stats()['made'], 2)
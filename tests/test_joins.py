@@ -0,0 +1,94 @@
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import CassBotService
+
+
+class JoinSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=self.clock,
+                                   statefile=self.mktemp())
+        self.serv.state.update({
+            'channels': ('a', '#b', '#c', '#d', '#e'),
+            'priority_channels': ('#D',),
+            'join_rate': 0.5,
+            'join_burst': 1,
+            'join_batch': 2,
+        })
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.bot.makeConnection(self.transport)
+        self.transport.clear()
+
+    def sent(self):
+        lines = self.transport.value().splitlines()
+        self.transport.clear()
+        return lines
+
+    def sync(self, channel):
+        self.bot.lineReceived(':cassbot!bot@host JOIN %s' % channel)
+        self.bot.lineReceived(':server 366 cassbot %s :End of /NAMES list.' % channel)
+
+    def test_batched_and_paced(self):
+        self.bot.signedOn()
+        # priority channels first, and bare names get a '#'
+        self.assertEqual(self.sent(), ['JOIN #d,#a'])
+        self.clock.advance(1.9)
+        self.assertEqual(self.sent(), [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.sent(), ['JOIN #b,#c'])
+        self.clock.advance(2)
+        self.assertEqual(self.sent(), ['JOIN #e'])
+        self.clock.advance(10)
+        self.assertEqual(self.sent(), [])
+
+    def test_mode_queries_alternate_with_joins(self):
+        self.bot.signedOn()
+        self.sent()
+        self.sync('#d')
+        self.sync('#a')
+        # a JOIN was just sent, so a query goes next
+        for expected in ('MODE #d', 'JOIN #b,#c', 'MODE #a', 'JOIN #e'):
+            self.clock.advance(2)
+            self.assertEqual(self.sent(), [expected])
+
+    def test_long_lines_split(self):
+        channels = ['#' + 'x' * 98 + str(i) for i in range(5)]
+        self.bot.join_options['batch'] = 10
+        self.bot.join_channels = channels
+        self.bot.signedOn()
+        self.clock.advance(10)
+        lines = [l for l in self.sent() if l.startswith('JOIN ')]
+        self.assertEqual([l[5:].split(',') for l in lines], [channels[:3], channels[3:]])
+        self.assertTrue(all(len(l) <= 400 for l in lines))
+
+    def test_finished_when_all_synced_or_failed(self):
+        self.bot.signedOn()
+        joiner = self.bot.joiner
+        for channel in ('#d', '#a', '#B'):
+            self.clock.advance(1)
+            self.sync(channel)
+        self.bot.lineReceived(':server 474 cassbot #c :Cannot join channel (+b)')
+        self.assertEqual(joiner.status(), 'synced 4/5 channels so far')
+        self.assertEqual(joiner.all_synced, None)
+        self.clock.advance(1)
+        self.sync('#e')
+        self.assertEqual(joiner.all_synced, 4.0)
+        self.assertEqual(joiner.status(), 'synced 5 channels in 4.0s (could not join #c)')
+        metrics = self.serv.metrics
+        self.assertEqual(metrics.channel_sync_seconds.count(('default',)), 5)
+        self.assertEqual(metrics.all_synced_seconds.count(('default',)), 1)
+
+    def test_nothing_to_join(self):
+        self.bot.join_channels = ()
+        self.bot.signedOn()
+        self.assertEqual(self.bot.joiner.status(), 'synced 0 channels in 0.0s')
+
+    def test_stopped_on_disconnect(self):
+        self.bot.signedOn()
+        self.sent()
+        self.bot.connectionLost(None)
+        self.clock.advance(10)
+        self.assertEqual(self.sent(), [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,97 @@
+import os
+import gzip
+from twisted.internet import reactor, task
+from twisted.trial import unittest
+from cassbot_plugins.log_index import LogIndex
+
+
+class LogIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.logdir = self.mktemp()
+        os.makedirs(os.path.join(self.logdir, '#chan'))
+        self.indexdir = os.path.join(self.logdir, '.index')
+
+    def open_index(self):
+        index = LogIndex(self.logdir, self.indexdir, reactor)
+        self.addCleanup(lambda: index.closed or index.close())
+        return index
+
+    def write_log(self, name, lines, compress=False):
+        path = os.path.join(self.logdir, '#chan', name)
+        data = ''.join('12:00:%02d %s\n' % (n, line) for (n, line) in enumerate(lines))
+        if compress:
+            with gzip.open(path + '.gz', 'wb') as f:
+                f.write(data)
+        else:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return path
+
+    def add_lines(self, index, path, lines):
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        with open(path, 'ab') as f:
+            for line in lines:
+                line = '12:00:00 %s\n' % line
+                f.write(line)
+                index.add(path, offset, line)
+                offset += len(line)
+
+    def until(self, predicate):
+        # for work done in the reactor's thread pool
+        d = task.deferLater(reactor, 0.01, predicate)
+        d.addCallback(lambda done: None if done else self.until(predicate))
+        return d
+
+    def test_search_memtable_and_segments(self):
+        index = self.open_index()
+        path = os.path.join(self.logdir, '#chan', '2026-10-16.log')
+        self.add_lines(index, path, ['compaction is slow', 'repair is fine'])
+        index.flush()
+        self.add_lines(index, path, ['compaction again'])
+        d = index.search(['compaction'])
+        d.addCallback(self.assertEqual, [
+            (os.path.join('#chan', '2026-10-16.log'), '12:00:00 compaction again'),
+            (os.path.join('#chan', '2026-10-16.log'), '12:00:00 compaction is slow')])
+        return d
+
+    def test_close_while_writing(self):
+        index = self.open_index()
+        path = os.path.join(self.logdir, '#chan', '2026-10-16.log')
+        self.add_lines(index, path, ['first batch'])
+        index.flush()
+        self.assertTrue(index.writing)
+        self.add_lines(index, path, ['second batch'])
+        index.close()
+        d = self.until(lambda: not index.writing)
+        def reopen(_):
+            # the late write was ignored, and close() covered both batches
+            again = self.open_index()
+            self.assertEqual(len(again.segments), 1)
+            self.assertEqual(again.indexed.values(), [os.path.getsize(path)])
+            return again.search(['batch'])
+        d.addCallback(reopen)
+        d.addCallback(lambda results: self.assertEqual(len(results), 2))
+        return d
+
+    def test_compressed_day(self):
+        self.write_log('2026-10-15.log', ['old news %d' % n for n in range(20)],
+                       compress=True)
+        index = self.open_index()
+        d = self.until(lambda: index.segments)
+        d.addCallback(lambda _: index.search(['news'], limit=3))
+        d.addCallback(lambda results: self.assertEqual(
+                [line for (rel, line) in results],
+                ['12:00:19 old news 19', '12:00:18 old news 18', '12:00:17 old news 17']))
+        return d
+
+    def test_read_line_reuses_unpacked(self):
+        self.write_log('2026-10-15.log', ['one', 'two'], compress=True)
+        index = self.open_index()
+        def check(_):
+            unpacked = {}
+            rel = os.path.join('#chan', '2026-10-15.log')
+            self.assertEqual(index.read_line(rel, 13, unpacked), '12:00:01 two')
+            self.assertEqual(unpacked.keys(), [rel])
+            os.remove(os.path.join(self.logdir, rel + '.gz'))
+            self.assertEqual(index.read_line(rel, 0, unpacked), '12:00:00 one')
+        return self.until(lambda: index.segments).addCallback(check)
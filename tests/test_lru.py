@@ -0,0 +1,84 @@
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import CassBotService, ExpiringLRU
+
+
+class ExpiringLRUTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = ExpiringLRU(3, 10, self.clock)
+
+    def test_get_and_set(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('b', 'x'), 'x')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_expiry(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=30)
+        self.clock.advance(10)
+        self.assertFalse('a' in self.cache)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 2)
+        self.clock.advance(20)
+        self.assertEqual(self.cache.get('b'), None)
+
+    def test_set_renews(self):
+        self.cache.set('a', 1)
+        self.clock.advance(8)
+        self.cache.set('a', 2)
+        self.clock.advance(8)
+        self.assertEqual(self.cache.get('a'), 2)
+
+    def test_evicts_least_recently_used(self):
+        for key in 'abc':
+            self.cache.set(key, key)
+        self.cache.get('a')
+        self.cache.set('d', 'd')
+        self.assertEqual(len(self.cache), 3)
+        self.assertFalse('b' in self.cache)
+        for key in 'acd':
+            self.assertTrue(key in self.cache)
+
+    def test_discard_and_clear(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.discard('a')
+        self.cache.discard('missing')
+        self.assertEqual(len(self.cache), 1)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+class RecentlyPostedTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=self.clock,
+                                   statefile=self.mktemp())
+        self.serv.state['reference_cache_size'] = 3
+        self.serv.configure_reference_cache()
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+
+    def posted(self, ref, channel='#c'):
+        return self.bot.recently_posted('me!m@host', channel, ref)
+
+    def test_window(self):
+        self.assertFalse(self.posted('link'))
+        self.assertTrue(self.posted('link'))
+        self.assertTrue(self.posted('link', '#C'))
+        self.assertFalse(self.posted('link', '#other'))
+        self.clock.advance(self.serv.default_reference_window)
+        self.assertFalse(self.posted('link'))
+
+    def test_repeated_reference_survives_eviction(self):
+        for ref in ('hot', 'b', 'c'):
+            self.posted(ref)
+        # 'hot' comes up again, so 'b' is now the least recently used
+        self.assertTrue(self.posted('hot'))
+        self.posted('d')
+        self.assertTrue(self.posted('hot'))
+        self.assertFalse(self.posted('b'))
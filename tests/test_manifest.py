@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+from twisted.internet import task
+from twisted.trial import unittest
+import cassbot_plugins
+from cassbot import CassBotService, PluginManifest
+
+
+class PluginManifestTests(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def test_update_records_relative_files(self):
+        manifest = PluginManifest(self.path)
+        self.assertTrue(manifest.update())
+        self.assertEqual(manifest.plugins['BotLogger']['module'],
+                         'cassbot_plugins.bot_logger')
+        with open(self.path) as f:
+            modules = json.load(f)['modules']
+        self.assertEqual(modules['cassbot_plugins.bot_logger']['file'][0], 'bot_logger.py')
+        again = PluginManifest(self.path)
+        self.assertFalse(again.update())
+        self.assertEqual(sorted(again.plugins), sorted(manifest.plugins))
+
+    def test_discovery_after_chdir(self):
+        # the package's __path__ is made absolute when it's imported, so
+        # the file signature (and so the manifest) doesn't come up empty
+        # once the process has changed directory, as twistd and trial do
+        self.assertTrue(all(os.path.isabs(p) for p in cassbot_plugins.__path__))
+        elsewhere = os.path.abspath(self.mktemp())
+        os.makedirs(elsewhere)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(elsewhere)
+        serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                              statefile=os.path.join(elsewhere, 'state.db'))
+        self.assertIn('BotLogger', serv.available_plugins())
+        self.assertTrue(os.path.exists(os.path.join(elsewhere, PluginManifest.filename)))
+
+
+plugin_source = """
+from cassbot import BaseBotPlugin
+
+class DiscoveredPlugin(BaseBotPlugin):
+    def command_hello(self, bot, user, channel, args):
+        return bot.address_msg(user, channel, 'hello')
+"""
+
+
+class PluginDiscoveryTests(unittest.TestCase):
+    def setUp(self):
+        self.plugindir = os.path.abspath(self.mktemp())
+        os.makedirs(self.plugindir)
+        self.patch(cassbot_plugins, '__path__', cassbot_plugins.__path__ + [self.plugindir])
+        self.addCleanup(sys.modules.pop, 'cassbot_plugins.discovered', None)
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                                   statefile=self.mktemp())
+        self.described = []
+        describe = self.serv.manifest.describe_module
+        def recording(modname, *a):
+            self.described.append(modname)
+            return describe(modname, *a)
+        self.serv.manifest.describe_module = recording
+
+    def add_module(self):
+        with open(os.path.join(self.plugindir, 'discovered.py'), 'w') as f:
+            f.write(plugin_source)
+
+    def test_discovery_is_cached(self):
+        self.assertIn('BotLogger', self.serv.available_plugins())
+        self.assertNotEqual(self.described, [])
+        del self.described[:]
+        self.assertFalse(self.serv.check_plugin_files())
+        self.serv.available_plugins()
+        self.assertEqual(self.described, [])
+
+    def test_only_changed_modules_are_described(self):
+        self.serv.available_plugins()
+        del self.described[:]
+        self.add_module()
+        self.assertTrue(self.serv.check_plugin_files())
+        self.assertEqual(self.described, ['cassbot_plugins.discovered'])
+        self.assertIn('DiscoveredPlugin', self.serv.available_plugins())
+
+    def test_waiting_plugin_loaded_when_found(self):
+        d = self.serv.enable_plugin_by_name('DiscoveredPlugin')
+        self.assertNoResult(d)
+        self.assertIdentical(self.serv.router.route('hello'), None)
+        self.add_module()
+        self.serv.check_plugin_files()
+        p = self.successResultOf(d)
+        self.assertIdentical(self.serv.pluginmap['DiscoveredPlugin'], p)
+        self.assertEqual(self.serv.command_map['hello'], [p])
+        self.assertEqual(self.serv.router.route('hello')[0], 'hello')
+        self.serv.disable_plugin('DiscoveredPlugin')
+        self.assertNotIn('hello', self.serv.command_map)
+        self.assertIdentical(self.serv.router.route('hello'), None)
+
+    def test_edited_module_reloaded(self):
+        self.add_module()
+        self.serv.check_plugin_files()
+        path = os.path.join(self.plugindir, 'discovered.py')
+        with open(path, 'a') as f:
+            f.write('\nclass AnotherPlugin(DiscoveredPlugin):\n    pass\n')
+        # make sure the edit doesn't share an mtime with the stale .pyc
+        mtime = os.stat(path).st_mtime + 10
+        os.utime(path, (mtime, mtime))
+        self.assertTrue(self.serv.check_plugin_files())
+        self.assertIn('AnotherPlugin', self.serv.available_plugins())
+        # and the saved manifest says the same after a restart
+        again = PluginManifest(self.serv.manifest.path())
+        self.assertFalse(again.update())
+        self.assertIn('AnotherPlugin', again.plugins)
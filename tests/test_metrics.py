@@ -0,0 +1,145 @@
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+from cassbot import CassBotService
+from cassbot_metrics import (Counter, Histogram, MetricsRegistry, channel_label,
+                             metrics_http_service)
+from cassbot_metrics_web import MetricsResource
+from cassbot_plugins.admin import Admin
+
+
+class CounterTests(unittest.TestCase):
+    def test_inc_and_render(self):
+        c = Counter('things_total', 'Things.', ('kind', 'channel'))
+        c.inc(('a', '#c'))
+        c.inc(('a', '#c'), 2)
+        c.inc(('b"\\\n', '#c'))
+        self.assertEqual(c.get(('a', '#c')), 3)
+        self.assertEqual(c.get(('z', '#c')), 0)
+        self.assertEqual(c.total(), 4)
+        self.assertEqual(list(c.render()), [
+            'things_total{kind="a",channel="#c"} 3',
+            'things_total{kind="b\\"\\\\\\n",channel="#c"} 1',
+        ])
+
+
+class HistogramTests(unittest.TestCase):
+    def setUp(self):
+        self.h = Histogram('took_seconds', 'Time.', ('op',), bounds=(1, 2, 5))
+
+    def test_observe_and_render(self):
+        for value in (0.5, 1, 1.5, 10):
+            self.h.observe(('x',), value)
+        self.assertEqual(self.h.count(('x',)), 4)
+        self.assertEqual(self.h.mean(('x',)), 3.25)
+        self.assertEqual(list(self.h.render()), [
+            'took_seconds_bucket{op="x",le="1"} 2',
+            'took_seconds_bucket{op="x",le="2"} 3',
+            'took_seconds_bucket{op="x",le="5"} 3',
+            'took_seconds_bucket{op="x",le="+Inf"} 4',
+            'took_seconds_sum{op="x"} 13.0',
+            'took_seconds_count{op="x"} 4',
+        ])
+
+    def test_observer_shares_series(self):
+        observe = self.h.observer(('y',))
+        observe(3)
+        self.h.observe(('y',), 4)
+        self.assertEqual(self.h.count(('y',)), 2)
+        self.assertEqual(self.h.quantile(('y',), 0.5), 5)
+
+    def test_quantile(self):
+        self.assertEqual(self.h.quantile(('none',), 0.5), 0.0)
+        for value in (0.1, 0.2, 1.5, 100):
+            self.h.observe(('x',), value)
+        self.assertEqual(self.h.quantile(('x',), 0.5), 1)
+        self.assertEqual(self.h.quantile(('x',), 0.75), 2)
+        self.assertEqual(self.h.quantile(('x',), 1), float('inf'))
+
+
+class RegistryTests(unittest.TestCase):
+    def test_get_or_make(self):
+        reg = MetricsRegistry()
+        c = reg.counter('a_total', 'A.')
+        self.assertIdentical(reg.counter('a_total', 'A.'), c)
+        self.assertRaises(ValueError, reg.add, Counter('a_total', 'Again.'))
+
+    def test_render(self):
+        reg = MetricsRegistry()
+        reg.counter('b_total', 'B things.').inc()
+        reg.histogram('a_seconds', 'A time.', bounds=(1,))
+        self.assertEqual(reg.render(), '\n'.join([
+            '# HELP a_seconds A time.',
+            '# TYPE a_seconds histogram',
+            '# HELP b_total B things.',
+            '# TYPE b_total counter',
+            'b_total 1',
+            '']))
+
+    def test_channel_label(self):
+        self.assertEqual(channel_label('#c'), '#c')
+        self.assertEqual(channel_label('&local'), '&local')
+        self.assertEqual(channel_label('somenick'), '(private)')
+
+
+class MetricsEndpointTests(unittest.TestCase):
+    def test_resource(self):
+        reg = MetricsRegistry()
+        reg.counter('a_total', 'A.').inc()
+        request = DummyRequest([''])
+        body = MetricsResource(reg).render_GET(request)
+        self.assertEqual(body, reg.render())
+        self.assertEqual(request.responseHeaders.getRawHeaders('content-type'),
+                         ['text/plain; version=0.0.4'])
+
+    def test_bare_port_is_local(self):
+        svc = metrics_http_service(MetricsRegistry(), '9123')
+        self.assertEqual(svc.endpoint._port, 9123)
+        self.assertEqual(svc.endpoint._interface, '127.0.0.1')
+
+
+class BotMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                                   statefile=self.mktemp())
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+        self.metrics = self.serv.metrics
+
+    def test_events_and_commands_counted(self):
+        self.bot.userJoined('someone', '#c')
+        self.bot.privmsg('someone!s@host', 'cassbot', 'nosuchcommand')
+        self.assertEqual(self.metrics.events.get(('userJoined',)), 1)
+        self.assertEqual(self.metrics.events.get(('privmsg',)), 1)
+        self.assertEqual(self.metrics.commands.get(('', '(private)', 'not_found')), 1)
+        self.assertEqual(self.metrics.messages_sent.get(('(private)',)), 1)
+        text = self.metrics.render()
+        self.assertIn('cassbot_events_total{hook="userJoined"} 1', text)
+        self.assertIn('# TYPE cassbot_hook_seconds histogram', text)
+
+
+class AdminStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=self.clock,
+                                   statefile=self.mktemp())
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.bot.makeConnection(self.transport)
+        self.admin = Admin()
+
+    def stats(self, *args):
+        self.admin.command_stats(self.bot, 'boss!b@host', '#c', list(args))
+        self.clock.pump([1] * 10)
+        return self.transport.value()
+
+    def test_slow_commands_and_hooks(self):
+        self.serv.metrics.command_seconds.observe(('Builder', 'build'), 60)
+        self.serv.metrics.command_seconds.observe(('Builder', 'forever'), 3600)
+        self.serv.metrics.hook_seconds.observe(('Slow', 'privmsg'), 45)
+        sent = self.stats('commands')
+        self.assertIn('build 1/1m00s/1m00s', sent)
+        self.assertIn('forever 1/1h00m/>30m00s', sent)
+        sent = self.stats()
+        self.assertIn('Slow.privmsg 45.0s/>30.0s/1', sent)
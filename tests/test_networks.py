@@ -0,0 +1,77 @@
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import CassBotService
+
+
+class NetworkTests(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.serv = self.service()
+        self.serv.state['cmd_prefix'] = '!'
+        self.serv.state['channels'] = ('#default',)
+
+    def service(self):
+        serv = CassBotService('tcp:host=localhost:port=1', nickname='bot',
+                              reactor=task.Clock(), statefile=self.path)
+        self.addCleanup(lambda: serv.state_store and serv.state_store.close())
+        return serv
+
+    def connect(self, network):
+        bot = self.serv.networks[network].buildProtocol(None)
+        bot.makeConnection(proto_helpers.StringTransport())
+        return bot
+
+    def test_config_falls_back_to_default(self):
+        self.serv.add_network('other', 'tcp:host=other:port=6667', nickname='otherbot',
+                              channels=('#elsewhere',))
+        conf = self.serv.network_config('other')
+        self.assertEqual(conf['nickname'], 'otherbot')
+        self.assertEqual(conf['channels'], ('#elsewhere',))
+        self.assertEqual(conf['cmd_prefix'], '!')
+        # but channels are never inherited
+        self.serv.add_network('bare', 'tcp:host=bare:port=6667')
+        self.assertEqual(self.serv.network_config('bare')['channels'], ())
+        self.assertEqual(self.serv.network_config('bare')['nickname'], 'bot')
+
+    def test_bots_per_network(self):
+        self.serv.add_network('other', 'tcp:host=other:port=6667', nickname='otherbot')
+        default = self.connect('default')
+        other = self.connect('other')
+        self.assertEqual((default.network, default.nickname), ('default', 'bot'))
+        self.assertEqual((other.network, other.nickname), ('other', 'otherbot'))
+        self.assertNotIdentical(default.outqueue, other.outqueue)
+        default.signedOn()
+        other.signedOn()
+        self.assertIdentical(self.serv.getbot(), default)
+        self.assertIdentical(self.serv.getbot('other'), other)
+        self.assertEqual(sorted(b.network for b in self.serv.getbots()),
+                         ['default', 'other'])
+
+    def test_references_kept_apart(self):
+        self.serv.add_network('other', 'tcp:host=other:port=6667')
+        default = self.connect('default')
+        other = self.connect('other')
+        self.assertFalse(default.recently_posted('me!m@h', '#c', 'link'))
+        self.assertFalse(other.recently_posted('me!m@h', '#c', 'link'))
+        self.assertTrue(default.recently_posted('me!m@h', '#c', 'link'))
+
+    def test_add_and_remove(self):
+        self.serv.add_network('other', 'tcp:host=other:port=6667')
+        self.assertRaises(ValueError, self.serv.add_network, 'other',
+                          'tcp:host=again:port=6667')
+        self.assertRaises(ValueError, self.serv.remove_network, 'default')
+        self.serv.remove_network('other')
+        self.assertEqual(self.serv.networks.keys(), ['default'])
+        self.assertEqual(self.serv.state['networks'], {})
+
+    def test_networks_saved(self):
+        self.serv.add_network('other', 'tcp:host=other:port=6667', nickname='otherbot')
+        self.serv.saveStateToFile(self.path)
+        self.serv.state_store.close()
+        self.serv.state_store = None
+        serv = self.service()
+        serv.loadStateFromFile(self.path)
+        self.assertEqual(sorted(serv.networks), ['default', 'other'])
+        self.assertEqual(serv.network_config('other')['nickname'], 'otherbot')
+        self.assertEqual(serv.networks['other'].network, 'other')
@@ -0,0 +1,57 @@
+from twisted.internet import task
+from twisted.trial import unittest
+from cassbot import OutboundQueue
+
+
+class OutboundQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.queue = OutboundQueue(lambda target, line: self.sent.append((target, line)),
+                                   self.clock, rate=1, burst=2)
+
+    def test_burst_then_paced(self):
+        d = self.queue.enqueue('#a', ['1', '2', '3', '4'])
+        fired = []
+        d.addCallback(fired.append)
+        self.assertEqual(self.sent, [('#a', '1'), ('#a', '2')])
+        self.clock.advance(1)
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(fired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.sent[-1], ('#a', '4'))
+        self.assertEqual(fired, [None])
+        self.assertEqual(self.queue.sent, 4)
+        self.assertEqual(self.queue.max_wait, 2)
+
+    def test_round_robin_between_targets(self):
+        self.queue.enqueue('#a', ['x'] * 2)
+        self.queue.enqueue('#a', ['a1', 'a2'])
+        self.queue.enqueue('#b', ['b1', 'b2'])
+        self.clock.pump([1] * 4)
+        self.assertEqual([t for (t, line) in self.sent[2:]], ['#a', '#b', '#a', '#b'])
+
+    def test_reply_lane_first(self):
+        self.queue.enqueue('#a', ['x'] * 2)
+        self.queue.enqueue('#a', ['link'], lane='link')
+        self.queue.enqueue('#b', ['reply'])
+        self.clock.pump([1] * 2)
+        self.assertEqual(self.sent[2:], [('#b', 'reply'), ('#a', 'link')])
+
+    def test_empty_enqueue(self):
+        fired = []
+        self.queue.enqueue('#a', []).addCallback(fired.append)
+        self.assertEqual(fired, [None])
+        self.assertEqual(self.sent, [])
+
+    def test_unknown_lane(self):
+        self.assertRaises(ValueError, self.queue.enqueue, '#a', ['x'], lane='notice')
+
+    def test_clear_fires_waiters(self):
+        fired = []
+        self.queue.enqueue('#a', ['1', '2', '3']).addCallback(fired.append)
+        self.queue.clear()
+        self.assertEqual(fired, [None])
+        self.assertEqual(self.queue.depth, 0)
+        self.clock.advance(10)
+        self.assertEqual(len(self.sent), 2)
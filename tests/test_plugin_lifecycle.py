@@ -0,0 +1,68 @@
+import os
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import CassBotService
+
+
+class PluginLifecycleTests(unittest.TestCase):
+    def setUp(self):
+        self.logdir = self.mktemp()
+        os.makedirs(self.logdir)
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                                   statefile=self.mktemp())
+        self.serv.state['plugins']['BotLogger'] = {
+            'blacklist': {}, 'log_dir': self.logdir, 'index_logs': False,
+        }
+        self.serv.enable_plugin_by_name('BotLogger')
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+        self.logger = self.serv.pluginmap['BotLogger']
+
+    def log_something(self):
+        self.logger.get_sink(self.bot)
+        self.assertNotIdentical(self.logger.sink, None)
+
+    def test_save_state_has_no_side_effects(self):
+        self.log_something()
+        state = self.logger.saveState()
+        self.assertEqual(state['log_dir'], self.logdir)
+        self.assertNotIdentical(self.logger.sink, None)
+
+    def test_disable_shuts_down(self):
+        self.log_something()
+        self.serv.disable_plugin('BotLogger')
+        self.assertIdentical(self.logger.sink, None)
+        self.assertEqual(self.serv.state['plugins']['BotLogger']['log_dir'],
+                         self.logdir)
+
+    def test_reload_keeps_running_logger(self):
+        self.log_something()
+        sink = self.logger.sink
+        d = self.serv.reload_plugin('BotLogger')
+        new = self.successResultOf(d)
+        self.assertNotIdentical(new, self.logger)
+        self.assertIdentical(self.serv.pluginmap['BotLogger'], new)
+        # the old instance is shut down only once the new one is in place
+        self.assertIdentical(self.logger.sink, None)
+        self.assertEqual(new.log_dir, self.logdir)
+        self.assertNotIdentical(sink, None)
+
+    def test_failed_reload_leaves_old_instance(self):
+        self.log_something()
+        import __builtin__
+        module = __import__('cassbot_plugins.bot_logger', fromlist=['BotLogger'])
+        class Broken(module.BotLogger):
+            @classmethod
+            def name(cls):
+                return 'BotLogger'
+            def loadState(self, state):
+                raise ValueError('bad state')
+        class FakeModule:
+            __name__ = module.__name__
+            BotLogger = Broken
+        self.patch(__builtin__, 'reload', lambda mod: FakeModule)
+        d = self.serv.reload_plugin('BotLogger')
+        self.failureResultOf(d, ValueError)
+        self.assertIdentical(self.serv.pluginmap['BotLogger'], self.logger)
+        self.assertNotIdentical(self.logger.sink, None)
@@ -0,0 +1,56 @@
+import os
+import threading
+from twisted.internet import reactor
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import CassBotService
+
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=reactor,
+                                   statefile=self.mktemp())
+        self.addCleanup(self.serv.workers.stop)
+        self.serv.auth.addPriv('boss!*@*', 'admin')
+        self.serv.enable_plugin_by_name('Profiler')
+        self.profiler = self.serv.pluginmap['Profiler']
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+        self.replies = []
+        def address_msg(user, channel, msg):
+            self.replies.append((msg, threading.current_thread().name))
+        self.bot.address_msg = address_msg
+
+    def start(self):
+        self.profiler.command_profile(self.bot, 'boss!b@host', '#c', ['30', '3'])
+        self.addCleanup(self.profiler.shutdown)
+        self.assertNotIdentical(self.profiler.profile, None)
+
+    def test_needs_admin(self):
+        self.profiler.command_profile(self.bot, 'pleb!p@host', '#c', ['30'])
+        self.assertIdentical(self.profiler.profile, None)
+        self.assertEqual(self.replies[0][0], 'command profile requires privilege admin')
+
+    def test_report_written_in_worker(self):
+        self.start()
+        sum(range(1000))
+        self.profiler.finish_call.cancel()
+        d = self.profiler.finish(self.bot, 'boss!b@host', '#c', 30.0, 3)
+        def check(_):
+            self.assertIdentical(self.profiler.profile, None)
+            msg, thread = self.replies[-1]
+            # the report is built in a worker, but the reply is sent from
+            # the reactor thread
+            self.assertEqual(thread, 'MainThread')
+            self.assertTrue(msg.startswith('Profiled 30.0 seconds: '))
+            dumpfile = msg.rsplit(' ', 1)[-1]
+            self.assertTrue(os.path.exists(dumpfile))
+            os.remove(dumpfile)
+        return d.addCallback(check)
+
+    def test_disable_unhooks(self):
+        self.start()
+        call = self.profiler.finish_call
+        self.serv.disable_plugin('Profiler')
+        self.assertIdentical(self.profiler.profile, None)
+        self.assertFalse(call.active())
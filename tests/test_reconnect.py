@@ -0,0 +1,125 @@
+import random
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import CassBotService
+
+
+class FakeConnector:
+    def __init__(self):
+        self.attempts = 0
+
+    def connect(self):
+        self.attempts += 1
+
+
+class CarriedStateTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=self.clock,
+                                   statefile=self.mktemp())
+        self.serv.state['channels'] = ('#a',)
+        self.factory = self.serv.pfactory
+        bot = self.connect()
+        bot.signedOn()
+        for channel in ('#a', '#b'):
+            self.join(bot, channel, '@x y')
+            bot.lineReceived(':x!u@h TOPIC %s :about %s' % (channel, channel))
+            bot.lineReceived(':x!u@h MODE %s +m' % channel)
+        self.clock.advance(100)
+        bot.connectionLost(None)
+
+    def connect(self):
+        bot = self.factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        bot.makeConnection(self.transport)
+        return bot
+
+    def join(self, bot, channel, names):
+        bot.lineReceived(':cassbot!bot@host JOIN %s' % channel)
+        bot.lineReceived(':server 353 cassbot = %s :%s' % (channel, names))
+        bot.lineReceived(':server 366 cassbot %s :End of /NAMES list.' % channel)
+
+    def test_state_carried_and_marked_stale(self):
+        self.assertEqual(self.factory.lost_at, 100)
+        bot = self.connect()
+        self.assertIdentical(self.factory.carried_state, None)
+        self.assertEqual(bot.stale_channels, {
+            '#a': set(['names', 'topic', 'modes']),
+            '#b': set(['names', 'topic', 'modes'])})
+        self.assertEqual(bot.channels, set())
+        self.assertEqual(bot.channel_memberships['#a'], set(['x', 'y']))
+        self.assertEqual(bot.topic_map['#b'], 'about #b')
+        self.assertEqual(bot.chan_modemap['#a'], {'x': set('o'), None: set('m')})
+
+    def test_rejoined_channel_refreshed(self):
+        bot = self.connect()
+        self.clock.advance(20)
+        bot.signedOn()
+        self.assertEqual(self.serv.metrics.reconnect_downtime.count(('default',)), 1)
+        self.assertIdentical(self.factory.lost_at, None)
+        bot.lineReceived(':cassbot!bot@host JOIN #a')
+        # members carried over are kept until NAMES comes in
+        self.assertEqual(bot.channel_memberships['#a'], set(['x', 'y']))
+        bot.lineReceived(':server 353 cassbot = #a :+y z')
+        bot.lineReceived(':server 366 cassbot #a :End of /NAMES list.')
+        # no topic came before NAMES, so it was cleared
+        self.assertNotIn('#a', bot.topic_map)
+        self.assertEqual(bot.stale_channels['#a'], set(['modes']))
+        self.assertEqual(bot.channel_memberships['#a'], set(['y', 'z']))
+        self.assertEqual(bot.chan_modemap['#a'], {'y': set('v'), None: set('m')})
+        bot.lineReceived(':server 324 cassbot #a +n')
+        self.assertNotIn('#a', bot.stale_channels)
+        self.assertEqual(bot.chan_modemap['#a'], {'y': set('v'), None: set('n')})
+
+    def test_channels_not_rejoined_dropped(self):
+        bot = self.connect()
+        bot.signedOn()
+        self.join(bot, '#a', 'x')
+        # the join scheduler is done, so nothing is coming for #b
+        self.assertEqual(bot.joiner.status(), 'synced 1 channels in 0.0s')
+        self.assertNotIn('#b', bot.stale_channels)
+        self.assertNotIn('#b', bot.channel_memberships)
+        self.assertNotIn('#b', bot.topic_map)
+        self.assertNotIn('#b', bot.chan_modemap)
+        self.assertEqual(bot.channel_memberships.channels_of('y'), frozenset())
+
+
+class RetryTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=self.clock,
+                                   statefile=self.mktemp())
+        self.factory = self.serv.pfactory
+        self.factory.clock = self.clock
+        self.connector = FakeConnector()
+
+    def test_backoff_without_jitter(self):
+        self.patch(random, 'random', lambda: 0.0)
+        for expected in (2.0, 4.0, 8.0):
+            self.factory.retry(self.connector)
+            self.assertEqual(self.clock.getDelayedCalls()[0].getTime(),
+                             self.clock.seconds() + expected)
+            self.clock.advance(expected)
+        self.assertEqual(self.connector.attempts, 3)
+
+    def test_jitter_only_shortens_the_wait_at_hand(self):
+        self.patch(random, 'random', lambda: 1.0)
+        self.factory.retry(self.connector)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 1.0)
+        self.clock.advance(1.0)
+        self.factory.retry(self.connector)
+        # the delay doubled in full; only the wait was cut
+        self.assertEqual(self.factory.delay, 4.0)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 3.0)
+
+    def test_delay_capped(self):
+        self.factory.delay = self.factory.maxDelay
+        self.factory.retry(self.connector)
+        wait = self.clock.getDelayedCalls()[0].getTime()
+        self.assertTrue(self.factory.maxDelay * 0.5 <= wait <= self.factory.maxDelay)
+
+    def test_stopped(self):
+        self.factory.stopTrying()
+        self.factory.retry(self.connector)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
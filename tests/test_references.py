@@ -0,0 +1,74 @@
+import re
+from twisted.trial import unittest
+from cassbot import ReferenceScanner
+from cassbot_plugins.link_checker import CassandraLinkChecker
+from cassbot_plugins.zendesk_links import ZendeskLinkChecker
+
+
+class ReferenceScannerTests(unittest.TestCase):
+    messages = [
+        'nothing to see here',
+        'see #1234 and r5678',
+        'CASSANDRA ##5,#1234-#2345 (#3456)',
+        'r12#3456 z77',
+        'r123 r124,r125',
+        '#12 z1 r1 z99999 z100000',
+        'z12/#345/r678',
+    ]
+
+    def scanner(self, plugins):
+        scanner = ReferenceScanner()
+        for p in plugins:
+            for refspec in p.referencePatterns():
+                scanner.register(p, *refspec)
+        return scanner
+
+    def separate_scans(self, plugins, msg):
+        # as each plugin used to scan for its own patterns
+        found = []
+        for p in plugins:
+            refs = []
+            for key, pattern in p.referencePatterns():
+                refs.extend((key, m.span()) for m in re.finditer(pattern, msg))
+            if refs:
+                found.append((p, sorted(refs, key=lambda (key, span): span)))
+        return found
+
+    def assertSameAsSeparate(self, plugins, msg):
+        scanned = [(owner, [(key, (m.start(), m.end())) for (key, m) in refs])
+                   for (owner, refs) in self.scanner(plugins).scan(msg)]
+        self.assertEqual(scanned, self.separate_scans(plugins, msg), msg)
+
+    def test_shipped_patterns(self):
+        plugins = [CassandraLinkChecker(), ZendeskLinkChecker()]
+        for msg in self.messages:
+            self.assertSameAsSeparate(plugins, msg)
+
+    def test_overlapping_patterns(self):
+        # a Zendesk letter of 'r' claims the same text as commit_re; both
+        # plugins still get it
+        zendesk = ZendeskLinkChecker()
+        zendesk.loadState({'ticket_letter': 'r'})
+        plugins = [CassandraLinkChecker(), zendesk]
+        for msg in self.messages:
+            self.assertSameAsSeparate(plugins, msg)
+        [(owner1, refs1), (owner2, refs2)] = self.scanner(plugins).scan('see r123')
+        self.assertEqual([m.group(1) for (key, m) in refs1], ['123'])
+        self.assertEqual([m.group(1) for (key, m) in refs2], ['123'])
+
+    def test_adjacent_to_consumed_separator(self):
+        # ticket_re takes the character before the '#' with it, which a
+        # pattern starting at that character must still be able to match
+        class Slashes:
+            def referencePatterns(self):
+                return [('path', r'/(\d+)/')]
+        plugins = [CassandraLinkChecker(), Slashes()]
+        self.assertSameAsSeparate(plugins, 'a/123/#4567 b')
+        self.assertSameAsSeparate(plugins, 'x/12/#345/678/')
+        found = dict(self.scanner(plugins).scan('x/12/#345/678/'))
+        self.assertEqual([m.group(1) for (key, m) in found[plugins[1]]], ['12', '678'])
+
+    def test_no_digits_no_scan(self):
+        scanner = self.scanner([CassandraLinkChecker()])
+        self.assertEqual(scanner.scan('no references here'), [])
+        self.assertEqual(scanner.scan('#abc r'), [])
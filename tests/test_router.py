@@ -0,0 +1,84 @@
+from twisted.trial import unittest
+from cassbot import BaseBotPlugin, CommandParseError, CommandRouter, split_command
+
+
+class Builder(BaseBotPlugin):
+    command_aliases = {'mk': 'build', 'stat': 'status'}
+
+    def command_build(self, bot, user, channel, args):
+        pass
+
+    def command_status(self, bot, user, channel, args):
+        pass
+
+
+class Stats(BaseBotPlugin):
+    def command_status(self, bot, user, channel, args):
+        pass
+
+    def command_stats_reset(self, bot, user, channel, args):
+        pass
+
+
+class FakeService:
+    def __init__(self, plugins):
+        self.command_map = {}
+        for p in plugins:
+            for cmd in p.implementedCommands():
+                self.command_map.setdefault(cmd, []).append(p)
+
+
+class CommandRouterTests(unittest.TestCase):
+    def setUp(self):
+        self.builder = Builder()
+        self.stats = Stats()
+        self.router = CommandRouter(FakeService([self.builder, self.stats]))
+
+    def test_exact(self):
+        cmd, handlers = self.router.route('build')
+        self.assertEqual(cmd, 'build')
+        self.assertEqual(handlers, ((self.builder, self.builder.command_build),))
+
+    def test_all_handlers(self):
+        cmd, handlers = self.router.route('STATUS')
+        self.assertEqual(cmd, 'status')
+        self.assertEqual([p for (p, m) in handlers], [self.builder, self.stats])
+
+    def test_dashes(self):
+        self.assertEqual(self.router.route('stats-reset')[0], 'stats_reset')
+
+    def test_abbreviation(self):
+        self.assertEqual(self.router.route('bui')[0], 'build')
+        self.assertEqual(self.router.route('stats_')[0], 'stats_reset')
+        # too short
+        self.assertEqual(self.router.route('bu'), None)
+
+    def test_ambiguous_abbreviation(self):
+        self.assertEqual(self.router.route('sta'), (None, ('stats_reset', 'status')))
+
+    def test_aliases(self):
+        self.assertEqual(self.router.route('mk')[0], 'build')
+        # an alias wins over an ambiguous abbreviation
+        self.assertEqual(self.router.route('stat')[0], 'status')
+
+    def test_unknown(self):
+        self.assertEqual(self.router.route('deploy'), None)
+
+    def test_invalidate(self):
+        self.router.route('build')
+        del self.router.service.command_map['build']
+        self.assertNotEqual(self.router.route('build'), None)
+        self.router.invalidate()
+        self.assertEqual(self.router.route('build'), None)
+
+
+class SplitCommandTests(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(split_command('  build  trunk now '), ['build', 'trunk', 'now'])
+
+    def test_quoted(self):
+        self.assertEqual(split_command('say "hello there" it\\\'s'),
+                         ['say', 'hello there', "it's"])
+
+    def test_unbalanced(self):
+        self.assertRaises(CommandParseError, split_command, 'say "hello')
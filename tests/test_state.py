@@ -0,0 +1,211 @@
+import os
+import sqlite3
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from twisted.internet import task
+from twisted.trial import unittest
+from cassbot import CassBotService
+from cassbot_state import (SQLiteStateStore, PluginStateMap, auth_rows, auth_state,
+                           open_state_store, sqlite_magic)
+
+authstate = ({'admin': set(['me!*@*'])},
+             {'#chan': ({'op': set(['you!*@*', 'them!*@*'])}, {})})
+
+
+class AuthRowsTests(unittest.TestCase):
+    def test_round_trip(self):
+        rows = auth_rows(authstate)
+        self.assertEqual(rows, set([('', 'admin', 'me!*@*'),
+                                    ('#chan', 'op', 'you!*@*'),
+                                    ('#chan', 'op', 'them!*@*')]))
+        self.assertEqual(auth_state(rows), authstate)
+
+
+class SQLiteStateStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.store = self.open()
+
+    def open(self):
+        store = SQLiteStateStore(self.path)
+        self.addCleanup(store.close)
+        return store
+
+    def record_writes(self, store):
+        writes = []
+        write = store.write
+        def recording(*a):
+            writes.append(a)
+            return write(*a)
+        store.write = recording
+        return writes
+
+    def test_round_trip(self):
+        self.assertTrue(self.store.is_empty())
+        self.store.save({'nickname': 'bot', 'channels': ['#a']},
+                        {'P': {'x': 1}}, authstate)
+        again = self.open()
+        self.assertFalse(again.is_empty())
+        self.assertEqual(again.load_settings(), {'nickname': 'bot', 'channels': ['#a']})
+        self.assertEqual(again.load_plugin('P'), {'x': 1})
+        self.assertRaises(KeyError, again.load_plugin, 'Q')
+        self.assertEqual(again.load_auth(), authstate)
+
+    def test_writes_only_changes(self):
+        self.store.save({'nickname': 'bot', 'channels': ['#a']},
+                        {'P': {'x': 1}, 'Q': {'y': 2}}, authstate)
+        again = self.open()
+        settings = again.load_settings()
+        again.load_plugin('P')
+        again.load_auth()
+        writes = self.record_writes(again)
+        again.save(settings, {}, authstate)
+        self.assertEqual(writes, [])
+        settings['channels'] = ['#a', '#b']
+        newauth = ({'admin': set(['me!*@*', 'new!*@*'])}, authstate[1])
+        again.save(settings, {'P': {'x': 1}, 'Q': None}, newauth)
+        [(puts, deletes, added, removed)] = writes
+        self.assertEqual(puts.keys(), [('setting', 'channels')])
+        self.assertEqual(deletes, set([('plugin', 'Q')]))
+        self.assertEqual(added, set([('', 'admin', 'new!*@*')]))
+        self.assertEqual(removed, set())
+        self.assertRaises(KeyError, self.open().load_plugin, 'Q')
+
+    def test_removed_settings(self):
+        self.store.save({'a': 1, 'b': 2}, {}, ({}, {}))
+        self.store.save({'a': 1}, {}, ({}, {}))
+        self.assertEqual(self.open().load_settings(), {'a': 1})
+
+
+class PluginStateMapTests(unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteStateStore(self.mktemp())
+        self.addCleanup(self.store.close)
+        self.store.save({'a': 1}, {'P': {'x': 1}, 'Q': {'y': 2}}, ({}, {}))
+        self.store.known.clear()
+        self.plugins = PluginStateMap(self.store)
+
+    def test_lazy(self):
+        self.assertEqual(self.plugins.get('P'), {'x': 1})
+        self.assertEqual(self.store.known.keys(), [('plugin', 'P')])
+        self.assertNotIn('R', self.plugins)
+        self.assertRaises(KeyError, lambda: self.plugins['R'])
+
+    def test_changes(self):
+        self.plugins['R'] = {'z': 3}
+        self.assertEqual(self.plugins.pop('Q'), {'y': 2})
+        self.assertEqual(self.plugins.pop('nope', 'default'), 'default')
+        changes = self.plugins.changes()
+        self.assertEqual(changes, {'R': {'z': 3}, 'Q': None})
+        self.plugins['Q'] = {'y': 3}
+        self.plugins.saved(changes)
+        self.assertEqual(self.plugins.changes(), {'Q': {'y': 3}})
+
+
+class MigrationTests(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.old = {'nickname': 'oldbot', 'networks': {},
+                    'plugins': {'P': {'x': 1}}, 'auth_map': authstate}
+        with open(self.path, 'wb') as f:
+            pickle.dump(self.old, f, -1)
+
+    def head(self):
+        with open(self.path, 'rb') as f:
+            return f.read(len(sqlite_magic))
+
+    def test_migrates(self):
+        store = open_state_store(self.path)
+        self.addCleanup(store.close)
+        self.assertEqual(self.head(), sqlite_magic)
+        self.assertEqual(store.load_settings(), {'nickname': 'oldbot', 'networks': {}})
+        self.assertEqual(store.load_plugin('P'), {'x': 1})
+        self.assertEqual(store.load_auth(), authstate)
+        with open(self.path + '.pickle', 'rb') as f:
+            self.assertEqual(pickle.load(f), self.old)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_failed_migration_keeps_pickle(self):
+        def broken(*a):
+            raise IOError('disk full')
+        restore = self.patch(SQLiteStateStore, 'write', broken)
+        self.assertRaises(IOError, open_state_store, self.path)
+        self.assertNotEqual(self.head(), sqlite_magic)
+        self.assertFalse(os.path.exists(self.path + '.pickle'))
+        restore.restore()
+        store = open_state_store(self.path)
+        self.addCleanup(store.close)
+        self.assertEqual(store.load_plugin('P'), {'x': 1})
+
+
+class ServiceStateTests(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def service(self):
+        serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                              statefile=self.path)
+        self.addCleanup(lambda: serv.state_store and serv.state_store.close())
+        return serv
+
+    def test_save_and_load(self):
+        serv = self.service()
+        serv.state['nickname'] = 'saved'
+        serv.state['plugins']['BuildCommand'] = {'cooldown': 5}
+        serv.auth.addPriv('me!*@*', 'admin')
+        serv.saveStateToFile(self.path)
+        serv.state_store.close()
+        serv.state_store = None
+        serv = self.service()
+        serv.loadStateFromFile(self.path)
+        self.assertEqual(serv.state['nickname'], 'saved')
+        self.assertEqual(serv.state['plugins'].get('BuildCommand'), {'cooldown': 5})
+        self.assertTrue(serv.auth.userHas('me!u@h', 'admin'))
+
+    def test_load_twice(self):
+        serv = self.service()
+        serv.state['plugins']['BuildCommand'] = {'cooldown': 5}
+        serv.loadStateFromFile(self.path)
+        serv.loadStateFromFile(self.path)
+        self.assertEqual(serv.state['plugins'].get('BuildCommand'), {'cooldown': 5})
+
+    def test_failed_save_keeps_changes(self):
+        serv = self.service()
+        serv.loadStateFromFile(self.path)
+        serv.state['plugins']['BuildCommand'] = {'cooldown': 5}
+        def fail(*a):
+            raise sqlite3.OperationalError('disk I/O error')
+        self.patch(serv.state_store, 'write', fail)
+        self.assertRaises(sqlite3.OperationalError, serv.saveStateToFile, self.path)
+        del serv.state_store.write
+        serv.saveStateToFile(self.path)
+        self.assertEqual(serv.state['plugins'].changes(), {})
+        again = SQLiteStateStore(self.path)
+        self.addCleanup(again.close)
+        self.assertEqual(again.load_plugin('BuildCommand'), {'cooldown': 5})
+
+    def assertStartsEmpty(self, contents):
+        with open(self.path, 'wb') as f:
+            f.write(contents)
+        serv = self.service()
+        serv.state['nickname'] = 'given'
+        serv.load_saved_state()
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
+        self.assertEqual(serv.state['nickname'], 'given')
+        [bad] = [name for name in os.listdir(os.path.dirname(self.path))
+                 if name.startswith(os.path.basename(self.path) + '.bad-')]
+        with open(os.path.join(os.path.dirname(self.path), bad), 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        # and the new state file works
+        serv.saveStateToFile(self.path)
+        store = SQLiteStateStore(self.path)
+        self.addCleanup(store.close)
+        self.assertEqual(store.load_settings()['nickname'], 'given')
+
+    def test_corrupt_database(self):
+        self.assertStartsEmpty(sqlite_magic + 'garbage' * 1000)
+
+    def test_truncated_pickle(self):
+        self.assertStartsEmpty(pickle.dumps({'nickname': 'old', 'plugins': {}}, 2)[:20])
@@ -0,0 +1,123 @@
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from cassbot import BaseBotPlugin, CassBotService, TokenBucket, UserThrottle
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_refill(self):
+        clock = task.Clock()
+        bucket = TokenBucket(2, 3, clock)
+        self.assertTrue(bucket.consume(3))
+        self.assertFalse(bucket.consume())
+        self.assertEqual(bucket.delay(), 0.5)
+        clock.advance(0.5)
+        self.assertTrue(bucket.consume())
+        clock.advance(100)
+        bucket.refill()
+        self.assertEqual(bucket.tokens, 3)
+
+
+class UserThrottleTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.throttle = UserThrottle(1, 2, self.clock)
+        self.throttle.max_users = self.throttle.prune_at = 4
+
+    def test_admit_and_refuse(self):
+        self.assertTrue(self.throttle.admit('a'))
+        self.assertTrue(self.throttle.admit('a'))
+        self.assertFalse(self.throttle.admit('a'))
+        self.assertTrue(self.throttle.admit('b'))
+        self.assertEqual(self.throttle.refused, 1)
+
+    def test_prune_drops_only_full_buckets(self):
+        for key in 'abc':
+            self.throttle.admit(key)
+        self.clock.advance(5)
+        # d is busy; a, b and c have refilled
+        self.throttle.admit('d')
+        self.throttle.admit('d')
+        self.throttle.admit('e')
+        self.assertEqual(sorted(self.throttle.buckets), ['d', 'e'])
+
+    def test_busy_users_keep_their_buckets(self):
+        for key in 'abcd':
+            self.throttle.admit(key)
+            self.throttle.admit(key)
+        self.throttle.admit('e')
+        self.assertEqual(sorted(self.throttle.buckets), list('abcde'))
+        # still throttled
+        self.assertFalse(self.throttle.admit('a'))
+        # and no prune on every new user while they're all busy
+        self.assertEqual(self.throttle.prune_at, 8)
+
+
+class AdminExemptionTests(unittest.TestCase):
+    def setUp(self):
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=task.Clock(),
+                                   statefile=self.mktemp())
+        self.serv.state['command_rate'] = 1
+        self.serv.state['command_burst'] = 1
+        self.serv.configure_throttle()
+        self.serv.auth.addPriv('boss!*@*', 'admin')
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+
+    def test_admin_gets_no_bucket(self):
+        for n in range(5):
+            self.assertTrue(self.bot.admit_command('boss!b@host', '#c'))
+        throttle = self.serv.command_throttle
+        self.assertEqual(throttle.buckets, {})
+        self.assertEqual(throttle.refused, 0)
+
+    def test_others_are_throttled(self):
+        self.assertTrue(self.bot.admit_command('pleb!p@host', '#c'))
+        self.assertFalse(self.bot.admit_command('pleb!p@host', '#c'))
+        self.assertEqual(self.serv.command_throttle.refused, 1)
+
+
+class Replier(BaseBotPlugin):
+    def command_fast(self, bot, user, channel, args):
+        return bot.address_msg(user, channel, 'done')
+
+    def command_slow(self, bot, user, channel, args):
+        return task.deferLater(bot.service.reactor, 5, lambda: None)
+
+
+class CommandTimeoutTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.serv = CassBotService('tcp:host=localhost:port=1', reactor=self.clock,
+                                   statefile=self.mktemp())
+        self.serv.state['flood_rate'] = 1
+        self.serv.state['flood_burst'] = 1
+        self.serv.state['command_timeout'] = 2
+        self.serv.auth.addPriv('boss!*@*', 'admin')
+        self.bot = self.serv.pfactory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.bot.makeConnection(self.transport)
+        self.plugin = self.serv.pluginmap['Replier'] = Replier()
+        self.serv.attach_plugin(self.plugin)
+
+    def outcomes(self, cmd):
+        return dict((outcome, n) for ((c, chan, outcome), n)
+                    in self.serv.metrics.commands.series.iteritems() if c == cmd)
+
+    def test_fast_command_behind_slow_queue(self):
+        self.bot.outqueue.enqueue('#c', ['backlog %d' % n for n in range(10)])
+        d = self.bot.dispatch_command('boss!b@host', '#c', 'fast', [])
+        self.successResultOf(d)
+        self.assertEqual(self.outcomes('fast'), {'ok': 1})
+        self.assertEqual(self.serv.in_flight.get('Replier', 0), 0)
+        self.clock.pump([1] * 12)
+        self.assertEqual(self.outcomes('fast'), {'ok': 1})
+        sent = self.transport.value()
+        self.assertIn('boss: done', sent)
+        self.assertNotIn('timed out', sent)
+
+    def test_slow_command_times_out(self):
+        self.bot.dispatch_command('boss!b@host', '#c', 'slow', [])
+        self.clock.pump([1] * 3)
+        self.assertEqual(self.outcomes('slow'), {'timeout': 1})
+        self.assertIn("The 'slow' command timed out.", self.transport.value())
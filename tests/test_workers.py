@@ -0,0 +1,140 @@
+import time
+import threading
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from cassbot import (ThreadWorkers, ProcessWorkers, ReactorProxy, WorkerError,
+                     BaseBotPlugin, CassBotService, blocking, cpu_bound,
+                     process_workers)
+
+
+@cpu_bound
+def square(n):
+    return n * n
+
+@cpu_bound
+def fail(msg):
+    raise ValueError(msg)
+
+@cpu_bound
+def nap(seconds):
+    time.sleep(seconds)
+
+
+class Blocker(BaseBotPlugin):
+    @blocking
+    def command_wait(self, bot, user, channel, args):
+        return threading.current_thread().name, bot.record(len(args))
+
+
+class Target:
+    def __init__(self):
+        self.calls = []
+
+    def record(self, x):
+        self.calls.append((x, threading.current_thread().name))
+        return x + 1
+
+
+class ThreadWorkersTests(unittest.TestCase):
+    def setUp(self):
+        self.workers = ThreadWorkers(reactor, 2)
+
+    def tearDown(self):
+        return self.workers.stop()
+
+    def test_run(self):
+        d = self.workers.run(lambda a, b: a + b, 1, b=2)
+        d.addCallback(self.assertEqual, 3)
+        return d
+
+    def test_failure(self):
+        d = self.workers.run(lambda: 1 / 0)
+        return self.assertFailure(d, ZeroDivisionError)
+
+    def test_stop_lets_jobs_call_into_reactor(self):
+        # a job waiting on the reactor through a ReactorProxy while the
+        # pool is being stopped must still get its answer
+        target = Target()
+        proxy = ReactorProxy(target, reactor)
+        go = threading.Event()
+        def job():
+            go.wait(5)
+            return proxy.record(1)
+        d = self.workers.run(job)
+        stopped = self.workers.stop()
+        go.set()
+        def check(results):
+            self.assertEqual(results[0], 2)
+            self.assertEqual(target.calls, [(1, 'MainThread')])
+        return defer.gatherResults([d, stopped]).addCallback(check)
+
+    def test_runs_again_after_stop(self):
+        d = self.workers.stop()
+        d.addCallback(lambda _: self.workers.run(lambda: 'again'))
+        d.addCallback(self.assertEqual, 'again')
+        return d
+
+
+class ProcessWorkersTests(unittest.TestCase):
+    def setUp(self):
+        self.workers = ProcessWorkers(1)
+
+    def tearDown(self):
+        self.workers.stop()
+
+    def test_run(self):
+        d = self.workers.run(square, 7)
+        d.addCallback(self.assertEqual, 49)
+        return d
+
+    def test_failure(self):
+        d = self.workers.run(fail, 'oops')
+        d = self.assertFailure(d, WorkerError)
+        d.addCallback(lambda e: self.assertIn('oops', str(e)))
+        return d
+
+    def test_unpickleable_arguments_fail_right_away(self):
+        d = self.workers.run(square, lambda: 1)
+        self.failureResultOf(d, WorkerError)
+        self.assertEqual(self.workers.pending, set())
+
+    def test_timeout(self):
+        self.workers.job_timeout = 0.2
+        d = self.workers.run(nap, 5)
+        d = self.assertFailure(d, WorkerError)
+        d.addCallback(lambda e: self.assertIn('within', str(e)))
+        d.addCallback(lambda _: self.assertEqual(self.workers.stats()['failed'], 1))
+        return d
+
+    def test_stop_fails_pending(self):
+        d = self.workers.run(nap, 5)
+        self.workers.stop()
+        self.failureResultOf(d, WorkerError)
+
+
+class DecoratorTests(unittest.TestCase):
+    def tearDown(self):
+        process_workers.stop()
+
+    def test_blocking(self):
+        serv = CassBotService('tcp:host=localhost:port=1', reactor=reactor,
+                              statefile=self.mktemp())
+        self.addCleanup(serv.workers.stop)
+        bot = Target()
+        bot.service = serv
+        d = Blocker().command_wait(bot, 'me!m@host', '#c', ['a', 'b'])
+        def check((thread, recorded)):
+            self.assertNotEqual(thread, 'MainThread')
+            self.assertEqual(recorded, 3)
+            # the bot was only touched from the reactor thread
+            self.assertEqual(bot.calls, [(2, 'MainThread')])
+        return d.addCallback(check)
+
+    def test_cpu_bound(self):
+        self.assertEqual(square.func(3), 9)
+        done = process_workers.stats()['done']
+        d = square(6)
+        d.addCallback(self.assertEqual, 36)
+        d.addCallback(lambda _: self.assertEqual(process_workers.stats()['done'],
+                                                 done + 1))
+        return d